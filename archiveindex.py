@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import email.utils
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from message import Message, message_from_bytes
+from rawcodec import has_raw, raw_path, raw_size
+from segmentstore import find_stores
+
+INDEX_FILENAME = 'imapbox.sqlite'
+FLUSH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    path TEXT PRIMARY KEY,
+    message_id TEXT,
+    sha224 TEXT,
+    account TEXT,
+    folder TEXT,
+    uid INTEGER,
+    size INTEGER,
+    date TEXT,
+    gmail_id TEXT,
+    properties TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id);
+CREATE INDEX IF NOT EXISTS messages_sha224 ON messages (sha224);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+CREATE TABLE IF NOT EXISTS folders (
+    account TEXT,
+    folder TEXT,
+    uidvalidity INTEGER,
+    last_uid INTEGER,
+    highestmodseq INTEGER,
+    PRIMARY KEY (account, folder)
+);
+"""
+
+# Full-text index, rows of messages_text have the id of the texts row of their folder
+TEXT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS texts (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5 (
+    subject, sender, recipients, body, attachments
+);
+"""
+
+
+def utc_date(datestr):
+    """Convert a Date header to the ISO 8601 UTC format used in metadata.json"""
+    t = email.utils.parsedate_tz(datestr) if datestr else None
+    if not t:
+        return None
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(email.utils.mktime_tz(t)))
+
+
+def addresses(value):
+    """Text of the From, To or Cc metadata, a [name, address] pair or a list of them"""
+    if not value:
+        return ''
+    if isinstance(value[0], str):
+        value = [value]
+    return ' '.join(' '.join(part for part in pair if part) for pair in value)
+
+
+def phrase(text):
+    """FTS5 string matching text as a phrase"""
+    return '"%s"' % text.replace('"', '""')
+
+
+def search_date(day):
+    """YYYY-MM-DD to the date format of the messages table"""
+    return day.replace('-', '') + 'T000000Z'
+
+
+class ArchiveIndex:
+    """Catalog of the archived messages, stored in a SQLite database at the archive root
+
+    The message folders are kept in memory so checking if a message is archived
+    does not touch the filesystem, new rows are written in bulk. With fulltext,
+    the metadata of the messages is also indexed in a FTS5 table for search().
+    """
+
+    def __init__(self, root, filename=INDEX_FILENAME, fulltext=True):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.connection = sqlite3.connect(os.path.join(root, filename), check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        # Columns added after the first version of the index
+        self.add_column('folders', 'highestmodseq', 'INTEGER')
+        self.add_column('messages', 'gmail_id', 'TEXT')
+        self.add_column('messages', 'properties', 'TEXT')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS messages_gmail_id ON messages (gmail_id)')
+        self.fulltext = fulltext
+        if fulltext:
+            try:
+                self.connection.executescript(TEXT_SCHEMA)
+            except sqlite3.OperationalError as e:
+                print("Full-text index disabled: {}".format(e))
+                self.fulltext = False
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_text = []
+        self.paths = set(row[0] for row in self.connection.execute('SELECT path FROM messages'))
+        self.gmail_ids = set(row[0] for row in self.connection.execute('SELECT gmail_id FROM messages WHERE gmail_id IS NOT NULL'))
+
+    def add_column(self, table, column, type):
+        if column not in [row[1] for row in self.connection.execute('PRAGMA table_info(%s)' % table)]:
+            with self.connection:
+                self.connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, type))
+
+    def relpath(self, directory):
+        return os.path.relpath(directory, self.root)
+
+    def __contains__(self, directory):
+        return self.relpath(directory) in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def has_gmail_id(self, gmail_id):
+        return gmail_id in self.gmail_ids
+
+    def add(self, directory, message_id=None, sha224=None, account=None, folder=None, uid=None, size=None, date=None,
+            gmail_id=None, properties=None):
+        """properties are the flags and labels of a message stored in a segment, it has no metadata.json"""
+        path = self.relpath(directory)
+        with self.lock:
+            self.paths.add(path)
+            if gmail_id:
+                self.gmail_ids.add(gmail_id)
+            self.pending.append((path, message_id, sha224, account, folder, uid, size, date, gmail_id,
+                                 json.dumps(properties) if properties else None))
+            if len(self.pending) >= FLUSH_SIZE:
+                self._flush()
+
+    def add_text(self, directory, metadata):
+        """Index the text of a message, metadata has the properties of metadata.json"""
+        if not self.fulltext:
+            return
+        row = (self.relpath(directory),
+               metadata.get('Subject') or '',
+               addresses(metadata.get('From')),
+               ' '.join([addresses(metadata.get('To')), addresses(metadata.get('Cc'))]),
+               metadata.get('Body') or '',
+               ' '.join(metadata.get('Attachments') or []))
+        with self.lock:
+            self.pending_text.append(row)
+            if len(self.pending_text) >= FLUSH_SIZE:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self._flush_messages()
+        if self.pending_text:
+            self._flush_texts()
+
+    def _flush_texts(self):
+        with self.connection:
+            for path, subject, sender, recipients, body, attachments in self.pending_text:
+                self.connection.execute('INSERT OR IGNORE INTO texts (path) VALUES (?)', (path,))
+                rowid = self.connection.execute('SELECT id FROM texts WHERE path = ?', (path,)).fetchone()[0]
+                self.connection.execute('DELETE FROM messages_text WHERE rowid = ?', (rowid,))
+                self.connection.execute('INSERT INTO messages_text (rowid, subject, sender, recipients, body, attachments) '
+                                        'VALUES (?, ?, ?, ?, ?, ?)', (rowid, subject, sender, recipients, body, attachments))
+        self.pending_text = []
+
+    def _flush_messages(self):
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO messages (path, message_id, sha224, account, folder, uid, size, date, gmail_id, properties)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    message_id = excluded.message_id,
+                    sha224 = COALESCE(excluded.sha224, sha224),
+                    account = COALESCE(excluded.account, account),
+                    folder = COALESCE(excluded.folder, folder),
+                    uid = COALESCE(excluded.uid, uid),
+                    size = COALESCE(excluded.size, size),
+                    date = COALESCE(excluded.date, date),
+                    gmail_id = COALESCE(excluded.gmail_id, gmail_id),
+                    properties = COALESCE(excluded.properties, properties)
+            """, self.pending)
+        self.pending = []
+
+    def search(self, query=None, sender=None, recipient=None, since=None, before=None, limit=50):
+        """Messages matching a FTS5 query and filters, as (path, date, subject) tuples, newest first
+
+        sender and recipient are matched as phrases, like an address or a name,
+        since and before are YYYY-MM-DD days.
+        """
+        terms = []
+        if query:
+            terms.append('(%s)' % query)
+        if sender:
+            terms.append('sender : %s' % phrase(sender))
+        if recipient:
+            terms.append('recipients : %s' % phrase(recipient))
+
+        conditions = []
+        args = []
+        if terms:
+            conditions.append('messages_text MATCH ?')
+            args.append(' AND '.join(terms))
+        if since:
+            conditions.append('messages.date >= ?')
+            args.append(search_date(since))
+        if before:
+            conditions.append('messages.date < ?')
+            args.append(search_date(before))
+
+        sql = """
+            SELECT texts.path, messages.date, messages_text.subject
+            FROM messages_text
+            JOIN texts ON texts.id = messages_text.rowid
+            LEFT JOIN messages ON messages.path = texts.path
+        """
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY messages.date DESC LIMIT ?'
+        args.append(limit)
+
+        self.flush()
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def get_folder(self, account, folder):
+        """Synchronization state of a remote folder, None if it was never synchronized"""
+        with self.lock:
+            row = self.connection.execute('SELECT uidvalidity, last_uid, highestmodseq FROM folders WHERE account IS ? AND folder = ?',
+                                          (account, folder)).fetchone()
+        if row is None:
+            return None
+        return {'uidvalidity': row[0], 'last_uid': row[1], 'highestmodseq': row[2]}
+
+    def set_folder(self, account, folder, uidvalidity, last_uid, highestmodseq=None):
+        with self.lock:
+            # Messages are written before the state that refers to them
+            self._flush()
+            with self.connection:
+                self.connection.execute('DELETE FROM folders WHERE account IS ? AND folder = ?', (account, folder))
+                self.connection.execute('INSERT INTO folders (account, folder, uidvalidity, last_uid, highestmodseq) '
+                                        'VALUES (?, ?, ?, ?, ?)', (account, folder, uidvalidity, last_uid, highestmodseq))
+
+    def get_uids(self, account, folder):
+        """Message folders of a remote folder by UID"""
+        with self.lock:
+            self._flush()
+            rows = self.connection.execute('SELECT uid, path FROM messages WHERE account IS ? AND folder = ? AND uid IS NOT NULL',
+                                           (account, folder)).fetchall()
+        return dict((uid, os.path.join(self.root, path)) for uid, path in rows)
+
+    def get_properties(self, directory):
+        """Flags and labels of a message stored in a segment, None if they were not archived"""
+        with self.lock:
+            self._flush()
+            row = self.connection.execute('SELECT properties FROM messages WHERE path = ?', (self.relpath(directory),)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def set_properties(self, directory, properties):
+        with self.lock:
+            self._flush()
+            with self.connection:
+                self.connection.execute('UPDATE messages SET properties = ? WHERE path = ?',
+                                        (json.dumps(properties), self.relpath(directory)))
+
+    def account_paths(self, account):
+        """Message folders archived from an account, read when iterated"""
+        with self.lock:
+            self._flush()
+            rows = self.connection.execute('SELECT path FROM messages WHERE account IS ?', (account,)).fetchall()
+        for row in rows:
+            yield os.path.join(self.root, row[0])
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def add_segment_message(self, store, key, directory):
+        """Index a message stored in a segment, its headers and text are read from the segment"""
+        try:
+            msg = message_from_bytes(store.read(key), headersonly=not self.fulltext)
+        except (OSError, EOFError, ValueError) as e:
+            print("Invalid segment entry %s: %s" % (directory, e))
+            self.add(directory, size=store.entries[key][3])
+            return
+        message_id = msg['Message-Id'] if msg['Message-Id'] and len(msg['Message-Id']) < 255 else None
+        name = os.path.basename(directory)
+        sha224 = name if not message_id and re.match(r'^[0-9a-f]{56}$', name) else None
+        self.add(directory, message_id=message_id, sha224=sha224, size=store.entries[key][3], date=utc_date(msg['Date']))
+        if self.fulltext:
+            try:
+                self.add_text(directory, Message(directory, msg).getMetadata())
+            except Exception as e:
+                print("Text of %s not indexed: %s" % (directory, e))
+
+    def rebuild(self):
+        """Index every message folder found in the archive tree, forget the missing ones"""
+        found = set()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if 'metadata.json' not in filenames and not has_raw(filenames):
+                continue
+            # A message folder, its attachments are not walked
+            dirnames[:] = []
+            message_id = None
+            date = None
+            size = None
+            gmail_id = None
+            if 'metadata.json' in filenames:
+                try:
+                    with open(os.path.join(dirpath, 'metadata.json'), encoding='utf8') as json_file:
+                        metadata = json.load(json_file)
+                    message_id = metadata.get('Id')
+                    date = metadata.get('Utc')
+                    gmail_id = metadata.get('GmailId')
+                    self.add_text(dirpath, metadata)
+                except ValueError:
+                    print("Invalid metadata file in %s" % dirpath)
+            if has_raw(filenames):
+                size = raw_size(raw_path(dirpath))
+            sha224 = None
+            name = os.path.basename(dirpath)
+            if re.match(r'^[0-9a-f]{56}$', name) and not (message_id and len(message_id) < 255):
+                sha224 = name
+            found.add(self.relpath(dirpath))
+            self.add(dirpath, message_id=message_id, sha224=sha224, size=size, date=date, gmail_id=gmail_id)
+
+        for store in find_stores(self.root):
+            for key in store.keys():
+                directory = os.path.join(store.local_folder, key)
+                if self.relpath(directory) not in found:
+                    found.add(self.relpath(directory))
+                    self.add_segment_message(store, key, directory)
+
+        self.flush()
+        with self.lock:
+            removed = self.paths - found
+            with self.connection:
+                self.connection.executemany('DELETE FROM messages WHERE path = ?', [(path,) for path in removed])
+                if self.fulltext:
+                    self.connection.executemany('DELETE FROM messages_text WHERE rowid IN (SELECT id FROM texts WHERE path = ?)',
+                                                [(path,) for path in removed])
+                    self.connection.executemany('DELETE FROM texts WHERE path = ?', [(path,) for path in removed])
+            self.paths = found
+            self.gmail_ids = set(row[0] for row in self.connection.execute('SELECT gmail_id FROM messages WHERE gmail_id IS NOT NULL'))
+        return len(found), len(removed)
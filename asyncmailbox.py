@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import asyncio
+import imaplib
+import re
+import time
+
+from metrics import metrics, Progress
+from segmentstore import get_segment_store
+from mailboxresource import MailboxClient, MAX_RETRIES, FETCH_BATCH_SIZE, FETCH_ITEMS, STRUCTURE_ITEMS, uid_set, parse_sizes
+from mailboxresource import check_esearch, is_gmail, get_part_policy, BROKEN_SESSION_ERRORS
+from bodystructure import fetch_items, fetch_attributes
+from sessionpool import SessionPool, HEALTH_CHECK_IDLE, ssl_context
+from uidset import UidSet
+
+# Maximum length of a response line, long SEARCH results come in a single line
+LINE_LIMIT = 64 * 1024 * 1024
+# Seconds without data from the server after which a connection is considered lost, like a socket timeout
+READ_TIMEOUT = 300
+
+Literal = re.compile(rb'\{(\d+)\}$')
+Untagged = re.compile(rb'^\* (?:(\d+) )?([A-Z-]+)(?: (.*))?$', re.S)
+Tagged = re.compile(rb'^(\S+) (OK|NO|BAD)(?: (.*))?$', re.S)
+ResponseCode = re.compile(rb'^\[(\S+) (\d+)\]')
+
+
+class ReadTimeout(imaplib.IMAP4.abort):
+    """No data received from the server in time, the connection is in an unknown state"""
+
+
+def quote(arg):
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class AsyncImapConnection:
+    """IMAP protocol on asyncio streams, responses have the same format as imaplib ones"""
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.tag_number = 0
+        # Tag of the command whose caller stopped reading its response
+        self.running = None
+
+    async def open(self, host, port, ssl):
+        # The same SSL context as the imaplib connections
+        context = ssl_context() if ssl else None
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=context, limit=LINE_LIMIT),
+                                                              READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise imaplib.IMAP4.abort('connection to %s timed out' % host)
+        await self.read_response()
+
+    async def read_response(self, timeout=None):
+        """Read a response line and its literals, literals are returned as (line, literal) tuples
+
+        Each read waits at most timeout seconds, READ_TIMEOUT by default, then
+        ReadTimeout is raised.
+        """
+        timeout = READ_TIMEOUT if timeout is None else timeout
+        parts = []
+        while True:
+            line = await self.read(self.reader.readline(), timeout)
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed by the server')
+            line = line.rstrip(b'\r\n')
+            match = Literal.search(line)
+            if not match:
+                parts.append(line)
+                return parts
+            parts.append((line, await self.read(self.reader.readexactly(int(match.group(1))), timeout)))
+
+    async def read(self, coroutine, timeout):
+        try:
+            return await asyncio.wait_for(coroutine, timeout)
+        except asyncio.TimeoutError:
+            raise ReadTimeout('no response from the server for %s seconds' % timeout)
+
+    async def finish(self):
+        """Read the rest of the response of a command left by its caller, before the next one is sent"""
+        tag, self.running = self.running, None
+        while tag is not None:
+            parts = await self.read_response()
+            head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+            if head.startswith(tag + b' '):
+                return
+
+    async def stream(self, *args):
+        """Send a command and yield (type, data) for each untagged response until it completes"""
+        await self.finish()
+        self.tag_number += 1
+        tag = b'A%d' % self.tag_number
+        self.writer.write(tag + b' ' + b' '.join(arg.encode() if isinstance(arg, str) else arg for arg in args) + b'\r\n')
+        await self.writer.drain()
+
+        self.running = tag
+        while True:
+            parts = await self.read_response()
+            head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+            if head.startswith(tag + b' '):
+                self.running = None
+                match = Tagged.match(head)
+                self.status = (match.group(2).decode(), [match.group(3)])
+                if self.status[0] == 'BAD':
+                    raise imaplib.IMAP4.error('%s command error: %s' % (args[0], self.status))
+                return
+            match = Untagged.match(head)
+            if not match:
+                # Continuation requests are not used by imapbox
+                continue
+            number, typ, data = match.groups()
+            data = data or b''
+            if number:
+                data = number + b' ' + data if typ != b'EXISTS' else number
+            if isinstance(parts[0], tuple):
+                parts[0] = (data, parts[0][1])
+            else:
+                parts[0] = data
+            yield typ.decode(), parts
+
+    async def command(self, *args):
+        """Send a command and return (status, untagged responses by type)"""
+        untagged = {}
+        async for typ, parts in self.stream(*args):
+            untagged.setdefault(typ, []).extend(parts)
+        return self.status[0], untagged
+
+    async def idle(self, timeout):
+        """Wait in IDLE (RFC 2177) for a new message or a flag change, at most timeout seconds, return True if one came"""
+        await self.finish()
+        self.tag_number += 1
+        tag = b'A%d' % self.tag_number
+        self.writer.write(tag + b' IDLE\r\n')
+        await self.writer.drain()
+        parts = await self.read_response()
+        if not parts[0].startswith(b'+'):
+            raise imaplib.IMAP4.error('IDLE refused: %s' % parts[0])
+
+        changed = False
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not changed:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                parts = await self.read_response(remaining)
+            except ReadTimeout:
+                break
+            head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+            match = Untagged.match(head)
+            # Expunged messages stay in the archive, they are not a change
+            changed = match is not None and match.group(2) in (b'EXISTS', b'FETCH')
+
+        self.writer.write(b'DONE\r\n')
+        await self.writer.drain()
+        while True:
+            parts = await self.read_response()
+            head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+            if head.startswith(tag + b' '):
+                match = Tagged.match(head)
+                if match is None or match.group(2) != b'OK':
+                    raise imaplib.IMAP4.error('IDLE failed: %s' % head)
+                return changed
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def logout(self):
+        """Close the connection without a LOGOUT command, called by the SessionPool for the sessions it drops"""
+        self.close()
+
+
+class AsyncSessionPool(SessionPool):
+    """SessionPool of AsyncImapConnections, acquire() and release() are coroutines
+
+    The connections count against the same HostLimit as the imaplib ones. The
+    tasks waiting for a connection wait on an asyncio.Condition shared by the
+    pools of the host, the pools are used in a single event loop.
+    """
+
+    def __init__(self, account, size=1, host=None):
+        super().__init__(account, size, host)
+        if self.host.available is None:
+            self.host.available = asyncio.Condition()
+        self.available = self.host.available
+        # Tasks waking up the waiting ones, referenced until they are done
+        self.waking = set()
+
+    async def connect(self):
+        connection = AsyncImapConnection()
+        await connection.open(self.account['host'], self.account['port'], self.account['ssl'])
+        typ, untagged = await connection.command('LOGIN', quote(self.account['username']), quote(self.account['password']))
+        if typ != 'OK':
+            connection.close()
+            raise imaplib.IMAP4.error('LOGIN failed: %s' % connection.status[1])
+        return connection
+
+    async def acquire(self):
+        while True:
+            async with self.available:
+                while True:
+                    with self.condition:
+                        reserved = self.reserve()
+                    if reserved is not None:
+                        break
+                    await self.available.wait()
+            connection, released, stale = reserved
+
+            if stale is not None:
+                stale.logout()
+            if connection is None:
+                break
+            if time.time() - released < HEALTH_CHECK_IDLE:
+                return connection
+            try:
+                await connection.command('NOOP')
+                return connection
+            except Exception:
+                # Dropped by the server, a new one is opened
+                self.discard(connection)
+
+        try:
+            return await self.connect()
+        except BaseException:
+            self.opening_failed()
+            raise
+
+    async def release(self, connection):
+        """Give back a session with a folder selected, it is closed first"""
+        try:
+            await connection.command('CLOSE')
+        except Exception:
+            self.discard(connection)
+            return
+        with self.condition:
+            self.idle.append((connection, time.time()))
+            self.notify()
+
+    def notify(self):
+        super().notify()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Closed out of the event loop, no task is waiting
+            return
+        # Sessions are discarded out of coroutines too, the tasks are woken up by a new one
+        task = asyncio.ensure_future(self.wake())
+        self.waking.add(task)
+        task.add_done_callback(self.waking.discard)
+
+    async def wake(self):
+        async with self.available:
+            self.available.notify_all()
+
+    async def close_async(self):
+        """Log out the idle sessions, in the event loop they were opened in"""
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+        for connection, released in idle:
+            try:
+                await connection.command('LOGOUT')
+            except Exception:
+                pass
+            self.discard(connection)
+
+
+class AsyncMailboxClient(MailboxClient):
+    """MailboxClient using asyncio instead of imaplib
+
+    The network operations are coroutines, so one process can drive many
+    mailboxes at the same time. Saving the messages runs in a thread.
+    """
+
+    def __init__(self, host, port, username, password, remote_folder, ssl, name=None, index=None, pipeline=None, renderer=None,
+                 export=None, gmail=False, pool=None):
+        self.init_state(host, port, username, password, remote_folder, ssl, name, index, pool, pipeline, renderer, export, gmail)
+
+    async def connect(self):
+        if self.pool is not None:
+            # Reconnecting: the current session is broken
+            if self.mailbox is not None:
+                self.pool.discard(self.mailbox)
+                self.mailbox = None
+            self.mailbox = await self.pool.acquire()
+        else:
+            if self.mailbox is not None:
+                self.mailbox.close()
+            self.mailbox = AsyncImapConnection()
+            await self.mailbox.open(self.host, self.port, self.ssl)
+            typ, untagged = await self.mailbox.command('LOGIN', quote(self.username), quote(self.password))
+            if typ != 'OK':
+                raise imaplib.IMAP4.error('LOGIN failed: %s' % self.mailbox.status[1])
+        if self.capabilities is None:
+            typ, untagged = await self.mailbox.command('CAPABILITY')
+            self.capabilities = set(b' '.join(untagged.get('CAPABILITY', [])).decode().upper().split())
+
+    async def connect_to_imap(self):
+        retries = 0
+        while retries < MAX_RETRIES:
+            try:
+                await self.connect()
+                await self.select_folder()
+                return
+            except (ConnectionError, imaplib.IMAP4.abort) as e:
+                print(f"Connection error: {e}. Will retry...")
+                retries += 1
+        raise imaplib.IMAP4.abort("Maximum retries reached")
+
+    async def select_folder(self):
+        """EXAMINE the folder, again to get its current UIDNEXT on a session kept open"""
+        typ, untagged = await self.mailbox.command('EXAMINE', self.remote_folder)
+        if typ != 'OK':
+            # Handle case where Exchange/Outlook uses '.' path separator when
+            # reporting subfolders. Adjust to use '/' on remote.
+            adjust_remote_folder = re.sub(r'\.', '/', self.remote_folder)
+            typ, untagged = await self.mailbox.command('EXAMINE', adjust_remote_folder)
+            if typ != 'OK':
+                print("MailboxClient: Could not select remote folder '%s'" % self.remote_folder)
+        self.message_count = int(untagged['EXISTS'][-1]) if typ == 'OK' and 'EXISTS' in untagged else 0
+        codes = dict(match.groups() for match in map(ResponseCode.match, untagged.get('OK', [])) if match)
+        self.uidvalidity = int(codes[b'UIDVALIDITY']) if b'UIDVALIDITY' in codes else None
+        self.uidnext = int(codes[b'UIDNEXT']) if b'UIDNEXT' in codes else None
+        self.highestmodseq = int(codes[b'HIGHESTMODSEQ']) if b'HIGHESTMODSEQ' in codes else None
+
+    async def list_folders(self):
+        typ, untagged = await self.mailbox.command('LIST', '""', '"*"')
+        return untagged.get('LIST', [])
+
+    async def search_emails(self, criterion, batch_size=5000):
+        if 'ESEARCH' in self.capabilities:
+            typ, untagged = await self.mailbox.command('UID', 'SEARCH', 'RETURN (ALL COUNT)', criterion)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"Error on searching emails: {self.mailbox.status[1]}")
+            return check_esearch(b' '.join(untagged.get('ESEARCH', [])))
+
+        all_uids = UidSet()
+        last_num = 0
+
+        while batch_size is None or last_num < self.message_count:
+            args = [criterion] if batch_size is None else [criterion, f'{last_num+1}:{last_num + batch_size}']
+            typ, untagged = await self.mailbox.command('UID', 'SEARCH', *args)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"Error on searching emails: {self.mailbox.status[1]}")
+            for data in untagged.get('SEARCH', []):
+                all_uids = all_uids.union(data.split())
+
+            if batch_size is None:
+                break
+            last_num = last_num + batch_size
+
+        return all_uids
+
+    async def search_new_emails(self, criterion, incremental):
+        last_uid = self.get_last_uid(incremental)
+        if last_uid is None:
+            return await self.search_emails(criterion), 0
+
+        if self.uidnext is not None and self.uidnext <= last_uid + 1:
+            return UidSet(), last_uid
+
+        uids = await self.search_emails(self.incremental_criterion(criterion, last_uid), None)
+        return uids.after(last_uid), last_uid
+
+    async def fetch_sizes(self, uids, batch_size=5000):
+        sizes = {}
+        for start in range(0, len(uids), batch_size):
+            typ, untagged = await self.mailbox.command('UID', 'FETCH', uid_set(uids[start:start + batch_size]), '(RFC822.SIZE)')
+            sizes.update(parse_sizes(untagged.get('FETCH', [])))
+        return sizes
+
+    async def fetch_stream(self, uids, items=FETCH_ITEMS, phase='fetch'):
+        wanted = UidSet(uids)
+        started = time.perf_counter()
+        async for typ, parts in self.mailbox.stream('UID', 'FETCH', uid_set(uids), items):
+            if typ != 'FETCH':
+                continue
+            attributes = b' '.join(part[0] if isinstance(part, tuple) else part for part in parts)
+            match = re.search(rb'UID (\d+)', attributes)
+            if match and match.group(1) in wanted:
+                metrics.observe(phase, time.perf_counter() - started)
+                yield match.group(1), parts
+                started = time.perf_counter()
+        if self.mailbox.status[0] != 'OK':
+            raise imaplib.IMAP4.error(f"Error on fetching emails: {self.mailbox.status[1]}")
+
+    async def fetch_messages(self, uids, part_policy=None):
+        """Yield (uid, data) for each message, without the parts refused by part_policy, like MailboxClient.fetch_messages()"""
+        partial = {}
+        if part_policy is not None:
+            async for uid, data in self.fetch_stream(uids, self.fetch_items.replace('BODY.PEEK[]', STRUCTURE_ITEMS), 'bodystructure'):
+                self.structureResponse(uid, data, part_policy, partial)
+
+        complete = [uid for uid in uids if uid not in partial]
+        if complete:
+            async for uid, data in self.fetch_stream(complete, self.fetch_items):
+                yield uid, data
+        for uid, (structure, skipped, response) in partial.items():
+            self.partial_uids.add(uid)
+            yield uid, await self.fetch_selective(uid, structure, skipped) + response
+
+    async def fetch_selective(self, uid, structure, skipped):
+        attributes = {}
+        async for _, data in self.fetch_stream([uid], '(%s)' % ' '.join(fetch_items(structure, skipped))):
+            attributes = fetch_attributes(data)
+        return self.selectiveResponse(uid, structure, skipped, attributes)
+
+    async def sync_flags(self, incremental, last_uid):
+        items = self.flag_sync_items(incremental, last_uid)
+        if items is None:
+            return 0
+        with metrics.timer('flags'):
+            typ, untagged = await self.mailbox.command('UID', 'FETCH', *items)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"Error on fetching flags: {self.mailbox.status[1]}")
+            return await asyncio.to_thread(self.saveProperties, untagged.get('FETCH', []))
+
+    async def prescan_emails(self, uids, batch_size=5000):
+        missing = []
+        sizes = {}
+        for start in range(0, len(uids), batch_size):
+            async for uid, data in self.fetch_stream(uids[start:start + batch_size], self.prescan_items, 'prescan'):
+                self.prescanResponse(uid, data, missing, sizes)
+        return missing, sizes
+
+    async def copy_emails(self, days, local_folder, batch_size=FETCH_BATCH_SIZE, batch_bytes=None, prescan=True,
+                          incremental=True, part_policy=None, attachment_store=None, storage='folders', raw_codec=None):
+
+        n_saved = 0
+        n_exists = 0
+        failed = []
+
+        self.local_folder = local_folder
+        self.attachment_store = attachment_store
+        self.raw_codec = raw_codec
+        self.segments = get_segment_store(local_folder) if storage == 'segments' else None
+
+        with metrics.timer('search'):
+            uids, last_uid = await self.search_new_emails(self.search_criterion(days), incremental)
+        synced_uid = last_uid
+        last_uid = self.searched_uid(last_uid, uids)
+
+        sizes = None
+        if uids and prescan:
+            try:
+                missing, sizes = await self.prescan_emails(uids)
+                n_exists += len(uids) - len(missing)
+                uids = missing
+            except (ConnectionError, imaplib.IMAP4.abort) as e:
+                print(f"Connection error while scanning headers: {e}. Fetching all emails...")
+                await self.connect_to_imap()
+        if uids and batch_bytes and sizes is None:
+            sizes = await self.fetch_sizes(uids)
+
+        if uids:
+            print("Copying emails...")
+        progress = Progress(len(uids))
+        idx = 0
+        for batch in self.fetch_batches(uids, batch_size, batch_bytes, sizes or {}):
+            pending = list(batch)
+            fetch_retries = 0
+            # After an error in a batch, its remaining messages are fetched one by one
+            single = False
+            while pending and fetch_retries < MAX_RETRIES:
+                fetching = pending[:1] if single else pending
+                try:
+                    async for uid, data in self.fetch_messages(fetching, part_policy):
+                        idx += 1
+                        pending.remove(uid)
+                        try:
+                            if await asyncio.to_thread(self.saveEmail, data):
+                                n_saved += 1
+                            else:
+                                n_exists += 1
+                        except Exception as e:
+                            print(f"Error while saving email: {e}. Skipping...")
+                            failed.append(uid)
+                        progress.update(idx)
+                    if not single:
+                        break
+                    # Not returned by the server, expunged since the search
+                    if fetching[0] in pending:
+                        pending.remove(fetching[0])
+                except (ConnectionError, imaplib.IMAP4.abort) as e:
+                    print(f"Connection error while fetching email: {e}. Retrying...")
+                    await self.connect_to_imap()
+                    fetch_retries += 1
+                except Exception as e:
+                    if single and fetching[0] in pending:
+                        print(f"Error while fetching email {fetching[0].decode()}: {e}. Skipping...")
+                        pending.remove(fetching[0])
+                        failed.append(fetching[0])
+                    else:
+                        print(f"Error while fetching emails: {e}. Fetching them one by one...")
+                    single = True
+                    await self.connect_to_imap()
+            if fetch_retries == MAX_RETRIES:
+                raise imaplib.IMAP4.abort("Maximum retries reached")
+        progress.finish()
+        if uids:
+            print("Done.")
+        try:
+            n_flags = await self.sync_flags(incremental, synced_uid)
+            if n_flags:
+                print("{} emails with new flags".format(n_flags))
+        except (ConnectionError, imaplib.IMAP4.error) as e:
+            print(f"Error while synchronizing flags: {e}. They are all fetched on the next run...")
+            self.highestmodseq = None
+        await asyncio.to_thread(self.save_sync_state, incremental, last_uid, failed)
+        metrics.count('emails_saved', n_saved)
+        metrics.count('emails_existing', n_exists)
+        metrics.count('emails_failed', len(failed))
+        return (n_saved, n_exists)
+
+    async def cleanup(self, broken=False):
+        """Give the session back to the pool or log out, a broken session is closed without a command"""
+        mailbox, self.mailbox = self.mailbox, None
+        if mailbox is None:
+            return
+        if self.pool is not None:
+            if broken:
+                self.pool.discard(mailbox)
+            else:
+                await self.pool.release(mailbox)
+            return
+        if broken:
+            mailbox.close()
+            return
+        try:
+            await mailbox.command('CLOSE')
+            await mailbox.command('LOGOUT')
+        finally:
+            mailbox.close()
+
+
+async def save_emails_async(account, options, index=None, pipeline=None, renderer=None, export=None, pool=None):
+    metrics.labels.set((account.get('name'), account['remote_folder']))
+    mailbox = AsyncMailboxClient(account['host'], account['port'], account['username'], account['password'], account['remote_folder'], account['ssl'],
+                                 account.get('name'), index, pipeline, renderer, export, is_gmail(account), pool)
+    try:
+        await mailbox.connect_to_imap()
+        stats = await mailbox.copy_emails(options['days'], options['local_folder'],
+                                          options['fetch_batch_size'], options['fetch_batch_bytes'], options['prescan'],
+                                          options['incremental'], get_part_policy(options), options['attachment_store'], options['storage'],
+                                          options.get('raw_codec'))
+    except BROKEN_SESSION_ERRORS + (asyncio.CancelledError,):
+        await mailbox.cleanup(broken=True)
+        raise
+    except BaseException:
+        # An error reported by the server, the session can be used again
+        await mailbox.cleanup()
+        raise
+    await mailbox.cleanup()
+    if stats[0] == 0 and stats[1] == 0:
+        print('No new emails in folder {}'.format(account['remote_folder']))
+    else:
+        print('{} emails created, {} emails already exists'.format(stats[0], stats[1]))
+
+
+async def close_pools(pools):
+    for pool in pools:
+        await pool.close_async()
+
+
+async def get_folder_list_async(account):
+    mailbox = AsyncMailboxClient(account['host'], account['port'], account['username'], account['password'], None, account['ssl'])
+    await mailbox.connect()
+    try:
+        return await mailbox.list_folders()
+    finally:
+        await mailbox.mailbox.command('LOGOUT')
+        mailbox.mailbox.close()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Folder of the store, at the root of local_folder
+STORE_DIRNAME = '.attachments'
+
+_stores = {}
+
+
+class AttachmentStore:
+    """Attachment payloads stored once, by SHA-256, and hardlinked in the message folders
+
+    The hashes already in the store are kept in memory, a repeated payload is
+    then linked without checking the store folder nor writing it again. Where
+    hardlinks are not supported the blob is copied.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.known = set()
+
+    def blobpath(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def contains(self, digest):
+        if digest in self.known:
+            return True
+        if os.path.exists(self.blobpath(digest)):
+            self.known.add(digest)
+            return True
+        return False
+
+    def save(self, payload, path):
+        """Write payload at path through the store, return False if the payload was already stored"""
+        digest = hashlib.sha256(payload).hexdigest()
+        blob = self.blobpath(digest)
+        created = not self.contains(digest)
+        if created:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # Written aside and renamed, so a concurrent process never links a partial blob
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(blob))
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(payload)
+            os.replace(tmp, blob)
+            self.known.add(digest)
+
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(blob, path)
+        except OSError:
+            shutil.copyfile(blob, path)
+        return created
+
+
+def get_store(root):
+    """The store of a folder, shared by the messages processed in this process"""
+    if not root:
+        return None
+    if root not in _stores:
+        _stores[root] = AttachmentStore(root)
+    return _stores[root]
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""Measure the archiving throughput against a generated mailbox
+
+The mailbox is served by the in-process test server of imapserver.py and
+archived with save_emails() into a temporary folder, for example:
+
+    python benchmark.py -c 2000 -s 20000 --attachments 0.2 --latency 0.01
+"""
+
+import argparse
+import base64
+import functools
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import mailboxresource
+from archiveindex import ArchiveIndex
+from imapbox import default_options
+from imapserver import ImapServer, Folder
+from message import Message
+from pipeline import MessagePipeline
+
+WORDS = {
+    'utf-8': ['lorem', 'ipsum', 'dolor', 'café', 'naïve', 'Grüße', 'Ελληνικά', 'русский', '日本語', '☃'],
+    'iso-8859-1': ['lorem', 'ipsum', 'dolor', 'café', 'naïve', 'Grüße', 'señor', 'façade', 'garçon', 'élève'],
+    'none': ['lorem', 'ipsum', 'dolor', 'café', 'naïve', 'Grüße', 'señor', 'façade', 'garçon', 'élève'],
+}
+
+
+def generate_text(rng, charset, size):
+    words = WORDS[charset]
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(rng.choice(words) for i in range(10))
+        lines.append(line)
+        length += len(line) + 2
+    return '\r\n'.join(lines)
+
+
+def generate_message(rng, number, body_size, charset, attachment_size=0):
+    """A message with a text body in charset, 'none' is latin-1 without declared charset, and an optional attachment"""
+    boundary = 'benchmark-%d' % number
+    encoding = 'iso-8859-1' if charset == 'none' else charset
+    content_type = 'text/plain' if charset == 'none' else 'text/plain; charset=%s' % charset
+    body = generate_text(rng, charset, body_size).encode(encoding)
+    headers = ('Message-Id: <%d@benchmark.test>\r\n'
+               'Date: %s\r\n'
+               'From: Sender %d <sender%d@benchmark.test>\r\n'
+               'To: Recipient <recipient@benchmark.test>\r\n'
+               'Subject: Message %d\r\n'
+               'MIME-Version: 1.0\r\n' % (number, time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(1704067200 + number * 600)),
+                                          number % 50, number % 50, number)).encode()
+    if not attachment_size:
+        return headers + ('Content-Type: %s\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' % content_type).encode() + body
+
+    attachment = rng.getrandbits(attachment_size * 8).to_bytes(attachment_size, 'little')
+    encoded = base64.encodebytes(attachment).replace(b'\n', b'\r\n')
+    return (headers
+            + ('Content-Type: multipart/mixed; boundary="%s"\r\n\r\n--%s\r\n' % (boundary, boundary)).encode()
+            + ('Content-Type: %s\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' % content_type).encode() + body
+            + ('\r\n--%s\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n'
+               'Content-Disposition: attachment; filename="file-%d.bin"\r\n\r\n' % (boundary, number)).encode()
+            + encoded + ('--%s--\r\n' % boundary).encode())
+
+
+def generate_mailbox(count, size=2000, distribution='fixed', attachments=0.0, attachment_size=100000,
+                     charsets=('utf-8',), seed=0):
+    """Generated messages, body sizes are either fixed or lognormal with size as median"""
+    rng = random.Random(seed)
+    messages = []
+    for number in range(1, count + 1):
+        body_size = size if distribution == 'fixed' else max(100, int(rng.lognormvariate(0, 1) * size))
+        with_attachment = rng.random() < attachments
+        messages.append(generate_message(rng, number, body_size, rng.choice(charsets), attachment_size if with_attachment else 0))
+    return messages
+
+
+class PhaseTimer:
+    """Time spent in some functions during the benchmark, they are wrapped until restore()
+
+    Phases are exclusive, the time of a phase called from another one, like a
+    fetch during the prescan, is only counted in the inner phase.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.patched = []
+        self.stack = []
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if self.stack:
+            outer, start = self.stack[-1]
+            self.phases[outer] += now - start
+        self.stack.append([phase, now])
+
+    def leave(self):
+        now = time.perf_counter()
+        phase, start = self.stack.pop()
+        self.phases[phase] += now - start
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def wrap(self, owner, name, phase):
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.leave()
+
+        self.phases.setdefault(phase, 0)
+        self.patched.append((owner, name, original))
+        setattr(owner, name, timed)
+
+    def wrap_generator(self, owner, name, phase):
+        """Only the time spent producing the items is counted, not the time of the consumer"""
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            iterator = original(*args, **kwargs)
+            while True:
+                self.enter(phase)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.leave()
+                yield item
+
+        self.phases.setdefault(phase, 0)
+        self.patched.append((owner, name, original))
+        setattr(owner, name, timed)
+
+    def restore(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+
+def peak_rss():
+    """Peak resident memory of this process and of its finished children, in bytes"""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def run(messages, latency=0, local_folder=None, **options):
+    """Archive messages served by a local server, return the report as a dict"""
+    server = ImapServer({'INBOX': Folder(enumerate(messages, 1))}, latency=latency).start()
+    keep = local_folder is not None
+    local_folder = local_folder or tempfile.mkdtemp(prefix='imapbox-benchmark-')
+    options = dict(default_options(), local_folder=os.path.join(local_folder, 'INBOX'), **options)
+    account = {'name': 'benchmark', 'host': '127.0.0.1', 'port': server.port, 'username': 'benchmark',
+               'password': 'benchmark', 'ssl': False, 'remote_folder': 'INBOX'}
+
+    timer = PhaseTimer()
+    timer.wrap(mailboxresource.MailboxClient, 'connect_to_imap', 'connect')
+    timer.wrap(mailboxresource.MailboxClient, 'search_new_emails', 'search')
+    timer.wrap(mailboxresource.MailboxClient, 'prescan_emails', 'prescan')
+    timer.wrap_generator(mailboxresource.MailboxClient, 'fetch_stream', 'fetch')
+    timer.wrap(mailboxresource, 'message_from_bytes', 'parse')
+    timer.wrap(Message, 'createRawFile', 'raw')
+    timer.wrap(Message, 'createMetaFile', 'metadata')
+    timer.wrap(Message, 'extractAttachments', 'attachments')
+
+    index = ArchiveIndex(local_folder, fulltext=options['fulltext']) if options['index'] else None
+    pipeline = MessagePipeline(options['processes']) if options['processes'] else None
+    start = time.perf_counter()
+    try:
+        mailboxresource.save_emails(account, options, index, pipeline=pipeline)
+        if pipeline is not None:
+            pipeline.close()
+        if index is not None:
+            index.close()
+    finally:
+        elapsed = time.perf_counter() - start
+        timer.restore()
+        server.stop()
+        if not keep:
+            shutil.rmtree(local_folder, ignore_errors=True)
+
+    size = sum(len(message) for message in messages)
+    phases = OrderedDict(timer.phases)
+    # Progress output, index updates, waiting for the processes
+    phases['other'] = max(0, elapsed - sum(timer.phases.values()))
+    rss, children_rss = peak_rss()
+    return OrderedDict([
+        ('messages', len(messages)),
+        ('bytes', size),
+        ('seconds', round(elapsed, 3)),
+        ('messages_per_second', round(len(messages) / elapsed, 1)),
+        ('mb_per_second', round(size / elapsed / 1e6, 2)),
+        ('peak_rss_mb', round(rss / 1e6, 1)),
+        ('peak_children_rss_mb', round(children_rss / 1e6, 1)),
+        ('phases', OrderedDict((phase, round(seconds, 3)) for phase, seconds in phases.items())),
+    ])
+
+
+def print_report(report):
+    print('{messages} messages, {mb:.1f} MB in {seconds:.2f} s'.format(mb=report['bytes'] / 1e6, **report))
+    print('{messages_per_second} messages/s, {mb_per_second} MB/s'.format(**report))
+    print('Peak RSS: {peak_rss_mb} MB, processes: {peak_children_rss_mb} MB'.format(**report))
+    print('Phases:')
+    for phase, seconds in report['phases'].items():
+        print('  {:<12} {:>8.3f} s {:>5.1f}%'.format(phase, seconds, seconds * 100 / report['seconds']))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Measure the archiving throughput against a generated mailbox")
+    argparser.add_argument('-c', dest='count', help="Number of messages", type=int, default=1000)
+    argparser.add_argument('-s', dest='size', help="Body size of the messages, the median with a lognormal distribution", type=int, default=2000)
+    argparser.add_argument('--distribution', help="Distribution of the body sizes", choices=('fixed', 'lognormal'), default='fixed')
+    argparser.add_argument('--attachments', help="Share of the messages with an attachment, from 0 to 1", type=float, default=0)
+    argparser.add_argument('--attachment-size', dest='attachment_size', help="Size of the attachments", type=int, default=100000)
+    argparser.add_argument('--charsets', help="Comma separated charsets of the bodies, none for undeclared latin-1",
+                           default='utf-8')
+    argparser.add_argument('--latency', help="Delay in seconds before each server response", type=float, default=0)
+    argparser.add_argument('--seed', help="Seed of the generated mailbox", type=int, default=0)
+    argparser.add_argument('--batch-size', dest='fetch_batch_size', help="fetch_batch_size option", type=int, default=50)
+    argparser.add_argument('--processes', help="processes option", type=int, default=0)
+    argparser.add_argument('--no-prescan', dest='prescan', help="Disable the prescan option", action='store_false')
+    argparser.add_argument('--no-index', dest='index', help="Disable the index option", action='store_false')
+    argparser.add_argument('-l', dest='local_folder', help="Keep the archive in this folder instead of a temporary one")
+    argparser.add_argument('--json', help="Also write the report to this JSON file")
+    args = argparser.parse_args()
+
+    charsets = [charset.strip() for charset in args.charsets.split(',')]
+    for charset in charsets:
+        if charset not in WORDS:
+            argparser.error('unsupported charset {}, use one of {}'.format(charset, ', '.join(WORDS)))
+
+    messages = generate_mailbox(args.count, args.size, args.distribution, args.attachments, args.attachment_size,
+                                charsets, args.seed)
+    report = run(messages, args.latency, args.local_folder, fetch_batch_size=args.fetch_batch_size,
+                 processes=args.processes, prescan=args.prescan, index=args.index)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
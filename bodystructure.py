@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import fnmatch
+import re
+
+# Header added to the parts which were not downloaded
+SKIPPED_HEADER = 'X-Imapbox-Skipped'
+
+# An atom keeps its section, like BODY[HEADER.FIELDS (MESSAGE-ID)]
+Token = re.compile(rb'\s*(?:(\()|(\))|"((?:\\.|[^"\\])*)"|\{(\d+)\}$|((?:[^\s()"\[]|\[[^\]]*\])+))')
+
+
+def parse_response(data):
+    """Parse a FETCH response from imaplib into nested lists, strings are bytes and NIL is None"""
+    stack = [[]]
+    for part in data:
+        text, literal = part if isinstance(part, tuple) else (part, None)
+        position = 0
+        while True:
+            match = Token.match(text, position)
+            if not match or match.end() == position:
+                break
+            position = match.end()
+            opening, closing, quoted, literal_size, atom = match.groups()
+            if opening:
+                stack.append([])
+            elif closing:
+                inner = stack.pop()
+                stack[-1].append(inner)
+            elif quoted is not None:
+                stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted))
+            elif literal_size is not None:
+                stack[-1].append(literal)
+            else:
+                stack[-1].append(None if atom.upper() == b'NIL' else atom)
+    return stack[0]
+
+
+def fetch_attributes(data):
+    """Attributes of a FETCH response as a dict, like {b'UID': b'12', b'BODY[1]': b'...'}"""
+    attributes = {}
+    for response in parse_response(data):
+        if isinstance(response, list):
+            for i in range(0, len(response) - 1, 2):
+                attributes[response[i].upper()] = response[i + 1]
+    return attributes
+
+
+def decode(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+
+def parameters(value):
+    """(key value key value) parameter list as a dict with lowercase keys"""
+    if not isinstance(value, list):
+        return {}
+    return dict((decode(value[i]).lower(), decode(value[i + 1])) for i in range(0, len(value) - 1, 2))
+
+
+class BodyPart:
+    """A node of a BODYSTRUCTURE, section is the part specifier used with BODY[...]"""
+
+    def __init__(self, section, maintype, subtype, params=None, encoding=None, size=0,
+                 disposition=None, disposition_params=None, children=None):
+        self.section = section
+        self.maintype = maintype
+        self.subtype = subtype
+        self.params = params or {}
+        self.encoding = encoding
+        self.size = size
+        self.disposition = disposition
+        self.disposition_params = disposition_params or {}
+        self.children = children or []
+
+    @property
+    def content_type(self):
+        return '%s/%s' % (self.maintype, self.subtype)
+
+    @property
+    def filename(self):
+        return self.disposition_params.get('filename') or self.params.get('name')
+
+    def is_multipart(self):
+        return self.maintype == 'multipart'
+
+    def is_body_text(self):
+        return self.content_type in ('text/plain', 'text/html') and not self.filename and self.disposition != 'attachment'
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            for part in child.walk():
+                yield part
+
+
+def parse_bodystructure(node, section=''):
+    if isinstance(node[0], list):
+        children = []
+        while len(children) < len(node) and isinstance(node[len(children)], list):
+            number = str(len(children) + 1)
+            children.append(parse_bodystructure(node[len(children)], section + '.' + number if section else number))
+        extension = node[len(children) + 1:]
+        disposition = extension[1] if len(extension) > 1 and isinstance(extension[1], list) else None
+        return BodyPart(section, 'multipart', decode(node[len(children)]).lower(),
+                        parameters(extension[0] if extension else None),
+                        disposition=decode(disposition[0]).lower() if disposition else None,
+                        disposition_params=parameters(disposition[1]) if disposition else None,
+                        children=children)
+
+    maintype, subtype = decode(node[0]).lower(), decode(node[1]).lower()
+    extension = 7
+    if maintype == 'text':
+        extension += 1
+    elif (maintype, subtype) == ('message', 'rfc822'):
+        extension += 3
+    disposition = node[extension + 1] if len(node) > extension + 1 and isinstance(node[extension + 1], list) else None
+    return BodyPart(section or '1', maintype, subtype, parameters(node[2]),
+                    decode(node[5]).lower() if node[5] else None, int(node[6] or 0),
+                    disposition=decode(disposition[0]).lower() if disposition else None,
+                    disposition_params=parameters(disposition[1]) if disposition else None)
+
+
+class PartPolicy:
+    """Which attachments are downloaded, the text and html bodies always are
+
+    max_size is in bytes, as reported by the server for the encoded part. types
+    and excluded_types are lists of MIME types which can contain wildcards,
+    like image/*.
+    """
+
+    def __init__(self, max_size=None, types=None, excluded_types=None):
+        self.max_size = max_size
+        self.types = types or []
+        self.excluded_types = excluded_types or []
+
+    def accepts(self, part):
+        if part.is_body_text():
+            return True
+        if self.max_size is not None and part.size > self.max_size:
+            return False
+        if self.types and not any(fnmatch.fnmatch(part.content_type, pattern) for pattern in self.types):
+            return False
+        return not any(fnmatch.fnmatch(part.content_type, pattern) for pattern in self.excluded_types)
+
+    def skipped(self, structure):
+        """Leaf parts which should not be downloaded, the body of a single part message is its only part"""
+        return [part for part in structure.walk() if not part.is_multipart() and not self.accepts(part)]
+
+
+def fetch_items(structure, skipped):
+    """FETCH items needed to rebuild the message without the skipped parts"""
+    items = ['BODY.PEEK[HEADER]']
+    skipped_sections = set(part.section for part in skipped)
+    for part in structure.walk():
+        if part is structure:
+            continue
+        items.append('BODY.PEEK[%s.MIME]' % part.section)
+        if not part.is_multipart() and part.section not in skipped_sections:
+            items.append('BODY.PEEK[%s]' % part.section)
+    return items
+
+
+def stub_header(part, source):
+    """Header of a skipped part, with what is needed to download it later"""
+    values = dict(source, section=part.section, size=part.size)
+    return '%s: skipped; %s\r\n' % (SKIPPED_HEADER, '; '.join('%s="%s"' % (key, str(value).replace('"', ''))
+                                                             for key, value in sorted(values.items())))
+
+
+def build_message(structure, attributes, skipped, source):
+    """Rebuild a raw message from its downloaded sections, skipped parts only keep their headers"""
+    skipped_sections = set(part.section for part in skipped)
+
+    def body(part):
+        if not part.is_multipart():
+            return attributes.get(('BODY[%s]' % part.section).encode()) or b''
+        boundary = part.params.get('boundary', '').encode()
+        out = []
+        for child in part.children:
+            headers = attributes.get(('BODY[%s.MIME]' % child.section).encode()) or b''
+            if child.section in skipped_sections:
+                headers = headers.rstrip(b'\r\n')
+                headers = (headers + b'\r\n' if headers else b'') + stub_header(child, source).encode()
+            headers = headers.rstrip(b'\r\n') + b'\r\n\r\n' if headers.strip() else b'\r\n'
+            out.append(b'--' + boundary + b'\r\n' + headers + body(child) + b'\r\n')
+        out.append(b'--' + boundary + b'--\r\n')
+        return b''.join(out)
+
+    header = attributes.get(b'BODY[HEADER]') or b'\r\n'
+    if structure.section in skipped_sections and not structure.is_multipart():
+        # The skipped body is the whole message, its header is the message header
+        return header.rstrip(b'\r\n') + b'\r\n' + stub_header(structure, source).encode() + b'\r\n'
+    return header + body(structure)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import io
+import json
+import os
+import re
+import threading
+import urllib.request
+
+EXPORT_PREFIX = 'imapbox-'
+EXPORT_SUFFIX = '.ndjson'
+CHECKPOINT_FILENAME = 'checkpoint.json'
+# Size after which a new export file is started
+EXPORT_MAX_BYTES = 64 * 1024 * 1024
+# Maximum size of a _bulk request when replaying
+REPLAY_MAX_BYTES = 5 * 1024 * 1024
+
+
+def export_files(folder):
+    """Export files of a folder, oldest first"""
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder)
+                  if name.startswith(EXPORT_PREFIX) and name.endswith(EXPORT_SUFFIX))
+
+
+class BulkExport:
+    """Append the metadata of the archived messages to NDJSON files in the Elasticsearch _bulk format
+
+    Each message is an index action line followed by its metadata.json
+    document, its id is the message folder relative to the archive root. A new
+    file is started when the current one is larger than max_bytes, a consumer
+    remembers how far it went in the checkpoint file, see replay(). Each line
+    is flushed when it is written, sync() makes them durable.
+    """
+
+    def __init__(self, folder, root, index_name='imapbox', max_bytes=EXPORT_MAX_BYTES):
+        self.folder = folder
+        self.root = root
+        self.index_name = index_name
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.file = None
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        files = export_files(folder)
+        if files:
+            self.open(files[-1])
+            self.truncate()
+        else:
+            self.open(EXPORT_PREFIX + '000001' + EXPORT_SUFFIX)
+
+    def open(self, name):
+        self.name = name
+        self.file = open(os.path.join(self.folder, name), 'ab')
+
+    def truncate(self):
+        """Drop the end of a line left by an interrupted run, so the file only has complete lines"""
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        with open(os.path.join(self.folder, self.name), 'rb') as f:
+            f.seek(max(0, size - 1024 * 1024))
+            tail = f.read()
+        end = tail.rfind(b'\n') + 1
+        if end != len(tail):
+            self.file.truncate(size - len(tail) + end)
+
+    def rotate(self):
+        self.fsync()
+        self.file.close()
+        number = int(re.search(r'(\d+)', self.name).group(1)) + 1
+        self.open('%s%06d%s' % (EXPORT_PREFIX, number, EXPORT_SUFFIX))
+
+    def add(self, directory, metadata):
+        action = {'index': {'_index': self.index_name, '_id': os.path.relpath(directory, self.root).replace(os.sep, '/')}}
+        lines = (json.dumps(action) + '\n' + json.dumps(metadata, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.lock:
+            if self.file.tell() and self.file.tell() + len(lines) > self.max_bytes:
+                self.rotate()
+            self.file.write(lines)
+            self.file.flush()
+
+    def fsync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def sync(self):
+        """Write the exported lines to disk, called before the UIDs of their messages are saved as archived"""
+        with self.lock:
+            self.fsync()
+
+    def close(self):
+        with self.lock:
+            self.fsync()
+            self.file.close()
+
+
+def read_checkpoint(folder):
+    path = os.path.join(folder, CHECKPOINT_FILENAME)
+    if not os.path.exists(path):
+        return {'file': None, 'offset': 0}
+    with io.open(path, 'r', encoding='utf8') as json_file:
+        return json.load(json_file)
+
+
+def write_checkpoint(folder, name, offset):
+    path = os.path.join(folder, CHECKPOINT_FILENAME)
+    with io.open(path + '.tmp', 'w', encoding='utf8') as json_file:
+        json_file.write(json.dumps({'file': name, 'offset': offset}))
+    os.replace(path + '.tmp', path)
+
+
+def pending_chunks(folder, max_bytes=REPLAY_MAX_BYTES):
+    """Yield (file name, end offset, lines) for the complete messages after the checkpoint"""
+    checkpoint = read_checkpoint(folder)
+    for name in export_files(folder):
+        if checkpoint['file'] is not None and name < checkpoint['file']:
+            continue
+        offset = checkpoint['offset'] if name == checkpoint['file'] else 0
+        with open(os.path.join(folder, name), 'rb') as f:
+            f.seek(offset)
+            chunk = []
+            size = 0
+            while True:
+                action = f.readline()
+                document = f.readline()
+                if not document.endswith(b'\n'):
+                    # Still being written
+                    break
+                chunk.append(action + document)
+                size += len(action) + len(document)
+                offset += len(action) + len(document)
+                if size >= max_bytes:
+                    yield name, offset, b''.join(chunk)
+                    chunk = []
+                    size = 0
+            if chunk:
+                yield name, offset, b''.join(chunk)
+
+
+def replay(folder, url):
+    """Send the messages exported since the checkpoint to a _bulk endpoint, return the number sent"""
+    sent = 0
+    for name, offset, lines in pending_chunks(folder):
+        request = urllib.request.Request(url.rstrip('/') + '/_bulk', data=lines, method='POST',
+                                         headers={'Content-Type': 'application/x-ndjson'})
+        with urllib.request.urlopen(request) as response:
+            result = json.loads(response.read().decode('utf-8'))
+        if result.get('errors'):
+            failed = [item for item in result.get('items', []) if list(item.values())[0].get('error')]
+            raise ValueError('{} documents were refused, first error: {}'.format(len(failed), failed[0] if failed else None))
+        write_checkpoint(folder, name, offset)
+        sent += lines.count(b'\n') // 2
+    return sent
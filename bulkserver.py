@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""Minimal stand-in for the Elasticsearch _bulk API
+
+Documents are kept in memory, it is meant to try the export replay without a
+search engine, for example:
+
+    python bulkserver.py -p 9200
+    python imapbox.py export-replay http://127.0.0.1:9200
+"""
+
+import argparse
+import http.server
+import json
+import threading
+
+
+class BulkHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/_bulk':
+            self.reply(404, {'error': 'unsupported path %s' % self.path})
+            return
+        lines = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8').splitlines()
+        items = []
+        for i in range(0, len(lines) - 1, 2):
+            action = json.loads(lines[i])
+            operation, target = list(action.items())[0]
+            try:
+                document = json.loads(lines[i + 1])
+                with self.server.lock:
+                    self.server.indices.setdefault(target['_index'], {})[target['_id']] = document
+                items.append({operation: {'_index': target['_index'], '_id': target['_id'], 'status': 201}})
+            except ValueError as e:
+                items.append({operation: {'_index': target['_index'], '_id': target['_id'], 'status': 400,
+                                          'error': {'type': 'mapper_parsing_exception', 'reason': str(e)}}})
+        self.server.requests += 1
+        self.reply(200, {'took': 1, 'errors': any('error' in list(item.values())[0] for item in items), 'items': items})
+
+    def do_GET(self):
+        index, _, action = self.path.strip('/').partition('/')
+        if action != '_count':
+            self.reply(404, {'error': 'unsupported path %s' % self.path})
+            return
+        with self.server.lock:
+            self.reply(200, {'count': len(self.server.indices.get(index, {}))})
+
+
+class BulkServer(http.server.ThreadingHTTPServer):
+    """_bulk server running in a background thread, indices maps index names to {id: document}"""
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.indices = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        http.server.ThreadingHTTPServer.__init__(self, (host, port), BulkHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Receive _bulk requests and keep the documents in memory")
+    argparser.add_argument('-p', dest='port', help="Port to listen on", type=int, default=9200)
+    args = argparser.parse_args()
+
+    server = BulkServer(port=args.port)
+    print('Listening on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import functools
+import importlib.util
+import threading
+from collections import OrderedDict
+
+# use cchardet, a faster implementation of chardet, if it is installed
+has_cchardet = importlib.util.find_spec('cchardet') is not None
+if has_cchardet:
+    import cchardet as chardet
+else:
+    import chardet
+
+# Bytes given to the detector, the start of a text is enough to guess its charset
+DETECT_SAMPLE_SIZE = 64 * 1024
+# Sender domains whose charset is remembered, the least recently used is forgotten first
+CACHE_SIZE = 1000
+# Bytes which a single-byte charset decodes to one character each
+HIGH_BYTES = bytes(range(0x80, 0x100))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def decodes(payload, charset):
+    try:
+        payload.decode(charset)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def is_multibyte(charset):
+    """If the charset has multi-byte sequences, a strict decode then rejects most texts of another charset
+
+    A single-byte charset like latin-1 or cp1252 decodes nearly any bytes,
+    decoding does not tell if it is the right one.
+    """
+    try:
+        return len(HIGH_BYTES.decode(charset, 'replace')) != len(HIGH_BYTES)
+    except LookupError:
+        return False
+
+
+def detect_charset(payload, key=None):
+    """Charset of a text without declared charset
+
+    utf-8, ascii included, is checked first with a strict decode. Otherwise the
+    detector runs on a sample. A multi-byte result is remembered for key,
+    usually the sender domain, and reused for the next texts of this key it
+    can decode.
+    """
+    if not payload:
+        return 'ascii'
+    if decodes(payload, 'utf-8'):
+        return 'utf-8'
+
+    if key is not None:
+        with _cache_lock:
+            cached = _cache.get(key)
+            if cached is not None:
+                _cache.move_to_end(key)
+        if cached is not None and decodes(payload, cached):
+            return cached
+
+    charset = chardet.detect(payload[:DETECT_SAMPLE_SIZE])['encoding'] or 'ascii'
+    if key is not None and is_multibyte(charset):
+        with _cache_lock:
+            _cache[key] = charset
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    return charset
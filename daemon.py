@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import asyncio
+import imaplib
+import random
+import traceback
+from collections import OrderedDict
+
+from asyncmailbox import AsyncMailboxClient
+from mailboxresource import is_gmail, get_part_policy
+from metrics import metrics
+
+# Sessions of an account, one per folder watched with IDLE
+DAEMON_CONNECTIONS = 4
+# Delay in seconds between two checks of the folders not watched with IDLE
+POLL_INTERVAL = 300
+# IDLE is started again before the 30 minutes after which a server may log the client out (RFC 2177)
+IDLE_TIMEOUT = 29 * 60
+# Delay in seconds before opening a lost session again, doubled after each failure
+BACKOFF_MIN = 1
+BACKOFF_MAX = 300
+
+
+class Daemon:
+    """Archive the messages of folders as they arrive, until stopped
+
+    Each session keeps its connection open. A session watching one folder
+    waits in IDLE until the server reports a new message or a flag change,
+    then archives the folder like a run with the incremental option. An
+    account has at most `connections` sessions, its folders beyond them share
+    the last one, which checks them every poll_interval seconds. A lost
+    session is opened again after a delay growing up to BACKOFF_MAX. report
+    is called after each sync cycle of a session, to write the metrics so far.
+    Without an index, the last archived UID of each folder is kept in memory,
+    so a cycle only searches the messages added since the previous one.
+    """
+
+    def __init__(self, connections=DAEMON_CONNECTIONS, poll_interval=POLL_INTERVAL, idle_timeout=IDLE_TIMEOUT, report=None):
+        self.connections = max(1, connections)
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.report = report
+        self.accounts = OrderedDict()
+        self.loop = None
+        self.stopped = None
+        # Synchronization state of the folders without an index, by account and folder
+        self.states = {}
+
+    def add(self, account, options, *args):
+        """Watch the folder of account, args are the index, pipeline, renderer and export of save_emails_async()"""
+        self.accounts.setdefault(account['name'], []).append((account, options, args))
+
+    def sessions(self):
+        """Folders of each session and if it waits in IDLE"""
+        for jobs in self.accounts.values():
+            watched = jobs if len(jobs) <= self.connections else jobs[:self.connections - 1]
+            for job in watched:
+                yield [job], True
+            if len(watched) < len(jobs):
+                yield jobs[len(watched):], False
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        tasks = [asyncio.ensure_future(self.session(jobs, idle)) for jobs, idle in self.sessions()]
+        try:
+            await self.stopped.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        """Stop the sessions, can be called from another thread"""
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def session(self, jobs, idle):
+        folders = ', '.join('{}/{}'.format(account['name'], account['remote_folder']) for account, options, args in jobs)
+        backoff = BACKOFF_MIN
+        while True:
+            mailbox = None
+            try:
+                while True:
+                    for account, options, args in jobs:
+                        mailbox = await self.archive(mailbox, account, options, args)
+                    backoff = BACKOFF_MIN
+                    self.write_report()
+                    if idle and 'IDLE' in mailbox.capabilities:
+                        await mailbox.mailbox.idle(self.idle_timeout)
+                    else:
+                        await asyncio.sleep(self.poll_interval)
+            except (OSError, EOFError, imaplib.IMAP4.error) as e:
+                print('{}: session lost, opened again in {} seconds: {}'.format(folders, backoff, e))
+            except Exception:
+                print('{}: session failed, opened again in {} seconds'.format(folders, backoff))
+                print(traceback.format_exc())
+            finally:
+                if mailbox is not None:
+                    mailbox.mailbox.close()
+            # Sessions lost together are not all opened again at the same time
+            await asyncio.sleep(backoff * random.uniform(1, 1.5))
+            backoff = min(backoff * 2, BACKOFF_MAX)
+
+    def write_report(self):
+        if self.report is None:
+            return
+        try:
+            self.report()
+        except OSError as e:
+            print('Report not written: {}'.format(e))
+
+    async def archive(self, previous, account, options, args):
+        """Archive the new messages of a folder, on the connection of the previous client if any, return the client"""
+        index, pipeline, renderer, export = args
+        metrics.labels.set((account.get('name'), account['remote_folder']))
+        mailbox = AsyncMailboxClient(account['host'], account['port'], account['username'], account['password'], account['remote_folder'],
+                                     account['ssl'], account.get('name'), index, pipeline, renderer, export, is_gmail(account))
+        if previous is not None:
+            mailbox.mailbox, mailbox.capabilities = previous.mailbox, previous.capabilities
+        key = (account.get('name'), account['remote_folder'])
+        mailbox.sync_state = self.states.get(key)
+        try:
+            if previous is None:
+                await mailbox.connect()
+            await mailbox.select_folder()
+            stats = await mailbox.copy_emails(options['days'], options['local_folder'],
+                                              options['fetch_batch_size'], options['fetch_batch_bytes'], options['prescan'],
+                                              options['incremental'], get_part_policy(options), options['attachment_store'],
+                                              options['storage'], options.get('raw_codec'))
+        except BaseException:
+            # The session may have been opened again by copy_emails()
+            if mailbox.mailbox is not None and (previous is None or mailbox.mailbox is not previous.mailbox):
+                mailbox.mailbox.close()
+            raise
+        self.states[key] = mailbox.sync_state
+        if stats[0]:
+            print('{} emails created in folder {}'.format(stats[0], account['remote_folder']))
+        return mailbox
@@ -1,48 +1,83 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
 
-from mailboxresource import save_emails, get_folder_fist, get_account
+from mailboxresource import save_emails, get_folder_fist, get_account, fetch_skipped, extract_segments, is_gmail, find_all_mail, get_part_policy
+from archiveindex import ArchiveIndex, INDEX_FILENAME
+from attachmentstore import STORE_DIRNAME
+from scheduler import Scheduler
+from sessionpool import SessionPool, HostLimit
+from pipeline import MessagePipeline
+from pdfrenderer import PdfRenderer, TIMEOUT_SECONDS, pending_messages
+from bulkexport import BulkExport, EXPORT_MAX_BYTES, replay
+from asyncmailbox import save_emails_async, get_folder_list_async, AsyncSessionPool, close_pools
+from metrics import metrics
+from reprocess import reprocess, parse_artifacts, ARTIFACTS
+from rawcodec import RawCodec, COMPRESSIONS, LEVEL_RANGES, has_zstandard, account_dictionary, dictionary_path, message_folders
+from daemon import Daemon, DAEMON_CONNECTIONS, POLL_INTERVAL
+from segmentstore import stored_messages
+import asyncio
 import argparse
+import sqlite3
 from six.moves import configparser
 import os
 import getpass
+import time
 
 
-def load_configuration(args):
-    config = configparser.ConfigParser(allow_no_value=True)
-    config.read(['./config.cfg', '/etc/imapbox/config.cfg', os.path.expanduser('~/.config/imapbox/config.cfg')])
+# Commands working on the local archive only, no account is needed
+OFFLINE_COMMANDS = ('rebuild-index', 'render-pdf', 'search', 'export-replay', 'extract', 'reprocess')
+
 
-    options = {
+def default_options():
+    return {
         'days': None,
         'local_folder': '.',
         'wkhtmltopdf': None,
         'specific_folders': False,
         'test_only': False,
+        'fetch_batch_size': 50,
+        'fetch_batch_bytes': None,
+        'prescan': True,
+        'index': True,
+        'fulltext': True,
+        'incremental': True,
+        'workers': 1,
+        'host_connections': 2,
+        'account_connections': 2,
+        'processes': 0,
+        # imaplib when not set, the daemon always uses asyncio
+        'backend': None,
+        'attachment_max_size': None,
+        'attachment_types': [],
+        'attachment_types_exclude': [],
+        'attachment_store': False,
+        'pdf_workers': 2,
+        'pdf_timeout': TIMEOUT_SECONDS,
+        'pdf_deferred': False,
+        'storage': 'folders',
+        'compression': 'gzip',
+        'compression_level': None,
+        'compression_threads': 0,
+        'zstd_dictionary': False,
+        'export_folder': None,
+        'export_max_bytes': EXPORT_MAX_BYTES,
+        'report_file': None,
+        'prometheus_file': None,
+        'daemon_connections': DAEMON_CONNECTIONS,
+        'poll_interval': POLL_INTERVAL,
         'accounts': []
     }
 
-    if (config.has_section('imapbox')):
-        if config.has_option('imapbox', 'days'):
-            options['days'] = config.getint('imapbox', 'days')
-
-        if config.has_option('imapbox', 'local_folder'):
-            options['local_folder'] = os.path.expanduser(config.get('imapbox', 'local_folder'))
-
-        if config.has_option('imapbox', 'wkhtmltopdf'):
-            options['wkhtmltopdf'] = os.path.expanduser(config.get('imapbox', 'wkhtmltopdf'))
-
-        if config.has_option('imapbox', 'specific_folders'):
-            options['specific_folders'] = config.getboolean('imapbox', 'specific_folders')
-
-        if config.has_option('imapbox', 'test_only'):
-            options['test_only'] = config.getboolean('imapbox', 'test_only')
 
+def load_accounts(config, args):
+    """Accounts of the DSN given on the command line, or of the sections of the configuration"""
+    accounts = []
     if args.specific_dsn:
         account = get_account(args.specific_dsn)
         if (None == account['host'] or None == account['username'] or None == account['password']):
             print('Invalid DSN: ' + args.specific_dsn)
         else:
-            options['accounts'].append(account)
+            accounts.append(account)
 
     else:
         for section in config.sections():
@@ -94,11 +129,157 @@ def load_configuration(args):
             else:
                 account['exclude_folders'] = []  # Leeres Array, falls keine exclude_folders angegeben sind
 
+            if config.has_option(section, 'gmail'):
+                account['gmail'] = config.getboolean(section, 'gmail')
+
             if (None == account['host'] or None == account['username'] or None == account['password']):
                 print('Invalid account: ' + section)
                 continue
 
-            options['accounts'].append(account)
+            accounts.append(account)
+
+    return accounts
+
+
+def load_configuration(args):
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.read(['./config.cfg', '/etc/imapbox/config.cfg', os.path.expanduser('~/.config/imapbox/config.cfg')])
+
+    options = default_options()
+
+    if (config.has_section('imapbox')):
+        if config.has_option('imapbox', 'days'):
+            options['days'] = config.getint('imapbox', 'days')
+
+        if config.has_option('imapbox', 'local_folder'):
+            options['local_folder'] = os.path.expanduser(config.get('imapbox', 'local_folder'))
+
+        if config.has_option('imapbox', 'wkhtmltopdf'):
+            options['wkhtmltopdf'] = os.path.expanduser(config.get('imapbox', 'wkhtmltopdf'))
+
+        if config.has_option('imapbox', 'specific_folders'):
+            options['specific_folders'] = config.getboolean('imapbox', 'specific_folders')
+
+        if config.has_option('imapbox', 'test_only'):
+            options['test_only'] = config.getboolean('imapbox', 'test_only')
+
+        if config.has_option('imapbox', 'fetch_batch_size'):
+            options['fetch_batch_size'] = max(1, config.getint('imapbox', 'fetch_batch_size'))
+
+        if config.has_option('imapbox', 'fetch_batch_bytes'):
+            options['fetch_batch_bytes'] = config.getint('imapbox', 'fetch_batch_bytes') or None
+
+        if config.has_option('imapbox', 'prescan'):
+            options['prescan'] = config.getboolean('imapbox', 'prescan')
+
+        if config.has_option('imapbox', 'index'):
+            options['index'] = config.getboolean('imapbox', 'index')
+
+        if config.has_option('imapbox', 'fulltext'):
+            options['fulltext'] = config.getboolean('imapbox', 'fulltext')
+
+        if config.has_option('imapbox', 'incremental'):
+            options['incremental'] = config.getboolean('imapbox', 'incremental')
+
+        if config.has_option('imapbox', 'workers'):
+            options['workers'] = config.getint('imapbox', 'workers')
+
+        if config.has_option('imapbox', 'host_connections'):
+            options['host_connections'] = config.getint('imapbox', 'host_connections')
+
+        if config.has_option('imapbox', 'account_connections'):
+            options['account_connections'] = config.getint('imapbox', 'account_connections')
+
+        if config.has_option('imapbox', 'processes'):
+            options['processes'] = config.getint('imapbox', 'processes')
+
+        if config.has_option('imapbox', 'backend'):
+            options['backend'] = config.get('imapbox', 'backend').lower()
+            if options['backend'] not in ('imaplib', 'asyncio'):
+                print('Invalid backend: ' + options['backend'])
+                options['backend'] = None
+
+        if config.has_option('imapbox', 'attachment_max_size'):
+            options['attachment_max_size'] = config.getint('imapbox', 'attachment_max_size')
+
+        if config.has_option('imapbox', 'attachment_types'):
+            options['attachment_types'] = [t.strip().lower() for t in config.get('imapbox', 'attachment_types').split(',') if t.strip()]
+
+        if config.has_option('imapbox', 'attachment_types_exclude'):
+            options['attachment_types_exclude'] = [t.strip().lower() for t in config.get('imapbox', 'attachment_types_exclude').split(',') if t.strip()]
+
+        if config.has_option('imapbox', 'attachment_store'):
+            options['attachment_store'] = config.getboolean('imapbox', 'attachment_store')
+
+        if config.has_option('imapbox', 'pdf_workers'):
+            options['pdf_workers'] = config.getint('imapbox', 'pdf_workers')
+
+        if config.has_option('imapbox', 'pdf_timeout'):
+            options['pdf_timeout'] = config.getint('imapbox', 'pdf_timeout')
+
+        if config.has_option('imapbox', 'pdf_deferred'):
+            options['pdf_deferred'] = config.getboolean('imapbox', 'pdf_deferred')
+
+        if config.has_option('imapbox', 'storage'):
+            options['storage'] = config.get('imapbox', 'storage').lower()
+            if options['storage'] not in ('folders', 'segments'):
+                print('Invalid storage: ' + options['storage'])
+                options['storage'] = 'folders'
+
+        if config.has_option('imapbox', 'compression'):
+            options['compression'] = config.get('imapbox', 'compression').lower()
+            if options['compression'] not in COMPRESSIONS:
+                print('Invalid compression: ' + options['compression'])
+                options['compression'] = 'gzip'
+            elif options['compression'] == 'zstd' and not has_zstandard:
+                print('The zstandard package is required by the zstd compression, gzip is used')
+                options['compression'] = 'gzip'
+
+        if config.has_option('imapbox', 'compression_level'):
+            options['compression_level'] = config.getint('imapbox', 'compression_level')
+            low, high = LEVEL_RANGES[options['compression']]
+            if not low <= options['compression_level'] <= high:
+                print('Invalid compression_level for {}: {}, it must be between {} and {}'.format(
+                    options['compression'], options['compression_level'], low, high))
+                options['compression_level'] = None
+
+        if config.has_option('imapbox', 'compression_threads'):
+            options['compression_threads'] = config.getint('imapbox', 'compression_threads')
+
+        if config.has_option('imapbox', 'zstd_dictionary'):
+            options['zstd_dictionary'] = config.getboolean('imapbox', 'zstd_dictionary')
+
+        if config.has_option('imapbox', 'daemon_connections'):
+            options['daemon_connections'] = config.getint('imapbox', 'daemon_connections')
+
+        if config.has_option('imapbox', 'poll_interval'):
+            options['poll_interval'] = config.getint('imapbox', 'poll_interval')
+
+        if config.has_option('imapbox', 'export_folder'):
+            options['export_folder'] = os.path.expanduser(config.get('imapbox', 'export_folder'))
+
+        if config.has_option('imapbox', 'export_max_bytes'):
+            options['export_max_bytes'] = config.getint('imapbox', 'export_max_bytes')
+
+        if config.has_option('imapbox', 'report_file'):
+            options['report_file'] = os.path.expanduser(config.get('imapbox', 'report_file'))
+
+        if config.has_option('imapbox', 'prometheus_file'):
+            options['prometheus_file'] = os.path.expanduser(config.get('imapbox', 'prometheus_file'))
+
+        if options['storage'] == 'segments' and get_part_policy(options) is not None:
+            # A segment keeps the message of the server, never a partial one
+            print('The attachment policy is not supported by the segments storage, the full messages are downloaded')
+            options['attachment_max_size'] = None
+            options['attachment_types'] = []
+            options['attachment_types_exclude'] = []
+
+        if options['storage'] == 'segments' and options['processes']:
+            print('The processes option is not used by the segments storage, the messages are stored as they are fetched')
+
+    # The offline commands don't read the accounts, their passwords would be asked for nothing
+    if args.command not in OFFLINE_COMMANDS:
+        options['accounts'] = load_accounts(config, args)
 
     if (args.local_folder):
         options['local_folder'] = args.local_folder
@@ -125,6 +306,40 @@ def load_configuration(args):
 
 
 
+def save_folder(account, options, index, pool, pipeline, renderer, export):
+    print("Saving folder: " + account['remote_folder'])
+    save_emails(account, options, index, pool, pipeline, renderer, export)
+
+
+async def save_folder_async(account, options, index, pool, pipeline, renderer, export):
+    print("Saving folder: " + account['remote_folder'])
+    await save_emails_async(account, options, index, pipeline, renderer, export, pool)
+
+
+def get_raw_codec(options, rootDir, basedir, account, index=None):
+    """Codec of the raw messages of an account, with its zstd dictionary when there is one"""
+    codec = RawCodec(options['compression'], options['compression_level'], options['compression_threads'])
+    if codec.compression == 'zstd' and options['zstd_dictionary']:
+        stored = None
+        read = None
+        if options['storage'] == 'segments' and not os.path.exists(dictionary_path(rootDir, account['name'])):
+            # The dictionary is trained on the messages of the segments
+            stored = stored_messages(basedir)
+            read = lambda directory: stored[directory][0].read(stored[directory][1])
+        if options['specific_folders']:
+            directories = list(stored) if stored is not None else message_folders(basedir)
+            codec.dictionary = account_dictionary(rootDir, account['name'], directories, read)
+        elif index is not None:
+            # The accounts share the archive tree, the messages of this one are found in the index
+            directories = index.account_paths(account['name'])
+            if stored is not None:
+                directories = [directory for directory in directories if directory in stored]
+            codec.dictionary = account_dictionary(rootDir, account['name'], directories, read)
+        else:
+            print('zstd dictionary of {} not used: the index or specific_folders is needed to find its messages'.format(account['name']))
+    return codec
+
+
 def main():
     argparser = argparse.ArgumentParser(description="Dump a IMAP folder into .eml files")
     argparser.add_argument('-l', dest='local_folder', help="Local folder where to create the email folders")
@@ -135,18 +350,167 @@ def main():
     argparser.add_argument('-t', dest='test_only', help="Only a connection and folder retrival test will be performed", action='store_true')
     argparser.add_argument('-n', dest='specific_dsn', help="Use a specific DSN as account")
     argparser.add_argument('-v', '--version', dest='show_version', help="Show the current version", action="store_true")
+    subparsers = argparser.add_subparsers(dest='command', metavar='command', help="Run a command on the local archive instead of a backup")
+    subparsers.add_parser('rebuild-index', help="Rebuild the archive index from the local folder")
+    subparsers.add_parser('fetch-skipped', help="Download the attachments skipped by the attachment policy")
+    subparsers.add_parser('daemon', help="Keep running and archive the new messages as they arrive, with IMAP IDLE")
+    subparsers.add_parser('render-pdf', help="Create the missing message.pdf files of the archived messages")
+    search_parser = subparsers.add_parser('search', help="Search the archived messages in the full-text index")
+    search_parser.add_argument('query', nargs='?', help="Words to search, in the SQLite FTS5 query syntax")
+    search_parser.add_argument('--from', dest='sender', help="Sender address or name")
+    search_parser.add_argument('--to', dest='recipient', help="Recipient address or name, in To or Cc")
+    search_parser.add_argument('--since', help="Messages sent on or after this day, as YYYY-MM-DD")
+    search_parser.add_argument('--before', help="Messages sent before this day, as YYYY-MM-DD")
+    search_parser.add_argument('--limit', type=int, default=50, help="Maximum number of messages, 50 by default")
+    extract_parser = subparsers.add_parser('extract', help="Write the message folders of the messages stored in segments")
+    extract_parser.add_argument('paths', nargs='*', help="Messages to extract, like INBOX/2024/<id>, all by default")
+    extract_parser.add_argument('--month', help="Only the messages of this month, as YYYY-MM")
+    reprocess_parser = subparsers.add_parser('reprocess', help="Create the files of the archived messages again from their raw.eml.gz")
+    reprocess_parser.add_argument('paths', nargs='*', help="Folders of the archive to reprocess, like INBOX/2024, all by default")
+    reprocess_parser.add_argument('--only', type=parse_artifacts, default=ARTIFACTS,
+                                  help="Comma separated files to create, among {}, all by default".format(','.join(ARTIFACTS)))
+    reprocess_parser.add_argument('--restart', action='store_true', help="Start again instead of resuming an interrupted run")
+    replay_parser = subparsers.add_parser('export-replay', help="Send the messages exported since the last replay to a _bulk API")
+    replay_parser.add_argument('url', help="Base URL of the search engine, like http://localhost:9200")
     args = argparser.parse_args()
     options = load_configuration(args)
     rootDir = options['local_folder']
 
+    if args.command == 'extract':
+        store = os.path.join(rootDir, STORE_DIRNAME) if options['attachment_store'] else None
+        codec = RawCodec(options['compression'], options['compression_level'], options['compression_threads'])
+        index = None
+        if options['index'] and os.path.exists(os.path.join(rootDir, INDEX_FILENAME)):
+            # The flags and labels of the messages are kept in the index
+            index = ArchiveIndex(rootDir, fulltext=options['fulltext'])
+        try:
+            print('{} emails extracted'.format(extract_segments(rootDir, args.paths, args.month, store, codec, index)))
+        finally:
+            if index is not None:
+                index.close()
+        return
+
+    if args.command == 'reprocess':
+        store = os.path.join(rootDir, STORE_DIRNAME) if options['attachment_store'] else None
+        done, failed = reprocess(rootDir, args.only, args.paths, options['processes'], store, args.restart)
+        print('{} emails reprocessed, {} failed'.format(done - failed, failed))
+        if options['index'] and 'metadata' in args.only and done:
+            index = ArchiveIndex(rootDir, fulltext=options['fulltext'])
+            indexed, removed = index.rebuild()
+            index.close()
+            print('{} emails indexed, {} removed from the index'.format(indexed, removed))
+        return
+
+    if args.command == 'export-replay':
+        if not options['export_folder']:
+            print('The export_folder option is required to replay the export')
+            return
+        try:
+            print('{} messages sent'.format(replay(options['export_folder'], args.url)))
+        except (OSError, ValueError) as e:
+            print('Replay failed, it will resume from the last accepted request: {}'.format(e))
+        return
+
+    if args.command == 'search':
+        if not options['index'] or not options['fulltext']:
+            print('The index and fulltext options are required to search the archive')
+            exit(1)
+        if not os.path.exists(os.path.join(rootDir, INDEX_FILENAME)):
+            print('No index in {}, it is created by the next run or by rebuild-index'.format(rootDir))
+            exit(1)
+        index = ArchiveIndex(rootDir, fulltext=options['fulltext'])
+        try:
+            if not index.fulltext:
+                exit(1)
+            for path, date, subject in index.search(args.query, args.sender, args.recipient, args.since, args.before, args.limit):
+                print('{}\t{}\t{}'.format(date or '', path, subject))
+        except sqlite3.OperationalError as e:
+            print('Invalid search: {}'.format(e))
+            exit(1)
+        finally:
+            index.close()
+        return
+
+    if args.command == 'rebuild-index':
+        index = ArchiveIndex(rootDir, fulltext=options['fulltext'])
+        indexed, removed = index.rebuild()
+        index.close()
+        print('{} emails indexed, {} removed from the index'.format(indexed, removed))
+        return
+
+    if args.command == 'render-pdf':
+        if not options['wkhtmltopdf']:
+            print('The wkhtmltopdf option is required to create PDF files')
+            return
+        renderer = PdfRenderer(options['wkhtmltopdf'], options['pdf_workers'], options['pdf_timeout'])
+        for directory in pending_messages(rootDir):
+            renderer.submit(directory)
+        renderer.close()
+        print('{} PDF files created, {} failed'.format(renderer.rendered, renderer.failed))
+        return
+
+    if args.command == 'fetch-skipped':
+        index = ArchiveIndex(rootDir, fulltext=options['fulltext']) if options['index'] else None
+        export = BulkExport(options['export_folder'], rootDir, max_bytes=options['export_max_bytes']) if options['export_folder'] else None
+        store = os.path.join(rootDir, STORE_DIRNAME) if options['attachment_store'] else None
+        for account in options['accounts']:
+            basedir = os.path.join(rootDir, account['name']) if options['specific_folders'] else rootDir
+            codec = get_raw_codec(options, rootDir, basedir, account, index)
+            n_fetched = fetch_skipped(account, basedir, None, index, export, store, codec)
+            print('{} emails downloaded with their skipped attachments for {}'.format(n_fetched, account['name']))
+        if export is not None:
+            export.close()
+        if index is not None:
+            index.close()
+        return
+
     if not options['accounts']:
         argparser.print_help()
 
+    index = None
+    if options['index'] and options['accounts'] and not options['test_only']:
+        index = ArchiveIndex(rootDir, fulltext=options['fulltext'])
+
+    store = os.path.join(rootDir, STORE_DIRNAME) if options['attachment_store'] else None
+
+    if args.command == 'daemon' and options['backend'] == 'imaplib':
+        print('The daemon only runs with the asyncio backend, remove backend=imaplib from the configuration')
+        return
+
+    started = time.time()
+
+    def write_report():
+        finished = time.time()
+        if options['report_file']:
+            metrics.write_report(options['report_file'], started, finished)
+        if options['prometheus_file']:
+            metrics.write_prometheus(options['prometheus_file'], started, finished)
+
+    scheduler = Scheduler(options['workers'], options['host_connections'])
+    daemon = Daemon(options['daemon_connections'], options['poll_interval'], report=write_report)
+    pools = []
+    # The pools of the accounts of a host share its connections
+    hosts = {}
+
+    # PDF files are rendered in the background, or later with the render-pdf command
+    renderer = None
+    if options['wkhtmltopdf'] and not options['pdf_deferred'] and options['accounts'] and not options['test_only']:
+        renderer = PdfRenderer(options['wkhtmltopdf'], options['pdf_workers'], options['pdf_timeout'])
+
+    pipeline = None
+    if options['processes'] and options['storage'] != 'segments' and options['accounts'] and not options['test_only']:
+        pipeline = MessagePipeline(options['processes'])
+
+    export = None
+    if options['export_folder'] and options['accounts'] and not options['test_only']:
+        export = BulkExport(options['export_folder'], rootDir, max_bytes=options['export_max_bytes'])
+
     for account in options['accounts']:
 
-        print('{}/{} (on {})'.format(account['name'], account['remote_folder'], account['host']))
+        header = '{}/{} (on {})'.format(account['name'], account['remote_folder'], account['host'])
 
         if options['test_only']:
+            print(header)
             try:
                 get_folder_fist(account)
                 print(" - SUCCESS: Login and folder retrival")
@@ -154,14 +518,26 @@ def main():
                 print("\x1b[31;20m" + " - FAILED: Login and folder retrival" + "\x1b[0m")
             continue
 
+        if account['host'] not in hosts:
+            hosts[account['host']] = HostLimit(options['host_connections'])
+        pool_class = AsyncSessionPool if options['backend'] == 'asyncio' else SessionPool
+        pool = pool_class(account, options['account_connections'], hosts[account['host']])
+        pools.append(pool)
+
         if options['specific_folders']:
             basedir = os.path.join(rootDir, account['name'])
         else:
             basedir = rootDir
 
+        codec = get_raw_codec(options, rootDir, basedir, account, index)
+
         if account['remote_folder'] == "__ALL__":
             folders = []
-            for folder_entry in get_folder_fist(account):
+            if options['backend'] == 'asyncio':
+                folder_list = asyncio.run(get_folder_list_async(account))
+            else:
+                folder_list = get_folder_fist(account, pool)
+            for folder_entry in folder_list:
                 folder_name = folder_entry.decode().replace("/", ".").split(' "." ')[1] 
                 if folder_name not in account['exclude_folders']:
                     folders.append(folder_name)
@@ -169,13 +545,51 @@ def main():
             if '"[Gmail]"' in folders: folders.remove('"[Gmail]"')
             # Remove Gmail "All Mail" folder which just duplicates emails:
             if '"[Gmail].All Mail"' in folders: folders.remove('"[Gmail].All Mail"')
+            if is_gmail(account):
+                all_mail = find_all_mail(folder_list)
+                if all_mail is not None:
+                    # Each message is in All Mail once, its labels are archived in its metadata
+                    folders = [all_mail.decode().replace("/", ".").split(' "." ')[1]]
+                else:
+                    print("No folder with the \\All attribute, every folder of {} is archived".format(account['name']))
         else:
             folders = str.split(account['remote_folder'], ',')
         for folder_entry in folders:
-            print("Saving folder: " + folder_entry) 
-            account['remote_folder'] = folder_entry
-            options['local_folder'] = os.path.join(basedir, folder_entry.replace('"', ''))
-            save_emails(account, options)
+            folder_account = dict(account, remote_folder=folder_entry)
+            folder_options = dict(options, local_folder=os.path.join(basedir, folder_entry.replace('"', '')), attachment_store=store, raw_codec=codec)
+            if args.command == 'daemon':
+                daemon.add(folder_account, folder_options, index, pipeline, renderer, export)
+                continue
+            job = save_folder_async if options['backend'] == 'asyncio' else save_folder
+            scheduler.add(header, account['host'], job, folder_account, folder_options, index, pool, pipeline, renderer, export)
+
+    if args.command == 'daemon':
+        try:
+            asyncio.run(daemon.run())
+        except KeyboardInterrupt:
+            print('Daemon stopped')
+    elif options['backend'] == 'asyncio':
+        scheduler.run_async(lambda: close_pools(pools))
+    else:
+        scheduler.run()
+
+    for pool in pools:
+        pool.close()
+
+    if pipeline is not None:
+        pipeline.close()
+
+    if renderer is not None:
+        renderer.close()
+
+    if export is not None:
+        export.close()
+
+    if index is not None:
+        index.close()
+
+    if options['accounts'] and not options['test_only']:
+        write_report()
 
 
 if __name__ == '__main__':
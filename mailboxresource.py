@@ -4,38 +4,98 @@
 from __future__ import print_function
 
 import imaplib, email
+import base64
+import concurrent.futures
+import email.utils
 import re
 import os
 import hashlib
-from message import Message
+import io
+import json
+import time
+from message import Message, message_from_bytes
+from archiveindex import utc_date
+from attachmentstore import get_store
+from segmentstore import get_segment_store, find_stores
+from metrics import metrics, Progress
+from uidset import UidSet, parse_esearch
+from bodystructure import PartPolicy, fetch_attributes, parse_bodystructure, fetch_items, build_message
+from rawcodec import RawCodec
+from sessionpool import ssl_context
 import datetime
 import urllib
 
 MAX_RETRIES = 5
+FETCH_BATCH_SIZE = 50
+PRESCAN_ITEMS = '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE)])'
+FETCH_ITEMS = '(FLAGS BODY.PEEK[])'
+# Gmail extensions: the id of a message is the same in all its labels
+GMAIL_PRESCAN_ITEMS = '(X-GM-MSGID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE)])'
+GMAIL_FETCH_ITEMS = '(X-GM-MSGID X-GM-LABELS FLAGS BODY.PEEK[])'
+# Fetched first with an attachment policy, the Message-Id names the folder of a partial message
+STRUCTURE_ITEMS = 'BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'
+# Errors after which a session is in an unknown state, it is closed instead of reused
+BROKEN_SESSION_ERRORS = (OSError, EOFError, imaplib.IMAP4.abort, SystemExit, KeyboardInterrupt)
 
 class MailboxClient:
     """Operations on a mailbox"""
 
-    def __init__(self, host, port, username, password, remote_folder, ssl):
+    def __init__(self, host, port, username, password, remote_folder, ssl, name=None, index=None, pool=None, pipeline=None,
+                 renderer=None, export=None, gmail=False):
+        self.init_state(host, port, username, password, remote_folder, ssl, name, index, pool, pipeline, renderer, export, gmail)
+        self.connect_to_imap()
 
+    def init_state(self, host, port, username, password, remote_folder, ssl, name, index, pool, pipeline, renderer, export, gmail):
+        """State of the client before it connects, shared with AsyncMailboxClient"""
         self.host = host
         self.port = port
         self.username = username
         self.password = password
         self.remote_folder = remote_folder
         self.ssl = ssl
-
-        self.connect_to_imap()
+        self.name = name
+        self.index = index
+        self.pool = pool
+        self.pipeline = pipeline
+        self.renderer = renderer
+        self.export = export
+        self.segments = None
+        self.mailbox = None
+        self.capabilities = None
+        # Messages submitted to the pipeline and not saved yet
+        self.processing = []
+        # Messages fetched without the parts skipped by the attachment policy
+        self.partial_uids = set()
+        # Synchronization state of the folder without an index, kept by the daemon between its cycles
+        self.sync_state = None
+        self.set_gmail(gmail)
+
+    def set_gmail(self, gmail):
+        """With gmail, the labels and the Gmail id of the messages are fetched too, the id is used to skip the archived ones"""
+        self.gmail = gmail
+        self.prescan_items = GMAIL_PRESCAN_ITEMS if gmail else PRESCAN_ITEMS
+        self.fetch_items = GMAIL_FETCH_ITEMS if gmail else FETCH_ITEMS
 
     def connect_to_imap(self):
         retries = 0
         while retries < MAX_RETRIES:
             try:
-                if not self.ssl:  # Gespeicherten Wert verwenden
-                    self.mailbox = imaplib.IMAP4(self.host, self.port)  # Gespeicherte Werte verwenden
+                if self.pool is not None:
+                    # Reconnecting: the current session is broken
+                    if self.mailbox is not None:
+                        self.pool.discard(self.mailbox)
+                        self.mailbox = None
+                    self.mailbox = self.pool.acquire()
                 else:
-                    self.mailbox = imaplib.IMAP4_SSL(self.host, self.port)
-                self.mailbox.login(self.username, self.password)
+                    if not self.ssl:  # Gespeicherten Wert verwenden
+                        self.mailbox = imaplib.IMAP4(self.host, self.port)  # Gespeicherte Werte verwenden
+                    else:
+                        self.mailbox = imaplib.IMAP4_SSL(self.host, self.port, ssl_context=ssl_context())
+                    self.mailbox.login(self.username, self.password)
+                if self.capabilities is None:
+                    # The capabilities of the greeting may not list the extensions available after login
+                    typ, data = self.mailbox.capability()
+                    self.capabilities = set(data[0].decode().upper().split()) if typ == 'OK' and data and data[0] else set()
                 typ, data = self.mailbox.select(self.remote_folder, readonly=True)
                 if typ != 'OK':
                     # Handle case where Exchange/Outlook uses '.' path separator when
@@ -44,94 +104,436 @@ class MailboxClient:
                     typ, data = self.mailbox.select(adjust_remote_folder, readonly=True)
                     if typ != 'OK':
                         print("MailboxClient: Could not select remote folder '%s'" % self.remote_folder)
+                self.message_count = int(data[0]) if typ == 'OK' and data[0] else 0
+                self.uidvalidity = self.get_response_number('UIDVALIDITY')
+                self.uidnext = self.get_response_number('UIDNEXT')
+                # Only sent by servers with CONDSTORE
+                self.highestmodseq = self.get_response_number('HIGHESTMODSEQ')
                 break  # Erfolgreiche Verbindung und Ordnerauswahl
             except ConnectionResetError as e:
                 print(f"Connection error: {e}. Will retry...")
                 retries += 1
             except Exception as e:
                 print(f"MailboxClient: The following error happened: {e}. Will NOT retry...")
+                self.cleanup(broken=True)
                 exit(1)
 
         if retries == MAX_RETRIES:
             print("Maximum retries reached. Exiting...")
+            self.cleanup(broken=True)
             exit(1)
 
+    def get_response_number(self, code):
+        """Numeric value of a response code sent with SELECT, like UIDVALIDITY"""
+        typ, data = self.mailbox.response(code)
+        if data and data[-1]:
+            return int(data[-1])
+        return None
+
     def search_emails(self, criterion, batch_size=5000):
-        all_uids = []
+        """UidSet matching criterion, searched by windows of batch_size message numbers or in one command if batch_size is None
+
+        With ESEARCH the server returns a compact sequence set, one command is
+        enough whatever the number of messages.
+        """
+        if 'ESEARCH' in self.capabilities:
+            return self.esearch_emails(criterion)
+
+        all_uids = UidSet()
         last_num = 0
 
-        while True:
-            typ, data = self.mailbox.search(None, criterion, f'{last_num+1}:{last_num + batch_size}')
+        while batch_size is None or last_num < self.message_count:
+            if batch_size is None:
+                typ, data = self.mailbox.uid('SEARCH', criterion)
+            else:
+                typ, data = self.mailbox.uid('SEARCH', criterion, f'{last_num+1}:{last_num + batch_size}')
             if typ != 'OK':
                 raise imaplib.IMAP4.error(f"Error on searching emails: {data}")
 
             if data and len(data) > 0 and data[0]: 
-                batch_uids = data[0].split()
-            else:
-                batch_uids = []
+                all_uids = all_uids.union(data[0].split())
 
-            if not batch_uids:
+            if batch_size is None:
                 break
-
-            all_uids.extend(batch_uids)
             last_num = last_num + batch_size
 
         return all_uids
-    
-    def copy_emails(self, days, local_folder, wkhtmltopdf):
-
-        n_saved = 0
-        n_exists = 0
 
-        self.local_folder = local_folder
-        self.wkhtmltopdf = wkhtmltopdf
-        criterion = 'ALL'
+    def esearch_emails(self, criterion):
+        self.mailbox.response('ESEARCH')
+        typ, data = self.mailbox.uid('SEARCH', 'RETURN (ALL COUNT)', criterion)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"Error on searching emails: {data}")
+        typ, data = self.mailbox.response('ESEARCH')
+        return check_esearch(data[-1] if data and data[-1] else b'')
 
+    def search_criterion(self, days):
         if days:
             date = (datetime.date.today() - datetime.timedelta(days)).strftime("%d-%b-%Y")
-            criterion = '(SENTSINCE {date})'.format(date=date)
+            return '(SENTSINCE {date})'.format(date=date)
+        return 'ALL'
+
+    def get_last_uid(self, incremental):
+        """UID high-water mark of the previous run, None if the folder must be fully synchronized"""
+        if not incremental or self.uidvalidity is None:
+            return None
+
+        state = self.index.get_folder(self.name, self.remote_folder) if self.index is not None else self.sync_state
+        if state is None:
+            return None
+
+        if state['uidvalidity'] != self.uidvalidity:
+            print("UIDVALIDITY of folder {} changed, full resync".format(self.remote_folder))
+            return None
+
+        return state['last_uid']
+
+    def search_new_emails(self, criterion, incremental):
+        """UIDs to archive and the UID high-water mark they are relative to"""
+        last_uid = self.get_last_uid(incremental)
+        if last_uid is None:
+            return self.search_emails(criterion), 0
+
+        if self.uidnext is not None and self.uidnext <= last_uid + 1:
+            # Nothing was added since the last run
+            return UidSet(), last_uid
+
+        uids = self.search_emails(self.incremental_criterion(criterion, last_uid), None)
+        return uids.after(last_uid), last_uid
+
+    def incremental_criterion(self, criterion, last_uid):
+        """Search of the messages added after last_uid, the days window is kept"""
+        # UID last+1:* matches at least the last message, even if its UID is lower
+        if criterion == 'ALL':
+            return 'UID {}:*'.format(last_uid + 1)
+        return 'UID {}:* {}'.format(last_uid + 1, criterion)
+
+    def searched_uid(self, last_uid, uids):
+        """High-water mark once uids are archived: every message below UIDNEXT was searched
+
+        The messages out of the days window are below it too, the window only
+        moves forward so they are never searched again.
+        """
+        if uids:
+            last_uid = max(last_uid, uids.max())
+        if self.uidnext is not None:
+            last_uid = max(last_uid, self.uidnext - 1)
+        return last_uid
+
+    def save_sync_state(self, incremental, last_uid, failed):
+        # The messages are saved and exported before their UIDs are marked archived
+        if self.processing:
+            concurrent.futures.wait(self.processing)
+            self.processing = []
+        if self.export is not None:
+            self.export.sync()
+        if incremental and self.uidvalidity is not None:
+            # Skipped messages are retried on the next run
+            if failed:
+                last_uid = min(int(uid) for uid in failed) - 1
+            if self.index is None:
+                self.sync_state = {'uidvalidity': self.uidvalidity, 'last_uid': last_uid, 'highestmodseq': self.highestmodseq}
+            else:
+                self.index.set_folder(self.name, self.remote_folder, self.uidvalidity, last_uid, self.highestmodseq)
+        if self.index is not None:
+            self.index.flush()
+
+    def flag_sync_items(self, incremental, last_uid):
+        """UID FETCH arguments getting the flags and labels changed since the last run, None if there is nothing to get
+
+        Messages up to last_uid were archived by the previous runs, with the
+        mod-sequence of the folder at that time. Without CONDSTORE the flags
+        are only archived with new messages.
+        """
+        if not incremental or not last_uid or self.index is None or self.highestmodseq is None:
+            return None
+        state = self.index.get_folder(self.name, self.remote_folder)
+        if state is None or state['uidvalidity'] != self.uidvalidity:
+            return None
+        items = '(FLAGS X-GM-LABELS)' if self.gmail else '(FLAGS)'
+        if state['highestmodseq'] is None:
+            # Archived before the flags were, they are all fetched once
+            return '1:%d' % last_uid, items
+        if state['highestmodseq'] >= self.highestmodseq:
+            return None
+        return '1:%d' % last_uid, '%s (CHANGEDSINCE %d)' % (items, state['highestmodseq'])
+
+    def sync_flags(self, incremental, last_uid):
+        """Update the flags of the archived messages changed on the server, return the number updated"""
+        items = self.flag_sync_items(incremental, last_uid)
+        if items is None:
+            return 0
+        with metrics.timer('flags'):
+            typ, data = self.mailbox.uid('FETCH', *items)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"Error on fetching flags: {data}")
+            return self.saveProperties(data)
+
+    def fetch_sizes(self, uids, batch_size=5000):
+        """Get the RFC822.SIZE of each UID, used to cut fetch batches by bytes"""
+        sizes = {}
+        for start in range(0, len(uids), batch_size):
+            typ, data = self.mailbox.uid('FETCH', uid_set(uids[start:start + batch_size]), '(RFC822.SIZE)')
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"Error on fetching sizes: {data}")
+            sizes.update(parse_sizes(data))
+        return sizes
+
+    def prescan_emails(self, uids, batch_size=5000):
+        """Fetch only the Message-Id and Date headers, return the UIDs not archived yet and the size of every message"""
+        missing = []
+        sizes = {}
+        for start in range(0, len(uids), batch_size):
+            batch = uids[start:start + batch_size]
+            for uid, data in self.fetch_stream(batch, self.prescan_items, 'prescan'):
+                self.prescanResponse(uid, data, missing, sizes)
+        return missing, sizes
+
+    def prescanResponse(self, uid, data, missing, sizes):
+        attributes = b' '.join(part[0] if isinstance(part, tuple) else part for part in data)
+        size = re.search(rb'RFC822\.SIZE (\d+)', attributes)
+        if size:
+            sizes[uid] = int(size.group(1))
+        gmail_id = re.search(rb'X-GM-MSGID (\d+)', attributes)
+        if gmail_id and self.index is not None and self.index.has_gmail_id(gmail_id.group(1).decode()):
+            # Archived from another label
+            return
+        headers = message_from_bytes(b''.join(part[1] for part in data if isinstance(part, tuple)))
+        directory = self.getEmailFolder(headers)
+        # Without a usable Message-Id the folder name is a hash of the full message
+        if directory is None or not self.isArchived(directory, headers, uid, sizes.get(uid)):
+            missing.append(uid)
+
+    def fetch_batches(self, uids, batch_size, batch_bytes=None, sizes=None):
+        """Split uids into fetch batches of at most batch_size messages and batch_bytes bytes"""
+        if sizes is None:
+            sizes = self.fetch_sizes(uids) if batch_bytes else {}
+        batch = []
+        batch_total = 0
+        for uid in uids:
+            size = sizes.get(uid, 0)
+            if batch and (len(batch) >= batch_size or (batch_bytes and batch_total + size > batch_bytes)):
+                yield batch
+                batch = []
+                batch_total = 0
+            batch.append(uid)
+            batch_total += size
+        if batch:
+            yield batch
+
+    def fetch_stream(self, uids, items=FETCH_ITEMS, phase='fetch'):
+        """Send one UID FETCH for all uids and yield (uid, data) for each message as soon as it is read
+
+        The time waiting for each message is observed in the phase metric. When
+        the caller stops before the end, the rest of the response is read so
+        the session can run the next command.
+        """
+        mailbox = self.mailbox
+        wanted = UidSet(uids)
+        started = time.perf_counter()
+        mailbox.untagged_responses.pop('FETCH', None)
+        tag = mailbox._command('UID', 'FETCH', uid_set(uids), items)
+        response = []
+        try:
+            while mailbox.tagged_commands[tag] is None:
+                mailbox._get_response()
+                for part in mailbox.untagged_responses.pop('FETCH', []):
+                    response.append(part)
+                    if isinstance(part, tuple):
+                        continue
+                    # A bytes element closes the response, literals are read in between
+                    attributes = b' '.join(p[0] if isinstance(p, tuple) else p for p in response)
+                    match = re.search(rb'UID (\d+)', attributes)
+                    if match and match.group(1) in wanted:
+                        metrics.observe(phase, time.perf_counter() - started)
+                        yield match.group(1), response
+                        started = time.perf_counter()
+                    response = []
+        except GeneratorExit:
+            self.finish_command(mailbox, tag)
+            raise
+        typ, data = mailbox.tagged_commands.pop(tag)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"Error on fetching emails: {data}")
+
+    def finish_command(self, mailbox, tag):
+        """Read the rest of the response of a command, the session is dropped if it can't be read"""
+        try:
+            while mailbox.tagged_commands[tag] is None:
+                mailbox._get_response()
+            mailbox.tagged_commands.pop(tag)
+            mailbox.untagged_responses.pop('FETCH', None)
+        except Exception:
+            if mailbox is self.mailbox:
+                self.cleanup(broken=True)
+
+    def fetch_messages(self, uids, part_policy=None):
+        """Yield (uid, data) for each message, without the parts refused by part_policy"""
+        if part_policy is None:
+            yield from self.fetch_stream(uids, self.fetch_items)
+            return
+
+        partial = {}
+        for uid, data in self.fetch_stream(uids, self.fetch_items.replace('BODY.PEEK[]', STRUCTURE_ITEMS), 'bodystructure'):
+            self.structureResponse(uid, data, part_policy, partial)
+
+        complete = [uid for uid in uids if uid not in partial]
+        if complete:
+            yield from self.fetch_stream(complete, self.fetch_items)
+        for uid, (structure, skipped, response) in partial.items():
+            self.partial_uids.add(uid)
+            # The flags and labels are read from the BODYSTRUCTURE response
+            yield uid, self.fetch_selective(uid, structure, skipped) + response
+
+    def structureResponse(self, uid, data, part_policy, partial):
+        """Add the message of a BODYSTRUCTURE response to partial if part_policy refuses some of its parts"""
+        attributes = fetch_attributes(data)
+        structure = attributes.get(b'BODYSTRUCTURE')
+        # Without a Message-Id, the folder is named after the hash of the full message, it is fetched in full
+        if not structure or not has_message_id(attributes.get(b'BODY[HEADER.FIELDS (MESSAGE-ID)]')):
+            return
+        structure = parse_bodystructure(structure)
+        skipped = part_policy.skipped(structure)
+        if skipped:
+            # Without the header literal, only the flags and labels are read from this response
+            partial[uid] = (structure, skipped, [part[0] if isinstance(part, tuple) else part for part in data])
+
+    def fetch_selective(self, uid, structure, skipped):
+        """Fetch the sections of a message except the skipped ones, the result looks like a BODY[] response"""
+        attributes = {}
+        for _, data in self.fetch_stream([uid], '(%s)' % ' '.join(fetch_items(structure, skipped))):
+            attributes = fetch_attributes(data)
+        return self.selectiveResponse(uid, structure, skipped, attributes)
+
+    def selectiveResponse(self, uid, structure, skipped, attributes):
+        """The message rebuilt from the fetched sections, as a BODY[] response"""
+        source = {
+            'uid': int(uid),
+            'uidvalidity': self.uidvalidity,
+            'account': self.name or '',
+            'folder': self.remote_folder
+        }
+        raw = build_message(structure, attributes, skipped, source)
+        return [(b'%s (UID %s BODY[] {%d}' % (uid, uid, len(raw)), raw), b')']
+
+    def copy_emails(self, days, local_folder, batch_size=FETCH_BATCH_SIZE, batch_bytes=None, prescan=True,
+                    incremental=True, part_policy=None, attachment_store=None, storage='folders', raw_codec=None):
 
-        uids = self.search_emails(criterion)
+        n_saved = 0
+        n_exists = 0
+        failed = []
+
+        self.local_folder = local_folder
+        self.attachment_store = attachment_store
+        self.raw_codec = raw_codec
+        self.segments = get_segment_store(local_folder) if storage == 'segments' else None
+
+        with metrics.timer('search'):
+            uids, last_uid = self.search_new_emails(self.search_criterion(days), incremental)
+        synced_uid = last_uid
+        last_uid = self.searched_uid(last_uid, uids)
         if uids is not None and uids is not []:
-            print("Copying emails...")
-            total = len(uids)
-            for idx, num in enumerate(uids):
+            sizes = None
+            if prescan:
+                try:
+                    missing, sizes = self.prescan_emails(uids)
+                    n_exists += len(uids) - len(missing)
+                    uids = missing
+                except (ConnectionResetError, imaplib.IMAP4.abort) as e:
+                    print(f"Connection error while scanning headers: {e}. Fetching all emails...")
+                    self.connect_to_imap()
+
+            if uids:
+                print("Copying emails...")
+            progress = Progress(len(uids))
+            idx = 0
+            for batch in self.fetch_batches(uids, batch_size, batch_bytes, sizes):
+                pending = list(batch)
                 fetch_retries = 0
-                while fetch_retries < MAX_RETRIES:
+                # After an error in a batch, its remaining messages are fetched one by one
+                single = False
+                while pending and fetch_retries < MAX_RETRIES:
+                    fetching = pending[:1] if single else pending
                     try:
-                        typ, data = self.mailbox.fetch(num, '(BODY.PEEK[])')
-                        print('\r{0:.2f}%'.format(idx*100/total), end='')
-                        if self.saveEmail(data):
-                            n_saved += 1
-                        else:
-                            n_exists += 1
-                        break
+                        for uid, data in self.fetch_messages(fetching, part_policy):
+                            idx += 1
+                            pending.remove(uid)
+                            try:
+                                if self.saveEmail(data):
+                                    n_saved += 1
+                                else:
+                                    n_exists += 1
+                            except Exception as e:
+                                print(f"Error while saving email: {e}. Skipping...")
+                                failed.append(uid)
+                            progress.update(idx)
+                        if not single:
+                            break
+                        # Not returned by the server, expunged since the search
+                        if fetching[0] in pending:
+                            pending.remove(fetching[0])
                     except ConnectionResetError as e:
                         print(f"Connection error while fetching email: {e}. Retrying...")
                         self.connect_to_imap()
                         fetch_retries += 1
                     except imaplib.IMAP4.abort as e:
-                        print(f"Abort error while fetching email: {e}. Skipping...")
+                        print(f"Abort error while fetching email: {e}. Retrying...")
                         self.connect_to_imap()
-                        break
+                        fetch_retries += 1
                     except Exception as e:
-                        print(f"Error while fetching email: {e}. Skipping...")
-                        break
+                        # The stream may have stopped in the middle of a response
+                        if single and fetching[0] in pending:
+                            print(f"Error while fetching email {fetching[0].decode()}: {e}. Skipping...")
+                            pending.remove(fetching[0])
+                            failed.append(fetching[0])
+                        else:
+                            print(f"Error while fetching emails: {e}. Fetching them one by one...")
+                        single = True
+                        self.connect_to_imap()
                 if fetch_retries == MAX_RETRIES:
                     print("\nMaximum retries reached. Exiting...")
                     exit(1)
-            print("\rDone.")
+            progress.finish()
+            if uids:
+                print("Done.")
+        try:
+            n_flags = self.sync_flags(incremental, synced_uid)
+            if n_flags:
+                print("{} emails with new flags".format(n_flags))
+        except Exception as e:
+            print(f"Error while synchronizing flags: {e}. They are all fetched on the next run...")
+            self.highestmodseq = None
+        self.save_sync_state(incremental, last_uid, failed)
+        metrics.count('emails_saved', n_saved)
+        metrics.count('emails_existing', n_exists)
+        metrics.count('emails_failed', len(failed))
         return (n_saved, n_exists)
 
-    def cleanup(self):
-        self.mailbox.close()
-        self.mailbox.logout()
+    def cleanup(self, broken=False):
+        """Give the session back to the pool or log out, a broken session is closed without a command"""
+        mailbox, self.mailbox = self.mailbox, None
+        if mailbox is None:
+            return
+        if self.pool is not None:
+            if broken:
+                self.pool.discard(mailbox)
+            else:
+                self.pool.release(mailbox)
+            return
+        if broken:
+            mailbox.shutdown()
+            return
+        mailbox.close()
+        mailbox.logout()
 
 
-    def getEmailFolder(self, msg, data):
+    def getEmailFolder(self, msg, data=None):
         # 255is the max filename length on all systems
         if msg['Message-Id'] and len(msg['Message-Id']) < 255:
             foldername = re.sub(r'[^a-zA-Z0-9_\-\.() ]+', '', msg['Message-Id'])
+        elif data is None:
+            # Headers only, the folder name can't be known before the full message is fetched
+            return None
         else:
             foldername = hashlib.sha224(data).hexdigest()
 
@@ -146,66 +548,386 @@ class MailboxClient:
 
 
 
+    def isArchived(self, directory, msg, uid=None, size=None, gmail_id=None):
+        if self.index is not None and (directory in self.index or (gmail_id and self.index.has_gmail_id(gmail_id))):
+            return True
+        in_segments = self.segments is not None and self.segments.key(directory) in self.segments
+        if not in_segments and not os.path.exists(directory):
+            return False
+        # Archived before the index existed
+        self.recordEmail(directory, msg, uid, size)
+        return True
+
+    def recordEmail(self, directory, msg, uid=None, size=None, gmail_id=None, properties=None):
+        if self.index is None:
+            return
+        message_id = msg['Message-Id'] if msg['Message-Id'] and len(msg['Message-Id']) < 255 else None
+        self.index.add(directory,
+                       message_id=message_id,
+                       sha224=None if message_id else os.path.basename(directory),
+                       account=self.name,
+                       folder=self.remote_folder,
+                       uid=int(uid) if uid else None,
+                       size=size,
+                       date=utc_date(msg['Date']),
+                       gmail_id=gmail_id,
+                       properties=properties)
+
     def saveEmail(self, data):
         for response_part in data:
             if isinstance(response_part, tuple):
-                msg = ""
-                # Handle Python version differences:
-                # Python 2 imaplib returns bytearray, Python 3 imaplib
-                # returns str.
-                if isinstance(response_part[1], str):
-                    msg = email.message_from_string(response_part[1])
-                else:
-                    try:
-                        msg = email.message_from_string(response_part[1].decode("utf-8"))
-                    except:
-                        # print("couldn't decode message with utf-8 - trying 'ISO-8859-1'")
-                        msg = email.message_from_string(response_part[1].decode("ISO-8859-1"))
+                # The pipeline parses the full message in another process
+                metrics.count('fetched_bytes', len(response_part[1]))
+                with metrics.timer('parse'):
+                    msg = message_from_bytes(response_part[1], headersonly=self.pipeline is not None and self.segments is None)
 
                 directory = self.getEmailFolder(msg, data[0][1])
-
-                if os.path.exists(directory):
+                uid = re.search(rb'UID (\d+)', data[0][0])
+                uid = uid.group(1) if uid else None
+                properties = message_properties(data)
+                raw_codec = self.raw_codec
+                if uid in self.partial_uids:
+                    self.partial_uids.discard(uid)
+                    raw_codec = (raw_codec or RawCodec()).as_partial()
+                gmail_id = properties.get('GmailId')
+
+                if self.isArchived(directory, msg, uid, len(data[0][1]), gmail_id):
                     return False
 
-                os.makedirs(directory)
+                # Without specific_folders, the folder jobs of several accounts may save the same message at the same time
+                if self.segments is not None:
+                    return self.appendSegment(directory, msg, data[0][1], properties, uid, gmail_id)
 
                 try:
-                    message = Message(directory, msg)
-                    message.createRawFile(data[0][1])
-                    message.createMetaFile()
-                    message.extractAttachments()
-
-                    if self.wkhtmltopdf:
-                        message.createPdfFile(self.wkhtmltopdf)
-
-                except Exception as e:
-                    # ex: Unsupported charset on decode
-                    if hasattr(e, 'strerror'):
-                        if e.strerror is not None:
-                            print(directory)
-                            print("MailboxClient.saveEmail() failed:", e.strerror)
-                    else:
-                        print("MailboxClient.saveEmail() failed")
-                        print(e)
+                    os.makedirs(directory)
+                except FileExistsError:
+                    return False
+                self.recordEmail(directory, msg, uid, len(data[0][1]), gmail_id)
+
+                if self.pipeline is not None:
+                    self.processing.append(self.pipeline.submit(directory, data[0][1], self.attachment_store,
+                                                                self.messageSaved, properties, raw_codec))
+                else:
+                    self.messageSaved(directory, process_message(directory, msg, data[0][1], self.attachment_store,
+                                                                 properties, raw_codec))
+
+        return True
+
+    def appendSegment(self, directory, msg, data, properties=None, uid=None, gmail_id=None):
+        """Store a message in its segment, return False if it was already stored"""
+        date = email.utils.parsedate_tz(msg['Date']) if msg['Date'] else None
+        segment = '%04d-%02d' % date[:2] if date else 'None'
+        if not self.segments.add(self.segments.key(directory), segment, data, self.raw_codec):
+            return False
+        self.recordEmail(directory, msg, uid, len(data), gmail_id, properties)
 
+        # Only the raw message is stored, the metadata is needed for the search index and the export
+        if (self.index is not None and self.index.fulltext) or self.export is not None:
+            try:
+                self.messageSaved(directory, Message(directory, msg, properties).getMetadata())
+            except Exception as e:
+                print("MailboxClient.appendSegment() failed")
+                print(e)
         return True
 
+    def messageSaved(self, directory, metadata):
+        if metadata is not None:
+            if self.index is not None:
+                self.index.add_text(directory, metadata)
+            if self.export is not None:
+                self.export.add(directory, metadata)
+        if self.renderer is not None:
+            self.renderer.submit(directory)
+
+    def saveProperties(self, data):
+        """Update the flags and labels of the archived messages from FETCH responses, return the number updated"""
+        directories = self.index.get_uids(self.name, self.remote_folder)
+        n_updated = 0
+        for response in split_fetch_responses(data):
+            uid = re.search(rb'UID (\d+)', b' '.join(response))
+            properties = message_properties(response)
+            directory = directories.get(int(uid.group(1))) if uid else None
+            if directory is not None and properties and self.updateProperties(directory, properties):
+                n_updated += 1
+        metrics.count('flags_updated', n_updated)
+        return n_updated
+
+    def updateProperties(self, directory, properties):
+        metadata_path = os.path.join(directory, 'metadata.json')
+        if not os.path.exists(metadata_path):
+            # Stored in a segment, there is no metadata file
+            return self.updateSegmentProperties(directory, properties)
+        with io.open(metadata_path, 'r', encoding='utf8') as json_file:
+            metadata = json.load(json_file)
+        if all(metadata.get(name) == value for name, value in properties.items()):
+            return False
+        metadata.update(properties)
+        with io.open(metadata_path + '.tmp', 'w', encoding='utf8') as json_file:
+            json_file.write(json.dumps(metadata, indent=4, ensure_ascii=False))
+        os.replace(metadata_path + '.tmp', metadata_path)
+        if self.export is not None:
+            self.export.add(directory, metadata)
+        return True
+
+    def updateSegmentProperties(self, directory, properties):
+        """The flags and labels of a message stored in a segment are kept in the index"""
+        if self.segments is None or self.segments.key(directory) not in self.segments:
+            return False
+        stored = self.index.get_properties(directory) or {}
+        if all(stored.get(name) == value for name, value in properties.items()):
+            return False
+        stored.update(properties)
+        self.index.set_properties(directory, stored)
+        if self.export is not None:
+            msg = message_from_bytes(self.segments.read(self.segments.key(directory)))
+            self.export.add(directory, Message(directory, msg, stored).getMetadata())
+        return True
 
-def save_emails(account, options):
-    mailbox = MailboxClient(account['host'], account['port'], account['username'], account['password'], account['remote_folder'], account['ssl'])
-    stats = mailbox.copy_emails(options['days'], options['local_folder'], options['wkhtmltopdf'])
+    def fetchSkippedMessages(self, entries):
+        """Replace the messages archived without their skipped parts by the full messages, return the number fetched
+
+        entries maps the directory of each message to one of the Skipped parts
+        of its metadata, the messages are found with their Uid in this folder
+        and fetched with a single command.
+        """
+        directories = {}
+        for directory, entry in sorted(entries.items()):
+            if int(entry['UidValidity']) != self.uidvalidity:
+                print("{}: UIDVALIDITY of folder {} changed, the message can't be fetched".format(directory, self.remote_folder))
+                continue
+            directories[str(entry['Uid']).encode()] = directory
+
+        n_fetched = 0
+        for uid, data in self.fetch_stream(sorted(directories, key=int), self.fetch_items):
+            directory = directories.pop(uid, None)
+            if directory is not None and self.saveSkippedMessage(directory, uid, data):
+                n_fetched += 1
+        for uid, directory in sorted(directories.items()):
+            print("{}: message {} not found in folder {}".format(directory, uid.decode(), self.remote_folder))
+        return n_fetched
+
+    def saveSkippedMessage(self, directory, uid, data):
+        """Write again the files of a message fetched in full, its index row, text and export line are updated"""
+        # getEmailFolder() checks the message is the archived one, the folder is <local_folder>/<year>/<id>
+        self.local_folder = os.path.dirname(os.path.dirname(directory))
+        msg = message_from_bytes(data[0][1])
+        if self.getEmailFolder(msg, data[0][1]) != directory:
+            print("{}: message {} of folder {} is another message".format(directory, uid.decode(), self.remote_folder))
+            return False
+        properties = message_properties(data)
+        metadata = process_message(directory, msg, data[0][1], self.attachment_store, properties, self.raw_codec)
+        if metadata is None:
+            return False
+        self.recordEmail(directory, msg, uid, len(data[0][1]), properties.get('GmailId'))
+        self.messageSaved(directory, metadata)
+        return True
+
+
+def process_message(directory, msg, data, attachment_store=None, properties=None, raw_codec=None):
+    """Write the files of a message, return its metadata or None if it failed"""
+    try:
+        message = Message(directory, msg, properties)
+        with metrics.timer('raw'):
+            message.createRawFile(data, raw_codec)
+        with metrics.timer('metadata'):
+            message.createMetaFile()
+        with metrics.timer('attachments'):
+            message.extractAttachments(get_store(attachment_store))
+
+        return message.metadata
+
+    except Exception as e:
+        # ex: Unsupported charset on decode
+        if hasattr(e, 'strerror'):
+            if e.strerror is not None:
+                print(directory)
+                print("MailboxClient.saveEmail() failed:", e.strerror)
+        else:
+            print("MailboxClient.saveEmail() failed")
+            print(e)
+
+
+def has_message_id(headers):
+    """If a header block has a Message-Id usable as a folder name, see getEmailFolder()"""
+    if not headers:
+        return False
+    msg = message_from_bytes(headers, headersonly=True)
+    return bool(msg['Message-Id']) and len(msg['Message-Id']) < 255
+
+
+def uid_set(uids):
+    """Build a compact IMAP sequence set like 1:4,7,9:12 from a list of UIDs"""
+    return str(UidSet(uids))
+
+
+def check_esearch(data):
+    """UidSet of an ESEARCH response, checked against its COUNT"""
+    uids, count = parse_esearch(data)
+    if count is not None and count != len(uids):
+        raise imaplib.IMAP4.error(f"ESEARCH returned {len(uids)} UIDs instead of {count}")
+    return uids
+
+
+def message_properties(data):
+    """Metadata of a FETCH response known from the server only: Flags, and Labels and GmailId with Gmail"""
+    attributes = fetch_attributes(data)
+    properties = {}
+    if isinstance(attributes.get(b'FLAGS'), list):
+        properties['Flags'] = [flag.decode('utf-8', 'replace') for flag in attributes[b'FLAGS'] if flag]
+    if isinstance(attributes.get(b'X-GM-LABELS'), list):
+        properties['Labels'] = [decode_utf7(label.decode('utf-8', 'replace')) for label in attributes[b'X-GM-LABELS'] if label]
+    if isinstance(attributes.get(b'X-GM-MSGID'), bytes):
+        properties['GmailId'] = attributes[b'X-GM-MSGID'].decode()
+    return properties
+
+
+def decode_utf7(value):
+    """Decode the modified UTF-7 of IMAP folder names, also used by Gmail labels"""
+    def decode(match):
+        if not match.group(1):
+            return '&'
+        encoded = match.group(1).replace(',', '/')
+        return base64.b64decode(encoded + '=' * (-len(encoded) % 4)).decode('utf-16-be')
+    return re.sub(r'&([^-]*)-', decode, value)
+
+
+def split_fetch_responses(data):
+    """Group imaplib FETCH data into one list per message, literals are (header, payload) tuples"""
+    response = []
+    for part in data:
+        if isinstance(part, tuple):
+            response.append(part[0])
+            continue
+        if part:
+            response.append(part)
+        if response:
+            yield response
+        response = []
+
+
+def parse_sizes(data):
+    """RFC822.SIZE of each UID in a FETCH response"""
+    sizes = {}
+    for response in split_fetch_responses(data):
+        attributes = b' '.join(response)
+        uid = re.search(rb'UID (\d+)', attributes)
+        size = re.search(rb'RFC822\.SIZE (\d+)', attributes)
+        if uid and size:
+            sizes[uid.group(1)] = int(size.group(1))
+    return sizes
+
+
+def save_emails(account, options, index=None, pool=None, pipeline=None, renderer=None, export=None):
+    metrics.labels.set((account.get('name'), account['remote_folder']))
+    mailbox = MailboxClient(account['host'], account['port'], account['username'], account['password'], account['remote_folder'], account['ssl'],
+                            account.get('name'), index, pool, pipeline, renderer, export, is_gmail(account))
+    try:
+        stats = mailbox.copy_emails(options['days'], options['local_folder'],
+                                    options['fetch_batch_size'], options['fetch_batch_bytes'], options['prescan'],
+                                    options['incremental'], get_part_policy(options), options['attachment_store'], options['storage'],
+                                    options.get('raw_codec'))
+    except BROKEN_SESSION_ERRORS:
+        mailbox.cleanup(broken=True)
+        raise
+    except BaseException:
+        # An error reported by the server, the session can be used again
+        mailbox.cleanup()
+        raise
     mailbox.cleanup()
     if stats[0] == 0 and stats[1] == 0:
-        print('Folder {} is empty'.format(account['remote_folder']))
+        print('No new emails in folder {}'.format(account['remote_folder']))
     else:
         print('{} emails created, {} emails already exists'.format(stats[0], stats[1]))
 
 
-def get_folder_fist(account):
+def is_gmail(account):
+    """The gmail account option, a string when it comes from a DSN"""
+    return str(account.get('gmail', False)).lower() == 'true'
+
+
+def find_all_mail(folder_list):
+    """Name of the Gmail "All Mail" folder in a LIST response, it has the \\All special-use attribute"""
+    for folder_entry in folder_list:
+        if re.match(rb'^\([^)]*\\All\b', folder_entry):
+            return folder_entry
+    return None
+
+
+def get_part_policy(options):
+    if options['attachment_max_size'] is None and not options['attachment_types'] and not options['attachment_types_exclude']:
+        return None
+    return PartPolicy(options['attachment_max_size'], options['attachment_types'], options['attachment_types_exclude'])
+
+
+def extract_segments(root, paths=None, month=None, attachment_store=None, raw_codec=None, index=None):
+    """Write the classic message folders of the messages stored in segments, return the number written
+
+    The flags and labels of the messages are read from the index, when given.
+    """
+    n_extracted = 0
+    for store in find_stores(root):
+        for key in store.keys(month):
+            directory = os.path.join(store.local_folder, key)
+            if paths and os.path.relpath(directory, root).replace(os.sep, '/') not in paths:
+                continue
+            if os.path.exists(directory):
+                continue
+            data = store.read(key)
+            os.makedirs(directory)
+            properties = index.get_properties(directory) if index is not None else None
+            process_message(directory, message_from_bytes(data), data, attachment_store, properties, raw_codec)
+            n_extracted += 1
+    return n_extracted
+
+
+def fetch_skipped(account, local_folder, pool=None, index=None, export=None, attachment_store=None, raw_codec=None):
+    """Download in full the messages of an account archived in local_folder without the parts skipped by the attachment policy
+
+    Their partial raw message is replaced, their files are written again like
+    for a new message, return the number of messages downloaded.
+    """
+    folders = {}
+    for directory, dirnames, filenames in os.walk(local_folder):
+        if 'metadata.json' not in filenames:
+            continue
+        dirnames[:] = []
+        with io.open(os.path.join(directory, 'metadata.json'), 'r', encoding='utf8') as json_file:
+            metadata = json.load(json_file)
+        for entry in metadata.get('Skipped', []):
+            if entry['Account'] == (account.get('name') or ''):
+                # All the parts come from the same message
+                folders.setdefault(entry['Folder'], {})[directory] = entry
+                break
+
+    n_fetched = 0
+    for folder, entries in sorted(folders.items()):
+        mailbox = MailboxClient(account['host'], account['port'], account['username'], account['password'], folder, account['ssl'],
+                                account.get('name'), index, pool, export=export, gmail=is_gmail(account))
+        mailbox.attachment_store = attachment_store
+        mailbox.raw_codec = raw_codec
+        try:
+            n_fetched += mailbox.fetchSkippedMessages(entries)
+        except BROKEN_SESSION_ERRORS:
+            mailbox.cleanup(broken=True)
+            raise
+        except BaseException:
+            mailbox.cleanup()
+            raise
+        mailbox.cleanup()
+    return n_fetched
+
+
+def get_folder_fist(account, pool=None):
+    if pool is not None:
+        mailbox = pool.acquire()
+        try:
+            return mailbox.list()[1]
+        finally:
+            pool.release(mailbox)
     if not account['ssl']:
         mailbox = imaplib.IMAP4(account['host'], account['port'])
     else:
-        mailbox = imaplib.IMAP4_SSL(account['host'], account['port'])
+        mailbox = imaplib.IMAP4_SSL(account['host'], account['port'], ssl_context=ssl_context())
     mailbox.login(account['username'], account['password'])
     folder_list = mailbox.list()[1]
     mailbox.logout()
@@ -3,29 +3,29 @@
 
 
 import email
+import email.parser
+import email.policy
 from email.utils import parseaddr
 from email.header import decode_header
 import re
 import os
-import signal
 import posixpath
-import sys
 import json
 import io
 import mimetypes
-import chardet
-import gzip
 import html
 import time
-import pkgutil
 
 from six.moves import html_parser
 
-# import pdfkit if its loader is available
-has_pdfkit = pkgutil.find_loader('pdfkit') is not None
-if has_pdfkit: import pdfkit
+from bodystructure import SKIPPED_HEADER
+from charsets import detect_charset
+from metrics import metrics
+from rawcodec import RawCodec
 
-TIMEOUT_SECONDS = 120
+PARSE_CHUNK_SIZE = 64 * 1024
+# Characters of text kept from an html body, for the metadata of the messages without a text part
+HTML_TEXT_MAX_SIZE = 1024 * 1024
 
 # email address REGEX matching the RFC 2822 spec
 # from perlfaq9
@@ -54,30 +54,116 @@ email_address_re=re.compile('^'+addr_spec+'$')
 
 
 
+class Utf8HeadersPolicy(email.policy.Compat32):
+    """compat32 policy returning 8-bit header values decoded as utf-8, or ISO-8859-1 if it fails"""
+
+    def header_fetch_parse(self, name, value):
+        if isinstance(value, str) and not value.isascii():
+            # Parsed from bytes, the non-ascii bytes are kept as surrogates
+            raw = value.encode('ascii', 'surrogateescape')
+            try:
+                value = raw.decode('utf-8')
+            except UnicodeDecodeError:
+                value = raw.decode('ISO-8859-1')
+        return email.policy.Compat32.header_fetch_parse(self, name, value)
+
+utf8_headers = Utf8HeadersPolicy()
+
+header_end_re = re.compile(rb'\r?\n\r?\n')
+body_start_re = re.compile(r'<body[^>]*>', re.I)
+body_end_re = re.compile(r'</body>', re.I)
+
+
+def message_from_bytes(data, headersonly=False):
+    """Parse a raw message without decoding it to a string first"""
+    if headersonly:
+        # Only the header block is copied
+        match = header_end_re.search(data)
+        if match:
+            data = data[:match.end()]
+        return email.parser.BytesParser(policy=utf8_headers).parsebytes(data, headersonly=True)
+
+    # Fed by chunks, the message is never decoded to a single string
+    parser = email.parser.BytesFeedParser(policy=utf8_headers)
+    view = memoryview(data)
+    for start in range(0, len(view), PARSE_CHUNK_SIZE):
+        parser.feed(view[start:start + PARSE_CHUNK_SIZE].tobytes())
+    return parser.close()
+
+
 class MLStripper(html_parser.HTMLParser):
     def __init__(self):
         self.reset()
         self.fed = []
+        self.size = 0
     def convert_charrefs(x):
         return x
     def handle_data(self, d):
         self.fed.append(d)
+        self.size += len(d)
     def get_data(self):
         return ''.join(self.fed)
 
-def strip_tags(html):
+def strip_tags(html, limit=HTML_TEXT_MAX_SIZE):
+    """Text of an html body, cut at limit characters
+
+    It is not extracted with rewrite_cids(), only the messages without a text
+    part need it.
+    """
     s = MLStripper()
-    s.feed(html)
-    return s.get_data()
+    if limit is None or len(html) <= limit:
+        # The text is never longer than the html
+        s.feed(html)
+        return s.get_data()
+    # Fed by chunks, the parsing stops once the limit is reached
+    for start in range(0, len(html), PARSE_CHUNK_SIZE):
+        s.feed(html[start:start + PARSE_CHUNK_SIZE])
+        if s.size >= limit:
+            break
+    return s.get_data()[:limit]
+
+
+def extract_body(content):
+    """Content of the body element, from the first <body> tag to the last </body> tag, or the whole content"""
+    start = body_start_re.search(content)
+    if start is None:
+        return content
+    end = None
+    for end in body_end_re.finditer(content, start.end() + 1):
+        pass
+    if end is None:
+        return content
+    return content[start.end():end.start()]
+
+
+def rewrite_cids(content, embed):
+    """Replace the cid: sources of the embedded images by their path in the attachments folder, in one pass"""
+    paths = {}
+    for content_id, filename in embed:
+        # Content ids are compared ignoring the case, the first image of an id wins
+        paths.setdefault(content_id.lower(), 'src="%s"' % posixpath.join('attachments', filename))
+    if not paths:
+        return content
+    def replace(match):
+        content_id = match.group(1).lower()
+        if content_id not in paths:
+            # Only equal for the regex, like the long s and s
+            content_id = next(key for key in paths if re.fullmatch(re.escape(key), match.group(1), re.I))
+        return paths[content_id]
+
+    pattern = r'src=["\']cid:(%s)["\']' % '|'.join(re.escape(content_id) for content_id, filename in embed)
+    return re.sub(pattern, replace, content, 0, re.S | re.I)
 
 
 
 class Message:
     """Operation on a message"""
 
-    def __init__(self, directory, msg):
+    def __init__(self, directory, msg, properties=None):
         self.msg = msg
         self.directory = directory
+        # Metadata known from the IMAP server only, like the Flags or the Gmail Labels
+        self.properties = properties or {}
 
     def getmailheader(self, header_text, default="ascii"):
         """Decode header_text if needed"""
@@ -92,6 +178,9 @@ class Message:
                 headers[i]=text
                 if charset:
                     headers[i]=str(text, charset)
+                elif isinstance(text, bytes):
+                    # Unencoded text next to encoded words
+                    headers[i]=text.decode('raw-unicode-escape')
                 else:
                     headers[i]=str(text)
             return u"".join(headers)
@@ -145,7 +234,10 @@ class Message:
 
         return (rfc2822, iso8601)
 
-    def createMetaFile(self):
+    def getMetadata(self):
+        if hasattr(self, 'metadata'):
+            return self.metadata
+
         tos=self.getmailaddresses('to')
         ccs=self.getmailaddresses('cc')
 
@@ -154,6 +246,20 @@ class Message:
         for afile in parts['files']:
             attachments.append(afile[1])
 
+        skipped = []
+        for part, filename in parts['skipped']:
+            source = dict(part.get_params(header=SKIPPED_HEADER)[1:])
+            skipped.append({
+                'Filename': filename,
+                'ContentType': part.get_content_type(),
+                'Size': int(source.get('size', 0)),
+                'Section': source.get('section'),
+                'Uid': int(source.get('uid', 0)),
+                'UidValidity': int(source.get('uidvalidity', 0)),
+                'Account': source.get('account', ''),
+                'Folder': source.get('folder')
+            })
+
         text_content = ''
 
         if parts['text']:
@@ -164,20 +270,27 @@ class Message:
 
         rfc2822, iso8601 = self.normalizeDate(self.msg['Date'])
 
+        self.metadata = {
+            'Id': self.msg['Message-Id'],
+            'Subject' : self.getSubject(),
+            'From' : self.getFrom(),
+            'To' : tos,
+            'Cc' : ccs,
+            'Date' : rfc2822,
+            'Utc' : iso8601,
+            'Attachments': attachments,
+            'Skipped': skipped,
+            'WithHtml': len(parts['html']) > 0,
+            'WithText': len(parts['text']) > 0,
+            'Body': text_content
+        }
+        self.metadata.update(self.properties)
+        return self.metadata
+
+
+    def createMetaFile(self):
         with io.open('%s/metadata.json' %(self.directory), 'w', encoding='utf8') as json_file:
-            data = json.dumps({
-                'Id': self.msg['Message-Id'],
-                'Subject' : self.getSubject(),
-                'From' : self.getFrom(),
-                'To' : tos,
-                'Cc' : ccs,
-                'Date' : rfc2822,
-                'Utc' : iso8601,
-                'Attachments': attachments,
-                'WithHtml': len(parts['html']) > 0,
-                'WithText': len(parts['text']) > 0,
-                'Body': text_content
-            }, indent=4, ensure_ascii=False)
+            data = json.dumps(self.getMetadata(), indent=4, ensure_ascii=False)
 
             json_file.write(data)
 
@@ -186,25 +299,18 @@ class Message:
 
 
 
-    def createRawFile(self, data):
-        f = gzip.open('%s/raw.eml.gz' %(self.directory), 'wb')
-        f.write(data)
-        f.close()
+    def createRawFile(self, data, codec=None):
+        (codec or RawCodec()).write(self.directory, data)
 
 
-    def getPartCharset(self, part):
+    def getPartCharset(self, part, payload=None):
         if part.get_content_charset() is None:
-            # Python 2 chardet expects a string,
-            # Python 3 chardet expects a bytearray.
-            if sys.version_info[0] < 3:
-                return chardet.detect(part.as_string())['encoding']
-            else:
-                try:
-                    return chardet.detect(part.as_bytes())['encoding']
-                except UnicodeEncodeError:
-                        string = part.as_string()
-                        array = bytearray(string, 'utf-8')
-                        return chardet.detect(array)['encoding']
+            # Detect on the decoded payload, the part is not serialized again
+            if payload is None:
+                payload = part.get_payload(decode=True) or b''
+            sender = parseaddr(self.msg['From'] or '')[1]
+            with metrics.timer('charset'):
+                return detect_charset(payload, sender.rpartition('@')[2].lower() or None)
         return part.get_content_charset()
 
 
@@ -213,7 +319,7 @@ class Message:
             self.text_content = ''
             for part in parts:
                 raw_content = part.get_payload(decode=True)
-                charset = self.getPartCharset(part)
+                charset = self.getPartCharset(part, raw_content)
                 self.text_content += raw_content.decode(charset, "replace")
         return self.text_content
 
@@ -229,22 +335,16 @@ class Message:
 
             for part in parts:
                 raw_content = part.get_payload(decode=True)
-                charset = self.getPartCharset(part)
+                charset = self.getPartCharset(part, raw_content)
                 self.html_content += raw_content.decode(charset, "replace")
 
-            m = re.search(r'<body[^>]*>(.+)<\/body>', self.html_content, re.S | re.I)
-            if (m != None):
-                self.html_content = m.group(1)
+            self.html_content = extract_body(self.html_content)
 
         return self.html_content
 
 
     def createHtmlFile(self, parts, embed):
-        utf8_content = self.getHtmlContent(parts)
-        for img in embed:
-            pattern = r'src=["\']cid:%s["\']' % (re.escape(img[0]))
-            path = posixpath.join('attachments', img[1])
-            utf8_content = re.sub(pattern, 'src="%s"' % (path), utf8_content, 0, re.S | re.I)
+        utf8_content = rewrite_cids(self.getHtmlContent(parts), embed)
 
 
         subject = self.getSubject()
@@ -278,7 +378,8 @@ class Message:
                 'text': [],
                 'html': [],
                 'embed_images': [],
-                'files': []
+                'files': [],
+                'skipped': []
             }
 
 
@@ -308,6 +409,12 @@ class Message:
 
                 filename = self.sanitizeFilename(filename)
 
+                if part[SKIPPED_HEADER]:
+                    # Not downloaded, see fetch-skipped
+                    counter += 1
+                    message_parts['skipped'].append((part, filename))
+                    continue
+
                 content_id =part.get('Content-Id')
                 if (content_id):
                     content_id = content_id[1:][:-1]
@@ -319,7 +426,7 @@ class Message:
         return self.message_parts
 
 
-    def extractAttachments(self):
+    def extractAttachments(self, store=None):
         message_parts = self.getParts()
 
         if message_parts['text']:
@@ -329,33 +436,18 @@ class Message:
             self.createHtmlFile(message_parts['html'], message_parts['embed_images'])
 
         if message_parts['files']:
-            attdir = os.path.join(self.directory, 'attachments')
-            if not os.path.exists(attdir):
-                os.makedirs(attdir)
-            for afile in message_parts['files']:
-                with open(os.path.join(attdir, afile[1]), 'wb') as fp:
-                    payload = afile[0].get_payload(decode=True)
-                    if payload:
-                        fp.write(payload)
-
-
-    def createPdfFile(self, wkhtmltopdf):
-        if has_pdfkit:
-            html_path = os.path.join(self.directory, 'message.html')
-            pdf_path = os.path.join(self.directory, 'message.pdf')
-            config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf)
-
-            def timeout_handler(signum, frame):
-                raise TimeoutError("PDF creation timed out.")
-
-            signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(TIMEOUT_SECONDS)
-
-            try:
-                pdfkit.from_file(html_path, pdf_path, configuration=config)
-            except TimeoutError:
-                print("Timeout while creating PDF. wkhtmltopdf was terminated.")
-            finally:
-                signal.alarm(0)
-        else:
-            print("Couldn't create PDF message, since \"pdfkit\" module isn't installed.")
+            self.createAttachmentFiles(message_parts['files'], store)
+
+
+    def createAttachmentFiles(self, files, store=None):
+        attdir = os.path.join(self.directory, 'attachments')
+        if not os.path.exists(attdir):
+            os.makedirs(attdir)
+        for afile in files:
+            payload = afile[0].get_payload(decode=True)
+            if store is not None and payload:
+                store.save(payload, os.path.join(attdir, afile[1]))
+                continue
+            with open(os.path.join(attdir, afile[1]), 'wb') as fp:
+                if payload:
+                    fp.write(payload)
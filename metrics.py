@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import contextlib
+import contextvars
+import datetime
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+# Minimum delay in seconds between two progress lines
+PROGRESS_INTERVAL = 1.0
+
+
+class Metrics:
+    """Counters and duration histograms of a run, per account and folder
+
+    The account and folder of the current job are set in the labels context
+    variable, so the code measuring a phase does not need to know them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.labels = contextvars.ContextVar('labels', default=(None, None))
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        key = (name,) + self.labels.get()
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        key = (name,) + self.labels.get()
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def drain(self):
+        """Return the metrics collected so far and start again from zero, to merge them in another process"""
+        with self.lock:
+            snapshot = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        counters, histograms = snapshot
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in histograms.items():
+                histogram = self.histograms.setdefault(key, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)})
+                histogram['count'] += other['count']
+                histogram['sum'] += other['sum']
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+
+    def report(self, started, finished):
+        """The run as a dict: totals and the metrics of each folder"""
+        folders = {}
+        totals = {'counters': {}, 'phases': {}}
+        with self.lock:
+            for (name, account, folder), value in sorted(self.counters.items(), key=str):
+                entry = folders.setdefault((account, folder), {'account': account, 'folder': folder, 'counters': {}, 'phases': {}})
+                entry['counters'][name] = value
+                totals['counters'][name] = totals['counters'].get(name, 0) + value
+            for (name, account, folder), histogram in sorted(self.histograms.items(), key=str):
+                entry = folders.setdefault((account, folder), {'account': account, 'folder': folder, 'counters': {}, 'phases': {}})
+                entry['phases'][name] = {'count': histogram['count'], 'seconds': round(histogram['sum'], 6),
+                                         'buckets': dict(zip([str(bound) for bound in BUCKETS], histogram['buckets']))}
+                total = totals['phases'].setdefault(name, {'count': 0, 'seconds': 0})
+                total['count'] += histogram['count']
+                total['seconds'] = round(total['seconds'] + histogram['sum'], 6)
+        return {
+            'started': datetime.datetime.utcfromtimestamp(started).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'seconds': round(finished - started, 3),
+            'totals': totals,
+            'folders': list(folders.values())
+        }
+
+    def write_report(self, path, started, finished):
+        write_atomic(path, json.dumps(self.report(started, finished), indent=4))
+
+    def prometheus(self, started, finished):
+        """The metrics in the Prometheus text format, for the textfile collector of the node exporter"""
+        lines = ['# TYPE imapbox_last_run_timestamp_seconds gauge',
+                 'imapbox_last_run_timestamp_seconds %d' % finished,
+                 '# TYPE imapbox_last_run_duration_seconds gauge',
+                 'imapbox_last_run_duration_seconds %.3f' % (finished - started)]
+        with self.lock:
+            names = sorted(set(key[0] for key in self.counters))
+            for name in names:
+                lines.append('# TYPE imapbox_%s_total counter' % name)
+                for (counter, account, folder), value in sorted(self.counters.items(), key=str):
+                    if counter == name:
+                        lines.append('imapbox_%s_total{%s} %d' % (name, prometheus_labels(account, folder), value))
+
+            names = sorted(set(key[0] for key in self.histograms))
+            for name in names:
+                lines.append('# TYPE imapbox_%s_seconds histogram' % name)
+                for (phase, account, folder), histogram in sorted(self.histograms.items(), key=str):
+                    if phase != name:
+                        continue
+                    labels = prometheus_labels(account, folder)
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram['buckets']):
+                        cumulative += count
+                        lines.append('imapbox_%s_seconds_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+                    lines.append('imapbox_%s_seconds_bucket{%s,le="+Inf"} %d' % (name, labels, histogram['count']))
+                    lines.append('imapbox_%s_seconds_sum{%s} %.6f' % (name, labels, histogram['sum']))
+                    lines.append('imapbox_%s_seconds_count{%s} %d' % (name, labels, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, started, finished):
+        write_atomic(path, self.prometheus(started, finished))
+
+
+def prometheus_labels(account, folder):
+    escape = lambda value: str(value or '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return 'account="%s",folder="%s"' % (escape(account), escape(folder))
+
+
+def write_atomic(path, content):
+    """Write a file through a temporary one, a collector never reads it half written"""
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+
+class Progress:
+    """Progress line of a folder, printed at most every PROGRESS_INTERVAL seconds with the rate and the remaining time"""
+
+    def __init__(self, total, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.interval = interval
+        self.started = time.time()
+        self.printed = 0
+        self.shown = False
+
+    def update(self, done):
+        now = time.time()
+        if now - self.printed < self.interval and done < self.total:
+            return
+        self.printed = now
+        rate = done / (now - self.started) if now > self.started else 0
+        eta = datetime.timedelta(seconds=int((self.total - done) / rate)) if rate else '?'
+        print('\r{0:.2f}% {1}/{2}, {3:.1f} emails/s, ETA {4}'.format(done * 100 / self.total if self.total else 100,
+                                                                     done, self.total, rate, eta), end='')
+        self.shown = True
+
+    def finish(self):
+        if self.shown:
+            print()
+
+
+metrics = Metrics()
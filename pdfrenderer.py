@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import contextvars
+import importlib.util
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+# import pdfkit if it is installed
+has_pdfkit = importlib.util.find_spec('pdfkit') is not None
+if has_pdfkit: import pdfkit
+
+TIMEOUT_SECONDS = 120
+
+
+class PdfError(Exception):
+    pass
+
+
+def render_pdf(wkhtmltopdf, html_path, pdf_path, timeout=TIMEOUT_SECONDS):
+    """Run wkhtmltopdf in a subprocess, it is killed after timeout seconds, raise PdfError if it failed"""
+    if not has_pdfkit:
+        raise PdfError("Couldn't create PDF message, since \"pdfkit\" module isn't installed.")
+
+    config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf)
+    command = list(pdfkit.PDFKit(html_path, 'file', configuration=config).command(pdf_path))
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+        raise PdfError("Timeout while creating PDF. wkhtmltopdf was terminated.")
+    if result.returncode != 0:
+        raise PdfError("wkhtmltopdf exited with code {}: {}".format(result.returncode, result.stderr.decode('utf-8', 'replace').strip()))
+    return True
+
+
+def render_message(wkhtmltopdf, directory, timeout=TIMEOUT_SECONDS):
+    """Render the message.pdf of a message folder, return False if it has no message.html"""
+    html_path = os.path.join(directory, 'message.html')
+    if not os.path.exists(html_path):
+        return False
+    with metrics.timer('pdf'):
+        return render_pdf(wkhtmltopdf, html_path, os.path.join(directory, 'message.pdf'), timeout)
+
+
+def pending_messages(root):
+    """Archived message folders with a message.html but no message.pdf yet"""
+    for directory, dirnames, filenames in os.walk(root):
+        if 'message.html' in filenames and 'message.pdf' not in filenames:
+            yield directory
+
+
+class PdfRenderer:
+    """Render message.pdf files in the background while the messages are archived
+
+    At most `workers` wkhtmltopdf processes run at the same time, the messages
+    waiting to be rendered are queued so fetching never waits on rendering.
+    A render may end after the output of its folder job was printed, its
+    failures are printed on the stdout of the renderer creation.
+    """
+
+    def __init__(self, wkhtmltopdf, workers=2, timeout=TIMEOUT_SECONDS):
+        self.wkhtmltopdf = wkhtmltopdf
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max(1, workers))
+        self.stdout = sys.stdout
+        self.lock = threading.Lock()
+        self.rendered = 0
+        self.failed = 0
+
+    def submit(self, directory):
+        # The metrics of the rendering keep the account and folder of the message
+        context = contextvars.copy_context()
+        future = self.executor.submit(context.run, render_message, self.wkhtmltopdf, directory, self.timeout)
+        future.add_done_callback(lambda future: self.done(directory, future))
+
+    def done(self, directory, future):
+        try:
+            if future.result():
+                with self.lock:
+                    self.rendered += 1
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+                print("{}: PDF creation failed: {}".format(directory, e), file=self.stdout, flush=True)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import concurrent.futures
+import contextlib
+import contextvars
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from message import message_from_bytes
+from metrics import metrics
+from mailboxresource import process_message
+
+# Messages waiting for or being processed, per process
+QUEUE_PER_PROCESS = 4
+
+
+def process_raw_message(directory, data, attachment_store=None, properties=None, raw_codec=None, labels=(None, None)):
+    """Parse and save a fetched message in a worker process, return what it printed, the metadata and the metrics"""
+    metrics.labels.set(labels)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        with metrics.timer('parse'):
+            msg = message_from_bytes(data)
+        metadata = process_message(directory, msg, data, attachment_store, properties, raw_codec)
+    return output.getvalue(), metadata, metrics.drain()
+
+
+class MessagePipeline:
+    """Save fetched messages in a pool of processes while the network keeps fetching
+
+    The number of messages waiting for a process is bounded, submit() blocks the
+    fetcher when the processes can't keep up, so memory use stays bounded.
+    """
+
+    def __init__(self, processes, queue_size=None):
+        self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+        self.slots = threading.BoundedSemaphore(queue_size or processes * QUEUE_PER_PROCESS)
+
+    def submit(self, directory, data, attachment_store=None, callback=None, properties=None, raw_codec=None):
+        """Process a message, callback(directory, metadata) is then called in this process
+
+        The callback runs in the context of the caller, so what it prints goes to
+        the output buffer of its job. Return a future done once the callback has
+        returned.
+        """
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(process_raw_message, directory, data, attachment_store, properties,
+                                          raw_codec, metrics.labels.get())
+        except BaseException:
+            self.slots.release()
+            raise
+        finished = concurrent.futures.Future()
+        context = contextvars.copy_context()
+        future.add_done_callback(lambda future: context.run(self.done, directory, future, callback, finished))
+        return finished
+
+    def done(self, directory, future, callback=None, finished=None):
+        self.slots.release()
+        metadata = None
+        try:
+            output, metadata, snapshot = future.result()
+            metrics.merge(snapshot)
+        except Exception as e:
+            output = "MessagePipeline: processing failed: {}\n".format(e)
+        if output:
+            print(output, end='')
+        try:
+            if callback is not None:
+                callback(directory, metadata)
+        finally:
+            if finished is not None:
+                finished.set_result(None)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
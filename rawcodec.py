@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import gzip
+import importlib.util
+import os
+import random
+import re
+import struct
+import threading
+
+# zstd is optional, the raw messages are compressed with gzip without the zstandard package
+has_zstandard = importlib.util.find_spec('zstandard') is not None
+if has_zstandard:
+    import zstandard
+
+COMPRESSIONS = ('gzip', 'zstd')
+RAW_FILENAMES = {'gzip': 'raw.eml.gz', 'zstd': 'raw.eml.zst'}
+# Messages fetched without the parts skipped by the attachment policy, not the message of the server
+PARTIAL_FILENAMES = {'gzip': 'partial.eml.gz', 'zstd': 'partial.eml.zst'}
+DEFAULT_LEVELS = {'gzip': 9, 'zstd': 3}
+# Valid compression_level values, the zstd ones are those of the zstd command
+LEVEL_RANGES = {'gzip': (0, 9), 'zstd': (1, 22)}
+GZIP_MAGIC = b'\x1f\x8b'
+# Folder of the zstd dictionaries, at the root of local_folder
+DICTIONARY_DIRNAME = '.dictionaries'
+DICTIONARY_SIZE = 112 * 1024
+# Messages sampled to train a dictionary, and the minimum number needed
+DICTIONARY_SAMPLES = 2000
+DICTIONARY_MIN_SAMPLES = 100
+# The headers and the start of the body are the parts similar between messages
+SAMPLE_SIZE = 16 * 1024
+
+# zstd compressors are not thread safe, each thread has its own
+_local = threading.local()
+_dictionaries = {}
+
+
+class RawCodec:
+    """Compression of the raw message of a message folder
+
+    Only the settings are kept, so a codec can be given to the processes of
+    the pipeline, the zstd compressor is created once per thread. With zstd,
+    dictionary is the path of a dictionary trained on the messages of the
+    account, see train_dictionary(). A partial codec writes the messages
+    rebuilt without their skipped parts, under PARTIAL_FILENAMES.
+    """
+
+    def __init__(self, compression='gzip', level=None, threads=0, dictionary=None, partial=False):
+        self.compression = compression
+        self.level = level if level is not None else DEFAULT_LEVELS[compression]
+        self.threads = threads
+        self.dictionary = dictionary
+        self.partial = partial
+
+    @property
+    def filename(self):
+        return (PARTIAL_FILENAMES if self.partial else RAW_FILENAMES)[self.compression]
+
+    def as_partial(self):
+        return RawCodec(self.compression, self.level, self.threads, self.dictionary, partial=True)
+
+    def compressor(self):
+        require_zstandard()
+        compressors = _local.__dict__.setdefault('compressors', {})
+        key = (self.level, self.threads, self.dictionary)
+        if key not in compressors:
+            dict_data = load_dictionary(self.dictionary) if self.dictionary else None
+            compressors[key] = zstandard.ZstdCompressor(level=self.level, dict_data=dict_data, threads=self.threads)
+        return compressors[key]
+
+    def compress(self, data):
+        """A gzip member or a zstd frame, a file of several of them is still a valid one"""
+        if self.compression == 'gzip':
+            return gzip.compress(data, compresslevel=self.level)
+        return self.compressor().compress(data)
+
+    def write(self, directory, data):
+        path = os.path.join(directory, self.filename)
+        if self.compression == 'gzip':
+            with gzip.open(path, 'wb', compresslevel=self.level) as f:
+                f.write(data)
+        else:
+            with open(path, 'wb') as f:
+                f.write(self.compress(data))
+        # The full message replaces the partial one, see fetch-skipped
+        if not self.partial:
+            remove_partial(directory)
+
+
+def require_zstandard():
+    if not has_zstandard:
+        raise IOError('The zstandard package is required by the zstd compression, install it with pip install zstandard')
+
+
+def load_dictionary(path):
+    if path not in _dictionaries:
+        with open(path, 'rb') as f:
+            _dictionaries[path] = zstandard.ZstdCompressionDict(f.read())
+    return _dictionaries[path]
+
+
+def has_raw(filenames):
+    """If a message folder listing has a raw message, whatever its compression, partial or not"""
+    return any(filename in filenames for filename in list(RAW_FILENAMES.values()) + list(PARTIAL_FILENAMES.values()))
+
+
+def raw_path(directory):
+    """Path of the raw message of a message folder, the partial one if it has only this one, None if there is none"""
+    for filename in list(RAW_FILENAMES.values()) + list(PARTIAL_FILENAMES.values()):
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_partial(path):
+    """If a raw message path is a message fetched without its skipped parts"""
+    return os.path.basename(path) in PARTIAL_FILENAMES.values()
+
+
+def remove_partial(directory):
+    for filename in PARTIAL_FILENAMES.values():
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def read_raw(directory, root):
+    """Raw message of a message folder, the zstd dictionaries are looked up in the archive root"""
+    path = raw_path(directory)
+    if path is None:
+        raise IOError('No raw message in {}'.format(directory))
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        return decompress(f.read(), root)
+
+
+def decompress(data, root):
+    """Raw message of a gzip member or a zstd frame, the zstd dictionaries are looked up in the archive root"""
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    require_zstandard()
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    dict_data = find_dictionary(root, dict_id) if dict_id else None
+    return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+
+
+def find_dictionary(root, dict_id):
+    folder = os.path.join(root, DICTIONARY_DIRNAME)
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith('.zdict'):
+                continue
+            dictionary = load_dictionary(os.path.join(folder, name))
+            if dictionary.dict_id() == dict_id:
+                return dictionary
+    raise IOError('zstd dictionary {} not found in {}'.format(dict_id, folder))
+
+
+def gzip_size(path):
+    """Uncompressed size of a gzip file, read from its trailer (modulo 2^32)"""
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def raw_size(path):
+    """Uncompressed size of a raw message, read from the gzip trailer or the zstd frame header"""
+    if path.endswith('.gz'):
+        return gzip_size(path)
+    if not has_zstandard:
+        return None
+    with open(path, 'rb') as f:
+        size = zstandard.frame_content_size(f.read(18))
+    return size if size >= 0 else None
+
+
+def dictionary_path(root, name):
+    return os.path.join(root, DICTIONARY_DIRNAME, re.sub(r'[^\w.@-]', '_', name) + '.zdict')
+
+
+def message_folders(local_folder):
+    """Message folders with a raw message under local_folder"""
+    for directory, dirnames, filenames in os.walk(local_folder):
+        if has_raw(filenames):
+            dirnames[:] = []
+            yield directory
+
+
+def train_dictionary(root, directories, name, samples=DICTIONARY_SAMPLES, read=None):
+    """Train the zstd dictionary of an account on a sample of its archived message folders
+
+    read(directory) returns the raw message of a message folder, by default
+    it is read from the folder. Return the path of the dictionary, None when
+    fewer than DICTIONARY_MIN_SAMPLES messages are archived yet.
+    """
+    if read is None:
+        directories = [directory for directory in directories if raw_path(directory) is not None]
+        read = lambda directory: read_raw(directory, root)
+    else:
+        directories = list(directories)
+    if len(directories) < DICTIONARY_MIN_SAMPLES:
+        return None
+    require_zstandard()
+
+    sample = [read(directory)[:SAMPLE_SIZE] for directory in random.sample(directories, min(samples, len(directories)))]
+    dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, sample)
+    path = dictionary_path(root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(dictionary.as_bytes())
+    os.replace(path + '.tmp', path)
+    print('zstd dictionary of {} trained on {} messages'.format(name, len(sample)))
+    return path
+
+
+def account_dictionary(root, name, directories, read=None):
+    """Path of the zstd dictionary of an account, trained on the first run with enough archived messages
+
+    directories are the message folders of the account, only read when the
+    dictionary is trained, see train_dictionary() for read.
+    """
+    path = dictionary_path(root, name)
+    if os.path.exists(path):
+        return path
+    if not has_zstandard:
+        print('zstd dictionary of {} not trained: the zstandard package is not installed'.format(name))
+        return None
+    try:
+        return train_dictionary(root, directories, name, read=read)
+    except (IOError, zstandard.ZstdError) as e:
+        print('zstd dictionary of {} not trained: {}'.format(name, e))
+        return None
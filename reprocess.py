@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from attachmentstore import get_store
+from message import Message, message_from_bytes
+from metrics import Progress
+from pipeline import QUEUE_PER_PROCESS
+from rawcodec import has_raw, read_raw
+
+# Files of a message folder which can be created again from its raw message
+ARTIFACTS = ('metadata', 'text', 'html', 'attachments')
+# Metadata known from the IMAP server only, kept from the previous metadata.json
+SERVER_PROPERTIES = ('Flags', 'Labels', 'GmailId')
+JOURNAL_FILENAME = '.reprocess'
+
+
+def parse_artifacts(value):
+    """Artifacts of a comma separated list like metadata,html"""
+    artifacts = [name.strip() for name in value.split(',') if name.strip()]
+    for name in artifacts:
+        if name not in ARTIFACTS:
+            raise ValueError('Unknown artifact {}, use one of {}'.format(name, ', '.join(ARTIFACTS)))
+    return tuple(name for name in ARTIFACTS if name in artifacts)
+
+
+def archived_messages(root, paths=None):
+    """Message folders with a raw message, in the given folders of the archive or in all of it"""
+    for top in paths or ['']:
+        for directory, dirnames, filenames in os.walk(os.path.join(root, top)):
+            if has_raw(filenames):
+                # A message folder, its attachments are not walked
+                dirnames[:] = []
+                yield directory
+
+
+def reprocess_message(root, directory, artifacts, attachment_store=None):
+    """Write the artifacts of an archived message again from its raw message, return what it printed"""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        data = read_raw(directory, root)
+
+        properties = {}
+        if os.path.exists(os.path.join(directory, 'metadata.json')):
+            try:
+                with open(os.path.join(directory, 'metadata.json'), encoding='utf8') as json_file:
+                    metadata = json.load(json_file)
+                properties = dict((key, metadata[key]) for key in SERVER_PROPERTIES if key in metadata)
+            except ValueError:
+                print("Invalid metadata file in %s, the Flags are lost" % directory)
+
+        message = Message(directory, message_from_bytes(data), properties)
+        parts = message.getParts()
+        if 'metadata' in artifacts:
+            message.createMetaFile()
+        if 'text' in artifacts and parts['text']:
+            message.createTextFile(parts['text'])
+        if 'html' in artifacts and parts['html']:
+            message.createHtmlFile(parts['html'], parts['embed_images'])
+        if 'attachments' in artifacts:
+            # Only the links are removed, never the blobs of the attachment store
+            shutil.rmtree(os.path.join(directory, 'attachments'), ignore_errors=True)
+            if parts['files']:
+                message.createAttachmentFiles(parts['files'], get_store(attachment_store))
+    return output.getvalue()
+
+
+class Journal:
+    """Message folders already reprocessed by an interrupted run, one relative path per line
+
+    The first line holds the artifacts of the run, a journal of other
+    artifacts is not resumed. The journal is removed once every message is done.
+    """
+
+    def __init__(self, root, artifacts, restart=False):
+        self.root = root
+        self.path = os.path.join(root, JOURNAL_FILENAME)
+        self.done = set()
+        header = json.dumps(list(artifacts))
+        if not restart and os.path.exists(self.path):
+            with open(self.path, encoding='utf8') as f:
+                lines = f.readlines()
+            if lines and lines[0].rstrip('\n') == header:
+                # The last line may have been cut by the interruption
+                self.done = set(line[:-1] for line in lines[1:] if line.endswith('\n'))
+        self.file = open(self.path, 'w' if not self.done else 'a', encoding='utf8')
+        if not self.done:
+            self.file.write(header + '\n')
+        self.file.flush()
+
+    def relpath(self, directory):
+        return os.path.relpath(directory, self.root).replace(os.sep, '/')
+
+    def __contains__(self, directory):
+        return self.relpath(directory) in self.done
+
+    def add(self, directory):
+        self.file.write(self.relpath(directory) + '\n')
+        self.file.flush()
+
+    def close(self, finished):
+        self.file.close()
+        if finished:
+            os.remove(self.path)
+
+
+def reprocess(root, artifacts=ARTIFACTS, paths=None, processes=None, attachment_store=None, restart=False):
+    """Create the artifacts of the archived messages again in a pool of processes, return the number of messages and failures
+
+    No IMAP connection is used, every message is read from its raw message. An
+    interrupted run is resumed from its journal.
+    """
+    journal = Journal(root, artifacts, restart)
+    if journal.done:
+        print('Resuming, {} emails already reprocessed'.format(len(journal.done)))
+    directories = [directory for directory in archived_messages(root, paths) if directory not in journal]
+    processes = processes or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+    progress = Progress(len(directories))
+    pending = {}
+    done = 0
+    failed = 0
+    finished = False
+    try:
+        for directory in directories + [None]:
+            # At most QUEUE_PER_PROCESS messages wait for each process
+            while pending and (directory is None or len(pending) >= processes * QUEUE_PER_PROCESS):
+                completed, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in completed:
+                    path = pending.pop(future)
+                    try:
+                        output = future.result()
+                        journal.add(path)
+                    except Exception as e:
+                        output = "{}: reprocessing failed: {}\n".format(path, e)
+                        failed += 1
+                    if output:
+                        print(output, end='')
+                    done += 1
+                    progress.update(done)
+            if directory is not None:
+                pending[executor.submit(reprocess_message, root, directory, artifacts, attachment_store)] = directory
+        finished = not failed
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        progress.finish()
+        journal.close(finished)
+    return done, failed
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import asyncio
+import contextvars
+import io
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ContextOutput(io.TextIOBase):
+    """Replacement for sys.stdout writing into the buffer of the current thread or task when one is set"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = contextvars.ContextVar('buffer', default=None)
+
+    def write(self, text):
+        buffer = self.buffer.get()
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if self.buffer.get() is None:
+            self.stream.flush()
+
+
+class Scheduler:
+    """Run the jobs of several accounts in a bounded pool of threads
+
+    At most `workers` jobs run at the same time and at most `host_connections`
+    of them connect to the same host, the connections themselves are capped by
+    the HostLimit of the session pools. The output of the jobs is kept per
+    group, usually an account, and printed when all the jobs of the group are
+    done. A failed job is reported in its output, the next jobs still run.
+    """
+
+    def __init__(self, workers=1, host_connections=2):
+        self.workers = max(1, workers)
+        self.host_connections = max(1, host_connections)
+        self.groups = OrderedDict()
+        self.host_semaphores = {}
+
+    def add(self, group, host, job, *args):
+        """Add job(*args) to a group, group is printed before the output of its jobs"""
+        self.groups.setdefault(group, []).append((host, job, args))
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = threading.BoundedSemaphore(self.host_connections)
+
+    def run(self):
+        if self.workers == 1:
+            # Sequential run, the output is not buffered
+            for group, jobs in self.groups.items():
+                print(group)
+                for host, job, args in jobs:
+                    call_job(job, args)
+            return
+
+        output = ContextOutput(sys.stdout)
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = OrderedDict()
+                for group, host, job, args in self.interleaved():
+                    futures.setdefault(group, []).append(executor.submit(self.run_job, output, host, job, args))
+
+                # Groups are printed in order, as soon as all their jobs are done
+                for group, group_futures in futures.items():
+                    buffers = [future.result() for future in group_futures]
+                    stdout.write(group + '\n')
+                    for buffer in buffers:
+                        stdout.write(buffer)
+                    stdout.flush()
+        finally:
+            sys.stdout = stdout
+
+    def interleaved(self):
+        """Jobs ordered round-robin over the hosts, so the workers are not all waiting for the same host"""
+        by_host = OrderedDict()
+        for group, jobs in self.groups.items():
+            for host, job, args in jobs:
+                by_host.setdefault(host, []).append((group, host, job, args))
+        queues = list(by_host.values())
+        while queues:
+            for queue in list(queues):
+                yield queue.pop(0)
+                if not queue:
+                    queues.remove(queue)
+
+    def run_job(self, output, host, job, args):
+        buffer = io.StringIO()
+        token = output.buffer.set(buffer)
+        try:
+            with self.host_semaphores[host]:
+                call_job(job, args)
+        finally:
+            output.buffer.reset(token)
+        return buffer.getvalue()
+
+    def run_async(self, finished=None):
+        """Run coroutine jobs in an event loop, with the same limits and output as run()
+
+        finished is a coroutine function awaited in the same loop once all the
+        jobs are done, to close the connections they left open.
+        """
+        asyncio.run(self.run_all_async(finished))
+
+    async def run_all_async(self, finished=None):
+        output = ContextOutput(sys.stdout)
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            workers = asyncio.Semaphore(self.workers)
+            hosts = dict((host, asyncio.Semaphore(self.host_connections)) for host in self.host_semaphores)
+            tasks = OrderedDict()
+            for group, host, job, args in self.interleaved():
+                task = asyncio.ensure_future(self.run_job_async(output, workers, hosts[host], job, args))
+                tasks.setdefault(group, []).append(task)
+
+            for group, group_tasks in tasks.items():
+                buffers = [await task for task in group_tasks]
+                stdout.write(group + '\n')
+                for buffer in buffers:
+                    stdout.write(buffer)
+                stdout.flush()
+            if finished is not None:
+                await finished()
+        finally:
+            sys.stdout = stdout
+
+    async def run_job_async(self, output, workers, host, job, args):
+        # Each task has its own context, the buffer is not shared
+        buffer = io.StringIO()
+        output.buffer.set(buffer)
+        try:
+            async with workers, host:
+                await job(*args)
+        except SystemExit:
+            # Raised out of the event loop otherwise, the other jobs would be cancelled
+            print("Job stopped")
+        except Exception:
+            print(traceback.format_exc())
+        return buffer.getvalue()
+
+
+def call_job(job, args):
+    """Run a job, its errors are printed instead of stopping the next jobs"""
+    try:
+        job(*args)
+    except SystemExit:
+        print("Job stopped")
+    except Exception:
+        print(traceback.format_exc())
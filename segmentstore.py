@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import os
+import threading
+
+from rawcodec import RawCodec, decompress
+
+SEGMENTS_DIRNAME = 'segments'
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class SegmentStore:
+    """Raw messages of a local folder appended to one segment file per month
+
+    A segment is a concatenation of members compressed by the RawCodec of the
+    folder, one gzip member or zstd frame per message, so it is also a valid
+    gzip or zstd file. The .idx file next to it has a line per message with its
+    key, the offset and length of its member and its raw size. Keys are the
+    message folders relative to the local folder, like 2024/<id>. The zstd
+    dictionaries are looked up in root, the archive root.
+    """
+
+    def __init__(self, local_folder, root=None):
+        self.local_folder = local_folder
+        self.root = root if root is not None else local_folder
+        self.folder = os.path.join(local_folder, SEGMENTS_DIRNAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isdir(self.folder):
+            for name in sorted(os.listdir(self.folder)):
+                if name.endswith('.idx'):
+                    self.load(name[:-4])
+
+    def load(self, segment):
+        path = os.path.join(self.folder, segment + '.idx')
+        with open(path, 'rb') as f:
+            content = f.read()
+        end = content.rfind(b'\n') + 1
+        if end != len(content):
+            # Line left incomplete by an interrupted run
+            with open(path, 'ab') as f:
+                f.truncate(end)
+        for line in content[:end].decode('utf-8').splitlines():
+            key, offset, length, size = line.rsplit('\t', 3)
+            self.entries[key] = (segment, int(offset), int(length), int(size))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, directory):
+        return os.path.relpath(directory, self.local_folder).replace(os.sep, '/')
+
+    def add(self, key, segment, data, codec=None):
+        """Append a message to a segment, return False if the key is already stored"""
+        member = (codec or RawCodec()).compress(data)
+        with self.lock:
+            if key in self.entries:
+                return False
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            with open(os.path.join(self.folder, segment + '.seg'), 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(member)
+            # The index line is written last, a message is never indexed before its data
+            with open(os.path.join(self.folder, segment + '.idx'), 'ab') as f:
+                f.write(('%s\t%d\t%d\t%d\n' % (key, offset, len(member), len(data))).encode('utf-8'))
+            self.entries[key] = (segment, offset, len(member), len(data))
+        return True
+
+    def read(self, key):
+        segment, offset, length, size = self.entries[key]
+        with open(os.path.join(self.folder, segment + '.seg'), 'rb') as f:
+            f.seek(offset)
+            return decompress(f.read(length), self.root)
+
+    def keys(self, segment=None):
+        return sorted(key for key, entry in self.entries.items() if segment is None or entry[0] == segment)
+
+
+def get_segment_store(local_folder):
+    """The store of a local folder, shared by the folder jobs writing into it at the same time"""
+    with _stores_lock:
+        if local_folder not in _stores:
+            _stores[local_folder] = SegmentStore(local_folder)
+        return _stores[local_folder]
+
+
+def stored_messages(root):
+    """Messages stored in the segments under root, as {message folder: (store, key)}"""
+    messages = {}
+    for store in find_stores(root):
+        for key in store.keys():
+            messages[os.path.join(store.local_folder, key)] = (store, key)
+    return messages
+
+
+def find_stores(root):
+    """Segment stores of the local folders under root"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        if os.path.basename(dirpath) == SEGMENTS_DIRNAME and any(name.endswith('.idx') for name in filenames):
+            dirnames[:] = []
+            yield SegmentStore(os.path.dirname(dirpath), root)
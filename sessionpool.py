@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import imaplib
+import ssl
+import threading
+import time
+
+# A session idle for longer is checked with NOOP before being reused
+HEALTH_CHECK_IDLE = 30
+
+
+class HostLimit:
+    """Connections open to a host, shared by the session pools of its accounts
+
+    At most `size` connections are open at the same time. A pool needing a new
+    one when they all are closes an idle connection of another pool first, so
+    the finished accounts don't keep the connections of the next ones.
+    """
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.opened = 0
+        self.pools = []
+        self.condition = threading.Condition()
+        # asyncio.Condition of the tasks waiting for a connection, set by the asyncio pools
+        self.available = None
+
+    def take_idle(self):
+        """Remove the oldest idle connection of the pools, its slot is given to the caller, None if there is none"""
+        candidates = [pool for pool in self.pools if pool.idle]
+        if not candidates:
+            return None
+        pool = min(candidates, key=lambda pool: pool.idle[0][1])
+        connection, released = pool.idle.pop(0)
+        pool.opened -= 1
+        return connection
+
+
+class SessionPool:
+    """Authenticated IMAP connections of an account, reused from one folder to the next
+
+    At most `size` connections are opened, acquire() waits for a free one. A
+    connection released in the SELECTED state is closed first, so the next
+    folder only needs a SELECT instead of a new TCP/TLS handshake and LOGIN.
+    The connections also count against the HostLimit of the account host.
+    """
+
+    def __init__(self, account, size=1, host=None):
+        self.account = account
+        self.size = max(1, size)
+        self.idle = []
+        self.opened = 0
+        self.host = host if host is not None else HostLimit(self.size)
+        self.host.pools.append(self)
+        # Shared with the other pools of the host
+        self.condition = self.host.condition
+
+    def connect(self):
+        if not self.account['ssl']:
+            connection = imaplib.IMAP4(self.account['host'], self.account['port'])
+        else:
+            connection = imaplib.IMAP4_SSL(self.account['host'], self.account['port'], ssl_context=ssl_context())
+        connection.login(self.account['username'], self.account['password'])
+        return connection
+
+    def reserve(self):
+        """Take an idle connection or a slot for a new one, None if the caller has to wait, called with the condition held
+
+        Return (connection, released, stale): connection is None when a new one
+        has to be opened, stale is an idle connection of another pool to log out first.
+        """
+        if self.idle:
+            connection, released = self.idle.pop()
+            return connection, released, None
+        if self.opened < self.size:
+            if self.host.opened < self.host.size:
+                self.host.opened += 1
+                self.opened += 1
+                return None, None, None
+            stale = self.host.take_idle()
+            if stale is not None:
+                self.opened += 1
+                return None, None, stale
+        return None
+
+    def acquire(self):
+        while True:
+            with self.condition:
+                reserved = self.reserve()
+                while reserved is None:
+                    self.condition.wait()
+                    reserved = self.reserve()
+            connection, released, stale = reserved
+
+            if stale is not None:
+                logout(stale)
+            if connection is None:
+                break
+            if time.time() - released < HEALTH_CHECK_IDLE:
+                return connection
+            try:
+                connection.noop()
+                return connection
+            except Exception:
+                # Dropped by the server, a new one is opened
+                self.discard(connection)
+
+        try:
+            return self.connect()
+        except BaseException:
+            self.opening_failed()
+            raise
+
+    def opening_failed(self):
+        with self.condition:
+            self.opened -= 1
+            self.host.opened -= 1
+            self.notify()
+
+    def release(self, connection):
+        try:
+            if connection.state == 'SELECTED':
+                connection.close()
+        except Exception:
+            self.discard(connection)
+            return
+        with self.condition:
+            self.idle.append((connection, time.time()))
+            self.notify()
+
+    def discard(self, connection):
+        logout(connection)
+        with self.condition:
+            self.opened -= 1
+            self.host.opened -= 1
+            self.notify()
+
+    def notify(self):
+        """Wake up the callers waiting for a connection, called with the condition held"""
+        self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+        for connection, released in idle:
+            self.discard(connection)
+
+
+def ssl_context():
+    """SSL context of the connections of both backends, the server certificate is verified"""
+    return ssl.create_default_context()
+
+
+def logout(connection):
+    try:
+        connection.logout()
+    except Exception:
+        pass
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rawcodec
+from imapbox import default_options
+from imapserver import ImapServer, Folder, generate_message
+from mailboxresource import save_emails
+from asyncmailbox import save_emails_async
+
+
+def make_account(server, remote_folder='INBOX', name='test'):
+    return {'name': name, 'host': '127.0.0.1', 'port': server.port, 'username': 'user', 'password': 'secret',
+            'ssl': False, 'remote_folder': remote_folder, 'exclude_folders': []}
+
+
+def make_options(local_folder, **options):
+    return dict(default_options(), local_folder=str(local_folder), **options)
+
+
+def archive(backend, account, options, index=None, pool=None, export=None, pipeline=None):
+    """Archive a folder like a run of imapbox with the given backend"""
+    if backend == 'asyncio':
+        asyncio.run(save_emails_async(account, options, index, pipeline, None, export, pool))
+    else:
+        save_emails(account, options, index, pool, pipeline, None, export)
+
+
+def message_folders(local_folder):
+    """Names of the message folders archived in local_folder"""
+    return sorted(os.path.basename(directory) for directory in rawcodec.message_folders(str(local_folder)))
+
+
+@pytest.fixture
+def server():
+    server = ImapServer({'INBOX': Folder(enumerate((generate_message(n) for n in range(1, 6)), 1)),
+                         'Sent': Folder(enumerate((generate_message(n) for n in range(11, 14)), 1))}).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(params=['imaplib', 'asyncio'])
+def backend(request):
+    return request.param
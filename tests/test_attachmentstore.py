@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import hashlib
+import os
+from email.message import EmailMessage
+
+from attachmentstore import AttachmentStore, STORE_DIRNAME
+from imapserver import ImapServer, Folder
+
+from conftest import make_account, make_options, archive
+
+
+def report_message(number):
+    msg = EmailMessage()
+    msg['Message-Id'] = '<report%d@imapserver.test>' % number
+    msg['Date'] = 'Mon, 1 Jan 2024 10:00:00 +0000'
+    msg['Subject'] = 'Report %d' % number
+    msg.set_content('Report of week %d' % number)
+    msg.add_attachment(b'%PDF same report', maintype='application', subtype='pdf', filename='report.pdf')
+    msg.add_attachment(b'week %d' % number, maintype='text', subtype='csv', filename='week.csv')
+    return msg.as_bytes().replace(b'\n', b'\r\n')
+
+
+def test_save(tmp_path):
+    store = AttachmentStore(str(tmp_path / 'store'))
+    first, second = tmp_path / 'a.pdf', tmp_path / 'b.pdf'
+    assert store.save(b'payload', str(first))
+    assert not store.save(b'payload', str(second))
+    digest = hashlib.sha256(b'payload').hexdigest()
+    blob = tmp_path / 'store' / digest[:2] / digest
+    assert os.stat(first).st_ino == os.stat(second).st_ino == os.stat(blob).st_ino
+    assert os.stat(blob).st_nlink == 3
+
+    # A file saved again is replaced by a link, the blobs are found by a new store
+    assert not AttachmentStore(str(tmp_path / 'store')).save(b'payload', str(first))
+    assert store.save(b'other', str(second))
+    assert second.read_bytes() == b'other' and first.read_bytes() == b'payload'
+
+
+def test_archive_deduplicated(backend, tmp_path):
+    server = ImapServer({'INBOX': Folder(enumerate((report_message(n) for n in range(1, 4)), 1))}).start()
+    try:
+        store = tmp_path / STORE_DIRNAME
+        archive(backend, make_account(server), make_options(tmp_path / 'INBOX', attachment_store=str(store)))
+    finally:
+        server.stop()
+    reports = [tmp_path / 'INBOX' / '2024' / ('report%dimapserver.test' % n) / 'attachments' for n in range(1, 4)]
+    assert len(set(os.stat(directory / 'report.pdf').st_ino for directory in reports)) == 1
+    assert len(set(os.stat(directory / 'week.csv').st_ino for directory in reports)) == 3
+    assert (reports[1] / 'week.csv').read_bytes() == b'week 2'
+    # One blob for the report, one per week
+    assert sum(len(files) for _, _, files in os.walk(store)) == 4
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import asyncio
+import email.utils
+import imaplib
+import json
+import os
+from email.message import EmailMessage
+
+import pytest
+
+import asyncmailbox
+import imapserver
+from archiveindex import ArchiveIndex
+from asyncmailbox import AsyncMailboxClient, AsyncSessionPool, save_emails_async, close_pools
+from imapserver import ImapServer, Folder, generate_message
+from mailboxresource import MailboxClient, fetch_skipped, save_emails
+from sessionpool import SessionPool
+
+from conftest import make_account, make_options, archive, message_folders
+
+
+def attachment_message(number, message_id=True):
+    msg = EmailMessage()
+    if message_id:
+        msg['Message-Id'] = '<att%d@imapserver.test>' % number
+    msg['Date'] = 'Mon, 1 Jan 2024 10:00:00 +0000'
+    msg['From'] = 'sender@imapserver.test'
+    msg['To'] = 'recipient@imapserver.test'
+    msg['Subject'] = 'Attachment %d' % number
+    msg.set_content('Body of message %d' % number)
+    msg.add_attachment(b'x' * 50000, maintype='application', subtype='pdf', filename='big.pdf')
+    msg.add_attachment(b'small', maintype='image', subtype='png', filename='small.png')
+    return msg.as_bytes().replace(b'\n', b'\r\n')
+
+
+def test_archive(server, backend, tmp_path):
+    options = make_options(tmp_path / 'INBOX')
+    index = ArchiveIndex(str(tmp_path))
+    archive(backend, make_account(server), options, index)
+    assert message_folders(tmp_path / 'INBOX') == ['%dimapserver.test' % n for n in range(1, 6)]
+    assert os.path.exists(tmp_path / 'INBOX' / '2024' / '1imapserver.test' / 'raw.eml.gz')
+
+    # Only the new message is fetched by the next run
+    server.folders['INBOX'].append(generate_message(6))
+    del server.commands[:]
+    archive(backend, make_account(server), options, index)
+    index.close()
+    assert '6imapserver.test' in message_folders(tmp_path / 'INBOX')
+    fetches = [command for command in server.commands if 'FETCH' in command.upper() and 'BODY.PEEK[]' in command]
+    assert len(fetches) == 1 and ' 6 ' in fetches[0]
+
+
+def test_part_policy(backend, tmp_path):
+    messages = [attachment_message(1), attachment_message(2, message_id=False), generate_message(3)]
+    server = ImapServer({'INBOX': Folder(enumerate(messages, 1))}).start()
+    try:
+        options = make_options(tmp_path / 'INBOX', attachment_max_size=10000)
+        index = ArchiveIndex(str(tmp_path))
+        archive(backend, make_account(server), options, index)
+
+        directory = tmp_path / 'INBOX' / '2024' / 'att1imapserver.test'
+        assert sorted(os.listdir(directory / 'attachments')) == ['small.png']
+        assert os.path.exists(directory / 'partial.eml.gz') and not os.path.exists(directory / 'raw.eml.gz')
+        with open(directory / 'metadata.json', encoding='utf8') as f:
+            assert [part['Filename'] for part in json.load(f)['Skipped']] == ['big.pdf']
+        # Without a Message-Id, the message is fetched in full
+        hashed = [name for name in message_folders(tmp_path / 'INBOX') if 'imapserver.test' not in name]
+        assert sorted(os.listdir(tmp_path / 'INBOX' / '2024' / hashed[0] / 'attachments')) == ['big.pdf', 'small.png']
+
+        assert fetch_skipped(make_account(server), str(tmp_path), None, index) == 1
+        index.close()
+        assert sorted(os.listdir(directory / 'attachments')) == ['big.pdf', 'small.png']
+        assert os.path.exists(directory / 'raw.eml.gz') and not os.path.exists(directory / 'partial.eml.gz')
+        with open(directory / 'metadata.json', encoding='utf8') as f:
+            assert json.load(f)['Skipped'] == []
+    finally:
+        server.stop()
+
+
+def test_prescan_connection_lost(server, backend, tmp_path, monkeypatch):
+    do_fetch = imapserver.ImapHandler.do_FETCH
+    dropped = []
+
+    def drop_prescan(handler, tag, args, use_uid):
+        if 'MESSAGE-ID' in str(args) and not dropped:
+            dropped.append(tag)
+            return False
+        return do_fetch(handler, tag, args, use_uid)
+
+    monkeypatch.setattr(imapserver.ImapHandler, 'do_FETCH', drop_prescan)
+    archive(backend, make_account(server), make_options(tmp_path / 'INBOX'), ArchiveIndex(str(tmp_path)))
+    assert dropped
+    assert len(message_folders(tmp_path / 'INBOX')) == 5
+
+
+def test_sessions_reused(server, backend, tmp_path):
+    options = dict((folder, make_options(tmp_path / folder)) for folder in ('INBOX', 'Sent'))
+    index = ArchiveIndex(str(tmp_path))
+    if backend == 'asyncio':
+        pool = AsyncSessionPool(make_account(server), 1)
+
+        async def run():
+            for folder in ('INBOX', 'Sent'):
+                await save_emails_async(make_account(server, folder), options[folder], index, pool=pool)
+            await close_pools([pool])
+        asyncio.run(run())
+    else:
+        pool = SessionPool(make_account(server), 1)
+        for folder in ('INBOX', 'Sent'):
+            save_emails(make_account(server, folder), options[folder], index, pool)
+        pool.close()
+    index.close()
+
+    assert len(message_folders(tmp_path / 'INBOX')) == 5 and len(message_folders(tmp_path / 'Sent')) == 3
+    assert len([command for command in server.commands if ' LOGIN ' in command]) == 1
+    assert pool.opened == 0 and pool.host.opened == 0
+
+
+def test_fetch_stream_stopped(server, backend):
+    """A session whose FETCH response was not read to the end runs the next command"""
+    account = make_account(server)
+    uids = [b'1', b'2', b'3', b'4', b'5']
+    if backend == 'asyncio':
+        async def run():
+            mailbox = AsyncMailboxClient(account['host'], account['port'], account['username'], account['password'], 'INBOX', False)
+            await mailbox.connect_to_imap()
+            async for uid, data in mailbox.fetch_stream(uids):
+                break
+            fetched = [uid async for uid, data in mailbox.fetch_stream(uids[3:])]
+            found = await mailbox.search_emails('ALL')
+            await mailbox.cleanup()
+            return found, fetched
+        found, fetched = asyncio.run(run())
+    else:
+        pool = SessionPool(account, 1)
+        mailbox = MailboxClient(account['host'], account['port'], account['username'], account['password'], 'INBOX', False, pool=pool)
+        for uid, data in mailbox.fetch_stream(uids):
+            break
+        fetched = [uid for uid, data in mailbox.fetch_stream(uids[3:])]
+        found = mailbox.search_emails('ALL')
+        mailbox.cleanup()
+        # The pooled session is given back in a usable state
+        session = pool.acquire()
+        assert session.select('Sent', readonly=True)[0] == 'OK'
+        pool.release(session)
+        pool.close()
+    assert list(found) == uids
+    assert fetched == [b'4', b'5']
+
+
+def test_incremental_days(backend, tmp_path):
+    """The days window applies to every incremental run, not only the first one"""
+    recent = email.utils.formatdate()
+    server = ImapServer({'INBOX': Folder(enumerate([generate_message(1, date=recent), generate_message(2, date=recent),
+                                                     generate_message(3)], 1))}).start()
+    try:
+        options = make_options(tmp_path / 'INBOX', days=30)
+        index = ArchiveIndex(str(tmp_path))
+        archive(backend, make_account(server), options, index)
+        assert message_folders(tmp_path / 'INBOX') == ['1imapserver.test', '2imapserver.test']
+
+        server.folders['INBOX'].append(generate_message(4))
+        server.folders['INBOX'].append(generate_message(5, date=recent))
+        del server.commands[:]
+        archive(backend, make_account(server), options, index)
+        index.close()
+        assert message_folders(tmp_path / 'INBOX') == ['1imapserver.test', '2imapserver.test', '5imapserver.test']
+        fetches = [command for command in server.commands if 'BODY.PEEK[]' in command]
+        assert len(fetches) == 1 and ' 5 ' in fetches[0]
+    finally:
+        server.stop()
+
+
+def test_async_pool_wait(server):
+    """A task waiting for a session gets the one released or discarded by another"""
+    pool = AsyncSessionPool(make_account(server), 1)
+    order = []
+
+    async def use(name, discard):
+        connection = await pool.acquire()
+        order.append(name)
+        await asyncio.sleep(0.05)
+        if discard:
+            pool.discard(connection)
+        else:
+            await connection.command('EXAMINE', 'INBOX')
+            await pool.release(connection)
+
+    async def run():
+        await asyncio.wait_for(asyncio.gather(use(1, True), use(2, False), use(3, False)), 5)
+        await close_pools([pool])
+    asyncio.run(run())
+    assert order == [1, 2, 3]
+    assert pool.opened == 0 and pool.host.opened == 0
+    assert len([command for command in server.commands if ' LOGIN ' in command]) == 2
+
+
+def test_async_read_timeout(server, monkeypatch):
+    monkeypatch.setattr(asyncmailbox, 'READ_TIMEOUT', 0.2)
+    server.latency = 1
+    account = make_account(server)
+
+    async def run():
+        mailbox = AsyncMailboxClient(account['host'], account['port'], account['username'], account['password'], 'INBOX', False)
+        await mailbox.connect()
+    with pytest.raises(imaplib.IMAP4.abort):
+        asyncio.run(run())
+
+
+def pdf_message(number):
+    msg = EmailMessage()
+    msg['Message-Id'] = '<pdf%d@imapserver.test>' % number
+    msg['Date'] = 'Mon, 1 Jan 2024 10:00:00 +0000'
+    msg['Subject'] = 'Scan %d' % number
+    msg.set_content(b'x' * 50000, maintype='application', subtype='pdf', filename='scan.pdf')
+    return msg.as_bytes().replace(b'\n', b'\r\n')
+
+
+def test_single_part_policy(backend, tmp_path):
+    """The body of a single part message is skipped like an attachment, fetch-skipped gets a folder in one command"""
+    server = ImapServer({'INBOX': Folder(enumerate([pdf_message(1), pdf_message(2), generate_message(3)], 1))}).start()
+    try:
+        options = make_options(tmp_path / 'INBOX', attachment_max_size=10000)
+        index = ArchiveIndex(str(tmp_path))
+        archive(backend, make_account(server), options, index)
+        assert len([command for command in server.commands if 'BODY.PEEK[]' in command]) == 1
+        for number in (1, 2):
+            directory = tmp_path / 'INBOX' / '2024' / ('pdf%dimapserver.test' % number)
+            assert os.path.exists(directory / 'partial.eml.gz') and not os.path.exists(directory / 'attachments')
+            with open(directory / 'metadata.json', encoding='utf8') as f:
+                assert [(part['Filename'], part['Section']) for part in json.load(f)['Skipped']] == [('scan.pdf', '1')]
+
+        del server.commands[:]
+        assert fetch_skipped(make_account(server), str(tmp_path), None, index) == 2
+        index.close()
+        fetches = [command for command in server.commands if 'BODY.PEEK[]' in command]
+        assert len(fetches) == 1 and ' 1:2 ' in fetches[0]
+        assert os.listdir(tmp_path / 'INBOX' / '2024' / 'pdf2imapserver.test' / 'attachments') == ['scan.pdf']
+    finally:
+        server.stop()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import email
+
+from bodystructure import SKIPPED_HEADER, PartPolicy, parse_response, fetch_attributes, parse_bodystructure, fetch_items, build_message
+
+# multipart/mixed (multipart/alternative (text/plain, text/html), application/pdf, message/rfc822)
+NESTED = (b'1 (UID 7 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1 NIL NIL NIL)'
+          b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 40 2 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "alt") NIL NIL)'
+          b'("APPLICATION" "PDF" ("NAME" "report.pdf") NIL NIL "BASE64" 50000 NIL ("ATTACHMENT" ("FILENAME" "report.pdf")) NIL)'
+          b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 300 ("date" "subject" NIL NIL NIL NIL NIL NIL NIL "<m@x>")'
+          b' ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 20 1 NIL NIL NIL) 10 NIL NIL NIL)'
+          b' "MIXED" ("BOUNDARY" "mix") NIL NIL))')
+SOURCE = {'uid': 7, 'uidvalidity': 1, 'account': 'test', 'folder': 'INBOX'}
+
+
+def test_parse_response():
+    data = [(b'1 (UID 3 BODY[HEADER.FIELDS (MESSAGE-ID)] {19}', b'Message-Id: <a@b>\r\n'), b' FLAGS (\\Seen "a \\"b\\"" NIL))']
+    assert parse_response(data) == [b'1', [b'UID', b'3', b'BODY[HEADER.FIELDS (MESSAGE-ID)]', b'Message-Id: <a@b>\r\n',
+                                           b'FLAGS', [b'\\Seen', b'a "b"', None]]]
+    assert fetch_attributes(data)[b'BODY[HEADER.FIELDS (MESSAGE-ID)]'] == b'Message-Id: <a@b>\r\n'
+
+
+def test_nested_sections():
+    structure = parse_bodystructure(fetch_attributes([NESTED])[b'BODYSTRUCTURE'])
+    parts = [(part.section, part.content_type) for part in structure.walk()]
+    assert parts == [('', 'multipart/mixed'), ('1', 'multipart/alternative'), ('1.1', 'text/plain'), ('1.2', 'text/html'),
+                     ('2', 'application/pdf'), ('3', 'message/rfc822')]
+    assert structure.params['boundary'] == 'mix'
+    pdf = parts_by_section(structure)['2']
+    assert (pdf.filename, pdf.size, pdf.disposition, pdf.encoding) == ('report.pdf', 50000, 'attachment', 'base64')
+
+
+def test_single_part():
+    structure = parse_bodystructure(fetch_attributes([b'1 (BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1))'])[b'BODYSTRUCTURE'])
+    assert (structure.section, structure.content_type, structure.params) == ('1', 'text/plain', {'charset': 'utf-8'})
+
+
+def test_policy():
+    structure = parse_bodystructure(fetch_attributes([NESTED])[b'BODYSTRUCTURE'])
+    # The bodies are kept whatever their size
+    assert [part.section for part in PartPolicy(max_size=10).skipped(structure)] == ['2', '3']
+    assert [part.section for part in PartPolicy(excluded_types=['application/*']).skipped(structure)] == ['2']
+    assert [part.section for part in PartPolicy(types=['message/rfc822']).skipped(structure)] == ['2']
+
+    pdf = parse_bodystructure([b'APPLICATION', b'PDF', None, None, None, b'BASE64', b'50000'])
+    assert PartPolicy(max_size=10000).skipped(pdf) == [pdf]
+
+
+def test_build_message():
+    structure = parse_bodystructure(fetch_attributes([NESTED])[b'BODYSTRUCTURE'])
+    skipped = PartPolicy(max_size=10000).skipped(structure)
+    items = fetch_items(structure, skipped)
+    assert 'BODY.PEEK[2.MIME]' in items and 'BODY.PEEK[2]' not in items and 'BODY.PEEK[1.1]' in items
+
+    attributes = {
+        b'BODY[HEADER]': b'Message-Id: <m@x>\r\nContent-Type: multipart/mixed; boundary="mix"\r\n\r\n',
+        b'BODY[1.MIME]': b'Content-Type: multipart/alternative; boundary="alt"\r\n\r\n',
+        b'BODY[1.1.MIME]': b'Content-Type: text/plain\r\n\r\n',
+        b'BODY[1.1]': b'Hello world',
+        b'BODY[1.2.MIME]': b'Content-Type: text/html\r\n\r\n',
+        b'BODY[1.2]': b'<p>Hello</p>',
+        b'BODY[2.MIME]': b'Content-Type: application/pdf\r\nContent-Disposition: attachment; filename="report.pdf"\r\n\r\n',
+        b'BODY[3.MIME]': b'Content-Type: message/rfc822\r\n\r\n',
+    }
+    msg = email.message_from_bytes(build_message(structure, attributes, skipped, SOURCE))
+    assert [part.get_content_type() for part in msg.get_payload()] == ['multipart/alternative', 'application/pdf', 'message/rfc822']
+    assert [part.get_payload() for part in msg.get_payload()[0].get_payload()] == ['Hello world', '<p>Hello</p>']
+    pdf = msg.get_payload()[1]
+    assert pdf.get_filename() == 'report.pdf' and not pdf.get_payload()
+    assert dict(pdf.get_params(header=SKIPPED_HEADER)[1:]) == {'account': 'test', 'folder': 'INBOX', 'section': '2',
+                                                               'size': '50000', 'uid': '7', 'uidvalidity': '1'}
+
+
+def test_build_skipped_single_part():
+    structure = parse_bodystructure([b'APPLICATION', b'PDF', [b'NAME', b'report.pdf'], None, None, b'BASE64', b'50000'])
+    skipped = PartPolicy(max_size=10000).skipped(structure)
+    assert fetch_items(structure, skipped) == ['BODY.PEEK[HEADER]']
+    header = b'Message-Id: <m@x>\r\nContent-Type: application/pdf; name="report.pdf"\r\n\r\n'
+    msg = email.message_from_bytes(build_message(structure, {b'BODY[HEADER]': header}, skipped, SOURCE))
+    assert msg.get_content_type() == 'application/pdf' and not msg.get_payload()
+    assert msg.get_param('section', header=SKIPPED_HEADER) == '1'
+
+
+def parts_by_section(structure):
+    return dict((part.section, part) for part in structure.walk())
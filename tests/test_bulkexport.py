@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+from bulkexport import BulkExport, export_files, pending_chunks, read_checkpoint, replay
+from bulkserver import BulkServer
+
+from conftest import make_account, make_options, archive
+
+
+def metadata(n):
+    return {'Subject': 'Message %d' % n, 'Body': 'x' * 100}
+
+
+def read_lines(folder):
+    lines = []
+    for name in export_files(folder):
+        with open(os.path.join(folder, name), 'rb') as f:
+            lines += [json.loads(line) for line in f]
+    return lines
+
+
+@pytest.fixture
+def bulk():
+    bulk = BulkServer().start()
+    yield bulk
+    bulk.stop()
+
+
+def test_rotation(tmp_path):
+    folder = str(tmp_path / 'export')
+    export = BulkExport(folder, str(tmp_path), max_bytes=500)
+    for n in range(1, 8):
+        export.add(str(tmp_path / 'INBOX' / '2024' / str(n)), metadata(n))
+    export.close()
+
+    files = export_files(folder)
+    assert files[:2] == ['imapbox-000001.ndjson', 'imapbox-000002.ndjson'] and len(files) > 2
+    for name in files:
+        # A message is never split across files
+        assert os.path.getsize(os.path.join(folder, name)) <= 500
+    lines = read_lines(folder)
+    assert [line['index']['_id'] for line in lines[::2]] == ['INBOX/2024/%d' % n for n in range(1, 8)]
+    assert lines[1] == metadata(1)
+
+    # The next run appends to the last file
+    export = BulkExport(folder, str(tmp_path), max_bytes=500)
+    assert export.name == files[-1]
+    export.close()
+
+
+def test_interrupted_line(tmp_path):
+    folder = str(tmp_path / 'export')
+    export = BulkExport(folder, str(tmp_path))
+    export.add(str(tmp_path / '1'), metadata(1))
+    export.close()
+    with open(os.path.join(folder, export.name), 'ab') as f:
+        f.write(b'{"index": {"_index": "imap')
+
+    # The partial line is not read, then dropped by the next run
+    assert len(list(pending_chunks(folder))) == 1
+    export = BulkExport(folder, str(tmp_path))
+    export.add(str(tmp_path / '2'), metadata(2))
+    export.close()
+    assert [line['index']['_id'] for line in read_lines(folder)[::2]] == ['1', '2']
+
+
+def test_replay_checkpoint(tmp_path, bulk):
+    folder = str(tmp_path / 'export')
+    export = BulkExport(folder, str(tmp_path), max_bytes=500)
+    for n in range(1, 4):
+        export.add(str(tmp_path / str(n)), metadata(n))
+
+    assert replay(folder, bulk.url) == 3
+    checkpoint = read_checkpoint(folder)
+    assert checkpoint['file'] == export.name
+    assert checkpoint['offset'] == os.path.getsize(os.path.join(folder, export.name))
+    assert replay(folder, bulk.url) == 0
+
+    for n in range(4, 6):
+        export.add(str(tmp_path / str(n)), metadata(n))
+    export.close()
+    requests = bulk.requests
+    assert replay(folder, bulk.url) == 2
+    assert sorted(bulk.indices['imapbox']) == ['1', '2', '3', '4', '5']
+    assert bulk.requests == requests + 2
+
+
+def test_chunks(tmp_path):
+    folder = str(tmp_path / 'export')
+    export = BulkExport(folder, str(tmp_path))
+    for n in range(1, 6):
+        export.add(str(tmp_path / str(n)), metadata(n))
+    export.close()
+    chunks = list(pending_chunks(folder, max_bytes=300))
+    assert [lines.count(b'\n') // 2 for name, offset, lines in chunks] == [2, 2, 1]
+    assert chunks[-1][1] == os.path.getsize(os.path.join(folder, export.name))
+
+
+def test_replay_refused(tmp_path, bulk):
+    folder = str(tmp_path / 'export')
+    export = BulkExport(folder, str(tmp_path))
+    export.add(str(tmp_path / '1'), metadata(1))
+    export.file.write(b'{"index": {"_index": "imapbox", "_id": "2"}}\nnot json\n')
+    export.close()
+    with pytest.raises(ValueError):
+        replay(folder, bulk.url)
+    # The chunk is sent again by the next replay
+    assert read_checkpoint(folder) == {'file': None, 'offset': 0}
+
+
+def test_archive_export(server, backend, tmp_path):
+    export = BulkExport(str(tmp_path / 'export'), str(tmp_path))
+    archive(backend, make_account(server), make_options(tmp_path / 'INBOX'), export=export)
+    export.close()
+    lines = read_lines(str(tmp_path / 'export'))
+    assert sorted(line['index']['_id'] for line in lines[::2]) == ['INBOX/2024/%dimapserver.test' % n for n in range(1, 6)]
+    assert sorted(line['Subject'] for line in lines[1::2]) == ['Message %d' % n for n in range(1, 6)]
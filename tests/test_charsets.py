@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import pytest
+
+import charsets
+from charsets import detect_charset
+
+JAPANESE = '日本語のテキストです。これは文字コードの検出のテストです。' * 5
+FRENCH = 'Ceci est un texte français, écrit en été à Noël.'
+
+
+@pytest.fixture(autouse=True)
+def cache():
+    charsets._cache.clear()
+    yield charsets._cache
+    charsets._cache.clear()
+
+
+def test_utf8_first(monkeypatch):
+    monkeypatch.setattr(charsets.chardet, 'detect', lambda payload: pytest.fail('detector called'))
+    assert detect_charset(b'') == 'ascii'
+    assert detect_charset(b'plain ascii') == 'utf-8'
+    assert detect_charset(JAPANESE.encode('utf-8'), 'example.jp') == 'utf-8'
+
+
+def test_detected():
+    assert JAPANESE.encode('shift_jis').decode(detect_charset(JAPANESE.encode('shift_jis'))) == JAPANESE
+    assert FRENCH.encode('latin-1').decode(detect_charset(FRENCH.encode('latin-1'))) == FRENCH
+
+
+def test_sample(monkeypatch):
+    sizes = []
+
+    def detect(payload):
+        sizes.append(len(payload))
+        return {'encoding': None}
+    monkeypatch.setattr(charsets.chardet, 'detect', detect)
+    assert detect_charset(b'\xff' * (charsets.DETECT_SAMPLE_SIZE * 3)) == 'ascii'
+    assert sizes == [charsets.DETECT_SAMPLE_SIZE]
+
+
+def test_cached_per_key(cache, monkeypatch):
+    charset = detect_charset(JAPANESE.encode('euc-jp'), 'example.jp')
+    assert cache == {'example.jp': charset}
+
+    # The next texts of the domain are decoded without the detector
+    detected = []
+    detect = charsets.chardet.detect
+    monkeypatch.setattr(charsets.chardet, 'detect', lambda payload: detected.append(payload) or detect(payload))
+    assert detect_charset('別のテキスト'.encode('euc-jp'), 'example.jp') == charset
+    assert detected == []
+    # Unless the cached charset can't decode them
+    assert detect_charset(JAPANESE.encode('shift_jis'), 'example.jp') != charset
+    assert len(detected) == 1
+
+    # Single-byte charsets decode anything, they are not cached
+    detect_charset(FRENCH.encode('latin-1'), 'example.fr')
+    assert 'example.fr' not in cache
+
+
+def test_cache_size(cache, monkeypatch):
+    monkeypatch.setattr(charsets, 'CACHE_SIZE', 2)
+    payload = JAPANESE.encode('euc-jp')
+    for key in ('a.jp', 'b.jp', 'a.jp', 'c.jp'):
+        detect_charset(payload, key)
+    # b.jp is the least recently used
+    assert list(cache) == ['a.jp', 'c.jp']
+
+
+def test_is_multibyte():
+    assert charsets.is_multibyte('shift_jis') and charsets.is_multibyte('euc-kr')
+    assert not charsets.is_multibyte('latin-1') and not charsets.is_multibyte('cp1252')
+    assert not charsets.is_multibyte('unknown-charset')
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""Smoke tests running imapbox.py as a command against the test servers"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from bulkserver import BulkServer
+from imapserver import ImapServer, Folder, generate_message
+
+from conftest import message_folders
+
+IMAPBOX = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'imapbox.py')
+
+
+def write_config(directory, server, **options):
+    lines = ['[imapbox]', 'local_folder=%s' % (directory / 'archive')]
+    lines += ['%s=%s' % option for option in options.items()]
+    lines += ['[test]', 'host=127.0.0.1', 'port=%d' % server.port, 'username=user', 'password=secret', 'remote_folder=INBOX']
+    (directory / 'config.cfg').write_text('\n'.join(lines) + '\n')
+
+
+def imapbox(directory, *args, timeout=60, returncode=0):
+    """Run imapbox.py in directory, with its config.cfg only, return its output"""
+    result = subprocess.run([sys.executable, IMAPBOX] + list(args), cwd=str(directory), env=dict(os.environ, HOME=str(directory)),
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+    output = result.stdout.decode('utf-8', 'replace')
+    assert result.returncode == returncode, output
+    return output
+
+
+def wait_until(condition, timeout=20):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timeout')
+        time.sleep(0.1)
+
+
+@pytest.fixture
+def server():
+    server = ImapServer({'INBOX': Folder(enumerate((generate_message(n) for n in range(1, 6)), 1))}, capabilities='IMAP4rev1 IDLE').start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize('backend', ['imaplib', 'asyncio'])
+def test_archive_and_incremental(server, tmp_path, backend):
+    write_config(tmp_path, server, backend=backend)
+    output = imapbox(tmp_path)
+    assert '5 emails created, 0 emails already exists' in output
+    assert len(message_folders(tmp_path / 'archive')) == 5
+
+    server.folders['INBOX'].append(generate_message(6))
+    del server.commands[:]
+    output = imapbox(tmp_path)
+    assert '1 emails created, 0 emails already exists' in output
+    assert len([command for command in server.commands if 'BODY.PEEK[]' in command]) == 1
+
+    assert 'No new emails in folder INBOX' in imapbox(tmp_path)
+
+
+def test_export_replay(server, tmp_path):
+    write_config(tmp_path, server, export_folder=tmp_path / 'export')
+    imapbox(tmp_path)
+    bulk = BulkServer().start()
+    try:
+        assert '5 messages sent' in imapbox(tmp_path, 'export-replay', bulk.url)
+        assert len(bulk.indices['imapbox']) == 5
+
+        # Only the lines exported since the last replay are sent
+        server.folders['INBOX'].append(generate_message(6))
+        imapbox(tmp_path)
+        assert '1 messages sent' in imapbox(tmp_path, 'export-replay', bulk.url)
+        assert len(bulk.indices['imapbox']) == 6
+    finally:
+        bulk.stop()
+
+
+def test_offline_commands(server, tmp_path):
+    write_config(tmp_path, server)
+    imapbox(tmp_path)
+    # An account without password would be asked for it, the offline commands don't read the accounts
+    (tmp_path / 'config.cfg').write_text((tmp_path / 'config.cfg').read_text().replace('password=secret\n', ''))
+    assert '5 emails indexed, 0 removed from the index' in imapbox(tmp_path, 'rebuild-index')
+    assert 'Message 3' in imapbox(tmp_path, 'search', 'lorem', '--limit', '10')
+
+
+def test_search(server, tmp_path):
+    write_config(tmp_path, server)
+    # Without an archive, the index is not created by the search
+    assert 'No index in' in imapbox(tmp_path, 'search', 'lorem', returncode=1)
+    assert not (tmp_path / 'archive' / 'imapbox.sqlite').exists()
+
+    imapbox(tmp_path)
+    assert imapbox(tmp_path, 'search', 'Message 3').split('\t')[2] == 'Message 3\n'
+    assert 'Invalid search' in imapbox(tmp_path, 'search', 'lorem AND', returncode=1)
+    write_config(tmp_path, server, fulltext=False)
+    assert 'The index and fulltext options are required' in imapbox(tmp_path, 'search', 'lorem', returncode=1)
+
+
+def test_daemon(server, tmp_path):
+    write_config(tmp_path, server, poll_interval=1, report_file=tmp_path / 'report.json')
+    report = tmp_path / 'report.json'
+
+    def saved():
+        if not report.exists():
+            return 0
+        return json.loads(report.read_text())['totals']['counters'].get('emails_saved', 0)
+
+    with open(tmp_path / 'output.txt', 'wb') as output:
+        daemon = subprocess.Popen([sys.executable, '-u', IMAPBOX, 'daemon'], cwd=str(tmp_path), env=dict(os.environ, HOME=str(tmp_path)),
+                                  stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT)
+        try:
+            # The report is written while the daemon runs
+            wait_until(lambda: saved() == 5)
+            server.folders['INBOX'].append(generate_message(6))
+            wait_until(lambda: saved() == 6)
+            assert len(message_folders(tmp_path / 'archive')) == 6
+        finally:
+            daemon.send_signal(signal.SIGINT)
+            daemon.wait(20)
+    output = (tmp_path / 'output.txt').read_text()
+    assert output.count('Copying emails...') == 2
+    assert 'Daemon stopped' in output
+
+    # backend=imaplib is refused instead of being ignored
+    write_config(tmp_path, server, backend='imaplib')
+    assert 'The daemon only runs with the asyncio backend' in imapbox(tmp_path, 'daemon')
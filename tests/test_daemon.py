@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from archiveindex import ArchiveIndex
+from daemon import Daemon
+from imapserver import ImapServer, Folder, generate_message
+from metrics import metrics
+
+from conftest import make_account, make_options, message_folders
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timeout')
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize('capabilities', ['IMAP4rev1 IDLE', 'IMAP4rev1'])
+def test_daemon(tmp_path, capsys, capabilities):
+    server = ImapServer({'INBOX': Folder(enumerate((generate_message(n) for n in range(1, 4)), 1))}, capabilities=capabilities).start()
+    local_folder = tmp_path / 'INBOX'
+    index = ArchiveIndex(str(tmp_path))
+    cycles = []
+    daemon = Daemon(poll_interval=0.1, idle_timeout=0.1, report=lambda: cycles.append(len(message_folders(local_folder))))
+    daemon.add(make_account(server), make_options(local_folder), index, None, None, None)
+    thread = threading.Thread(target=asyncio.run, args=(daemon.run(),))
+    thread.start()
+    try:
+        # The report is written after each cycle, with the messages archived so far
+        wait_until(lambda: len(cycles) >= 3)
+        assert cycles[0] == 3
+
+        server.folders['INBOX'].append(generate_message(4))
+        wait_until(lambda: cycles[-1] == 4)
+        done = len(cycles)
+        wait_until(lambda: len(cycles) >= done + 3)
+    finally:
+        daemon.stop()
+        thread.join(10)
+        server.stop()
+        index.close()
+
+    # The cycles without new messages are not logged
+    output = capsys.readouterr().out
+    assert output.count('Copying emails...') == 2
+    assert output.count('emails created in folder INBOX') == 2
+    assert not thread.is_alive()
+
+
+def test_daemon_without_index(tmp_path):
+    server = ImapServer({'INBOX': Folder(enumerate((generate_message(n) for n in range(1, 4)), 1))}).start()
+    local_folder = tmp_path / 'INBOX'
+    options = make_options(local_folder, index=False)
+    daemon = Daemon()
+
+    async def cycles():
+        mailbox = await daemon.archive(None, make_account(server), options, (None, None, None, None))
+        try:
+            server.folders['INBOX'].append(generate_message(4))
+            for i in range(2):
+                mailbox = await daemon.archive(mailbox, make_account(server), options, (None, None, None, None))
+        finally:
+            mailbox.mailbox.close()
+
+    metrics.drain()
+    try:
+        asyncio.run(cycles())
+    finally:
+        server.stop()
+    assert len(message_folders(local_folder)) == 4
+    assert daemon.states[('test', 'INBOX')]['last_uid'] == 4
+    # The messages archived by the previous cycles are not searched and prescanned again
+    counters = metrics.drain()[0]
+    assert counters[('emails_saved', 'test', 'INBOX')] == 4
+    assert counters.get(('emails_existing', 'test', 'INBOX'), 0) == 0
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+from archiveindex import ArchiveIndex
+from imapserver import ImapServer, Folder, generate_message
+from mailboxresource import extract_segments
+from segmentstore import SEGMENTS_DIRNAME
+
+from conftest import make_account, make_options, archive
+
+
+@pytest.fixture
+def condstore_server():
+    server = ImapServer({'INBOX': Folder(enumerate((generate_message(n) for n in range(1, 6)), 1))},
+                        capabilities='IMAP4rev1 CONDSTORE').start()
+    yield server
+    server.stop()
+
+
+def read_metadata(directory):
+    with open(os.path.join(directory, 'metadata.json'), encoding='utf8') as json_file:
+        return json.load(json_file)
+
+
+def test_changed_flags(condstore_server, backend, tmp_path):
+    local_folder = tmp_path / 'INBOX'
+    index = ArchiveIndex(str(tmp_path))
+    account = make_account(condstore_server)
+    archive(backend, account, make_options(local_folder), index)
+    directories = index.get_uids('test', 'INBOX')
+    assert read_metadata(directories[2])['Flags'] == []
+
+    # A local change of a message whose flags did not change on the server is not overwritten
+    metadata = read_metadata(directories[3])
+    metadata['Flags'] = ['$Local']
+    with open(os.path.join(directories[3], 'metadata.json'), 'w', encoding='utf8') as json_file:
+        json.dump(metadata, json_file)
+
+    condstore_server.folders['INBOX'].set_flags(2, ['\\Seen', '$Work'])
+    archive(backend, account, make_options(local_folder), index)
+    assert read_metadata(directories[2])['Flags'] == ['\\Seen', '$Work']
+    assert read_metadata(directories[3])['Flags'] == ['$Local']
+    assert index.get_folder('test', 'INBOX')['highestmodseq'] == condstore_server.folders['INBOX'].highestmodseq
+    index.close()
+
+
+def test_segment_flags(condstore_server, backend, tmp_path):
+    local_folder = tmp_path / 'INBOX'
+    index = ArchiveIndex(str(tmp_path))
+    account = make_account(condstore_server)
+    options = make_options(local_folder, storage='segments')
+    archive(backend, account, options, index)
+    directories = index.get_uids('test', 'INBOX')
+    assert index.get_properties(directories[2]) == {'Flags': []}
+
+    condstore_server.folders['INBOX'].set_flags(2, ['\\Seen'])
+    archive(backend, account, options, index)
+    assert index.get_properties(directories[2]) == {'Flags': ['\\Seen']}
+    assert index.get_properties(directories[1]) == {'Flags': []}
+    assert os.listdir(local_folder) == [SEGMENTS_DIRNAME]
+
+    # The flags are kept by a rebuild of the index, and written by extract
+    index.rebuild()
+    assert extract_segments(str(tmp_path), index=index) == 5
+    assert read_metadata(directories[2])['Flags'] == ['\\Seen']
+    assert read_metadata(directories[1])['Flags'] == []
+    index.close()
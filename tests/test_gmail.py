@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+from archiveindex import ArchiveIndex
+from imapserver import ImapServer, Folder, generate_message
+from mailboxresource import find_all_mail, get_folder_fist
+
+from conftest import make_account, make_options, archive, message_folders
+
+
+@pytest.fixture
+def gmail_server():
+    all_mail = Folder(attributes=('\\HasNoChildren', '\\All'))
+    work = Folder()
+    for n in range(1, 4):
+        all_mail.append(generate_message(n), labels=('\\Inbox', 'Work', 'Caf&AOk-'), gmail_id=5000 + n)
+    # The message 2 with the Work label, another Message-Id so only its Gmail id tells it is archived
+    work.append(generate_message(12), gmail_id=5002)
+    work.append(generate_message(14), gmail_id=5004)
+    # Named without the [Gmail] prefix, which is quoted in the LIST response
+    server = ImapServer({'AllMail': all_mail, 'Work': work}).start()
+    yield server
+    server.stop()
+
+
+def gmail_account(server, remote_folder):
+    return dict(make_account(server, remote_folder), gmail=True)
+
+
+def test_find_all_mail(gmail_server):
+    folder_list = get_folder_fist(make_account(gmail_server))
+    assert find_all_mail(folder_list) == b'(\\HasNoChildren \\All) "/" "AllMail"'
+    assert find_all_mail([b'(\\HasNoChildren) "/" "INBOX"']) is None
+
+
+def test_labels(gmail_server, backend, tmp_path):
+    index = ArchiveIndex(str(tmp_path))
+    archive(backend, gmail_account(gmail_server, 'AllMail'), make_options(tmp_path / 'AllMail'), index)
+    directory = index.get_uids('test', 'AllMail')[1]
+    with open(os.path.join(directory, 'metadata.json'), encoding='utf8') as json_file:
+        metadata = json.load(json_file)
+    assert metadata['Labels'] == ['\\Inbox', 'Work', 'Café'] and metadata['GmailId'] == '5001'
+    assert index.has_gmail_id('5003') and not index.has_gmail_id('5004')
+    index.close()
+
+
+@pytest.mark.parametrize('prescan', [True, False])
+def test_gmail_id_dedup(gmail_server, backend, tmp_path, prescan):
+    index = ArchiveIndex(str(tmp_path))
+    archive(backend, gmail_account(gmail_server, 'AllMail'), make_options(tmp_path / 'AllMail', prescan=prescan), index)
+    # The message archived from All Mail is skipped in the label folder, the other one is archived
+    archive(backend, gmail_account(gmail_server, 'Work'), make_options(tmp_path / 'Work', prescan=prescan), index)
+    assert message_folders(tmp_path / 'Work') == ['14imapserver.test']
+    assert len(index) == 4
+    index.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import posixpath
+import random
+import re
+
+import pytest
+
+from message import strip_tags, extract_body, rewrite_cids
+
+# Pieces of the generated html bodies, with the cid: sources of several case and quote styles
+PIECES = ['<p>', '</p>', 'lorem ipsum ', 'caf&eacute; &amp; ', '<BODY class="x">', '</Body>', '<body>', '</body>',
+          '<script>var a = "<b>";</script>', '<!-- comment -->', '<br/>', '\n', "<img src='cid:Logo@mail'>",
+          '<img src="cid:logo@MAIL">', '<img src="cid:logo@mail.x">', '<img src="cid:a.b">', '<img src="cid:aXb">',
+          '<img src="cid:other">', '<img src=cid:logo@mail>']
+EMBED = [('logo@mail', 'logo.png'), ('logo@mail.x', 'logo-x.png'), ('a.b', 'ab.gif'), ('LOGO@mail', 'second.png')]
+
+
+def old_extract_body(content):
+    """Body of the html before the single pass, found with a greedy regex"""
+    m = re.search(r'<body[^>]*>(.+)<\/body>', content, re.S | re.I)
+    return m.group(1) if m is not None else content
+
+
+def old_rewrite_cids(content, embed):
+    """cid: sources rewritten before the single pass, one re.sub per image"""
+    for img in embed:
+        pattern = r'src=["\']cid:%s["\']' % (re.escape(img[0]))
+        path = posixpath.join('attachments', img[1])
+        content = re.sub(pattern, 'src="%s"' % (path), content, 0, re.S | re.I)
+    return content
+
+
+def generate_html(rng):
+    return ''.join(rng.choice(PIECES) for i in range(rng.randint(0, 40)))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_same_output(seed):
+    rng = random.Random(seed)
+    for i in range(200):
+        content = generate_html(rng)
+        embed = rng.sample(EMBED, rng.randint(0, len(EMBED)))
+        assert extract_body(content) == old_extract_body(content)
+        assert rewrite_cids(content, embed) == old_rewrite_cids(content, embed)
+        assert strip_tags(content) == strip_tags(content, None)
+
+
+def test_rewrite_cids():
+    content = '<img src="cid:Logo@Mail"><img src=\'cid:a.b\'><img src="cid:aXb"><img src="cid:unknown">'
+    assert rewrite_cids(content, [('logo@mail', 'logo.png'), ('a.b', 'ab.gif'), ('LOGO@MAIL', 'second.png')]) == \
+        '<img src="attachments/logo.png"><img src="attachments/ab.gif"><img src="cid:aXb"><img src="cid:unknown">'
+    assert rewrite_cids(content, []) == content
+
+
+def test_strip_tags_limit():
+    content = '<p>lorem &amp; ipsum</p>' * 1000
+    text = strip_tags(content, None)
+    assert text == 'lorem & ipsum' * 1000
+    assert strip_tags(content, 100) == text[:100]
+    # Stopped after the chunk reaching the limit
+    assert strip_tags(content * 20, 100) == text[:100]
+
+
+def test_extract_body():
+    assert extract_body('<html><BODY bgcolor="white">a</body><body>b</BODY></html>') == 'a</body><body>b'
+    assert extract_body('<body></body>') == '<body></body>'
+    assert extract_body('<p>no body</p>') == '<p>no body</p>'
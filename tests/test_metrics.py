@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import contextvars
+import json
+
+from metrics import Metrics, metrics, BUCKETS
+
+from conftest import make_account, make_options, archive
+
+
+def sample_metrics():
+    run = Metrics()
+    run.labels.set(('work', 'INBOX'))
+    run.count('emails_saved', 2)
+    run.count('emails_saved')
+    run.observe('fetch', 0.002)
+    run.observe('fetch', 0.3)
+    run.observe('fetch', 100)
+
+    def other_folder():
+        run.labels.set(('home', 'Sent "old"'))
+        run.count('emails_saved')
+    contextvars.copy_context().run(other_folder)
+    return run
+
+
+def test_report(tmp_path):
+    run = sample_metrics()
+    report = run.report(1704103200, 1704103212.5)
+    assert report['started'] == '2024-01-01T10:00:00Z' and report['seconds'] == 12.5
+    assert report['totals']['counters'] == {'emails_saved': 4}
+    assert report['totals']['phases'] == {'fetch': {'count': 3, 'seconds': 100.302}}
+    folders = dict(((folder['account'], folder['folder']), folder) for folder in report['folders'])
+    assert folders[('work', 'INBOX')]['counters'] == {'emails_saved': 3}
+    buckets = folders[('work', 'INBOX')]['phases']['fetch']['buckets']
+    assert buckets['0.005'] == 1 and buckets['0.5'] == 1 and sum(buckets.values()) == 2
+    assert folders[('home', 'Sent "old"')]['phases'] == {}
+
+    run.write_report(str(tmp_path / 'report.json'), 1704103200, 1704103212.5)
+    assert json.loads((tmp_path / 'report.json').read_text()) == report
+    assert not (tmp_path / 'report.json.tmp').exists()
+
+
+def test_prometheus():
+    lines = sample_metrics().prometheus(1704103200, 1704103212.5).splitlines()
+    assert 'imapbox_last_run_timestamp_seconds 1704103212' in lines
+    assert 'imapbox_last_run_duration_seconds 12.500' in lines
+    assert lines.count('# TYPE imapbox_emails_saved_total counter') == 1
+    assert 'imapbox_emails_saved_total{account="work",folder="INBOX"} 3' in lines
+    assert 'imapbox_emails_saved_total{account="home",folder="Sent \\"old\\""} 1' in lines
+
+    # The buckets are cumulative, the observations above the last bound are only in +Inf
+    labels = 'account="work",folder="INBOX"'
+    buckets = [line for line in lines if line.startswith('imapbox_fetch_seconds_bucket{%s,' % labels)]
+    assert len(buckets) == len(BUCKETS) + 1
+    assert buckets[0].endswith(' 0') and buckets[1].endswith(' 1') and buckets[-2].endswith(' 2')
+    assert buckets[-1] == 'imapbox_fetch_seconds_bucket{%s,le="+Inf"} 3' % labels
+    assert 'imapbox_fetch_seconds_sum{%s} 100.302000' % labels in lines
+    assert 'imapbox_fetch_seconds_count{%s} 3' % labels in lines
+
+
+def test_drain_merge():
+    run = sample_metrics()
+    snapshot = run.drain()
+    assert run.report(0, 0)['totals'] == {'counters': {}, 'phases': {}}
+    run.merge(snapshot)
+    run.merge(snapshot)
+    totals = run.report(0, 0)['totals']
+    assert totals['counters'] == {'emails_saved': 8} and totals['phases']['fetch']['count'] == 6
+
+
+def test_archive_metrics(server, backend, tmp_path):
+    metrics.drain()
+    archive(backend, make_account(server), make_options(tmp_path / 'INBOX'))
+    report = metrics.report(0, 0)
+    metrics.drain()
+    folder = [folder for folder in report['folders'] if folder['folder'] == 'INBOX'][0]
+    assert folder['account'] == 'test' and folder['counters']['emails_saved'] == 5
+    assert folder['counters']['fetched_bytes'] > 5000
+    assert {'search', 'fetch', 'raw'} <= set(folder['phases'])
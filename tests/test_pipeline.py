@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import os
+
+import pytest
+
+from archiveindex import ArchiveIndex
+from imapserver import generate_message
+from pipeline import MessagePipeline
+
+from conftest import make_account, make_options, archive, message_folders
+
+
+@pytest.fixture
+def pipeline():
+    pipeline = MessagePipeline(2)
+    yield pipeline
+    pipeline.close()
+
+
+def test_archive(server, backend, pipeline, tmp_path):
+    """The messages are parsed and saved by the processes, then indexed in this one"""
+    index = ArchiveIndex(str(tmp_path))
+    archive(backend, make_account(server), make_options(tmp_path / 'INBOX'), index, pipeline=pipeline)
+    assert len(message_folders(tmp_path / 'INBOX')) == 5
+    for name in message_folders(tmp_path / 'INBOX'):
+        assert os.path.exists(tmp_path / 'INBOX' / '2024' / name / 'metadata.json')
+    assert sorted(subject for path, date, subject in index.search('lorem')) == ['Message %d' % n for n in range(1, 6)]
+    index.close()
+
+
+def test_queue_bounded(tmp_path):
+    pipeline = MessagePipeline(1, queue_size=1)
+    saved = []
+    try:
+        directory = tmp_path / 'message'
+        os.makedirs(directory)
+        finished = pipeline.submit(str(directory), generate_message(1), callback=lambda *args: saved.append(args))
+        # The next submit() would wait for this message
+        assert not pipeline.slots.acquire(blocking=False)
+        finished.result()
+        assert pipeline.slots.acquire(blocking=False)
+        pipeline.slots.release()
+    finally:
+        pipeline.close()
+    assert saved[0][0] == str(directory) and saved[0][1]['Subject'] == 'Message 1'
+    assert os.path.exists(directory / 'raw.eml.gz')
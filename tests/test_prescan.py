@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+from archiveindex import ArchiveIndex
+from imapserver import ImapServer, Folder, generate_message
+
+from conftest import make_account, make_options, archive, message_folders
+
+
+def body_fetches(server):
+    return [command for command in server.commands if 'BODY.PEEK[]' in command]
+
+
+def test_archived_messages_not_downloaded(server, backend, tmp_path, capsys):
+    # Without the index and the incremental state, the folder is searched in full again
+    options = make_options(tmp_path / 'INBOX', index=False, incremental=False)
+    archive(backend, make_account(server), options)
+    assert len(body_fetches(server)) == 1
+
+    del server.commands[:]
+    archive(backend, make_account(server), options)
+    assert body_fetches(server) == []
+    assert [command for command in server.commands if 'HEADER.FIELDS (MESSAGE-ID DATE)' in command]
+    assert '0 emails created, 5 emails already exists' in capsys.readouterr().out
+
+
+def test_messages_archived_from_another_folder(server, backend, tmp_path):
+    """The messages of Sent are the same as INBOX, they are found in the index from their headers"""
+    server.folders['Sent'] = Folder(enumerate((generate_message(n) for n in range(1, 6)), 1))
+    index = ArchiveIndex(str(tmp_path))
+    options = make_options(tmp_path, incremental=False)
+    archive(backend, make_account(server, 'INBOX'), options, index)
+    del server.commands[:]
+    archive(backend, make_account(server, 'Sent'), options, index)
+    index.close()
+    assert body_fetches(server) == []
+    assert len(message_folders(tmp_path)) == 5
+
+
+def test_message_without_message_id(backend, tmp_path, capsys):
+    message = generate_message(1).replace(b'Message-Id: <1@imapserver.test>\r\n', b'')
+    server = ImapServer({'INBOX': Folder([(1, message)])}).start()
+    try:
+        options = make_options(tmp_path / 'INBOX', index=False, incremental=False)
+        archive(backend, make_account(server), options)
+        del server.commands[:]
+        capsys.readouterr()
+        # The folder is named after the hash of the full message, it is downloaded again but not saved twice
+        archive(backend, make_account(server), options)
+        assert len(body_fetches(server)) == 1
+        assert '0 emails created, 1 emails already exists' in capsys.readouterr().out
+        assert len(message_folders(tmp_path / 'INBOX')) == 1
+    finally:
+        server.stop()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import argparse
+import os
+
+import pytest
+import zstandard
+
+import rawcodec
+from imapbox import load_configuration
+from imapserver import generate_message
+from rawcodec import RawCodec, read_raw, raw_path, raw_size, account_dictionary, dictionary_path, DICTIONARY_MIN_SAMPLES
+
+
+def write_messages(root, count, codec):
+    directories = []
+    for n in range(1, count + 1):
+        directory = os.path.join(str(root), 'INBOX', '2024', str(n))
+        os.makedirs(directory)
+        codec.write(directory, generate_message(n))
+        directories.append(directory)
+    return directories
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_round_trip(tmp_path, compression):
+    directory, = write_messages(tmp_path, 1, RawCodec(compression, 1))
+    assert os.path.basename(raw_path(directory)) == rawcodec.RAW_FILENAMES[compression]
+    assert read_raw(directory, str(tmp_path)) == generate_message(1)
+    assert raw_size(raw_path(directory)) == len(generate_message(1))
+
+    # The full message replaces a partial one
+    RawCodec(compression).as_partial().write(directory, b'partial')
+    RawCodec(compression).write(directory, generate_message(1))
+    assert sorted(os.listdir(directory)) == [rawcodec.RAW_FILENAMES[compression]]
+
+
+def test_dictionary(tmp_path):
+    directories = write_messages(tmp_path, DICTIONARY_MIN_SAMPLES, RawCodec('zstd'))
+    assert account_dictionary(str(tmp_path), 'too few', directories[:-1]) is None
+
+    path = account_dictionary(str(tmp_path), 'test/1', directories)
+    assert path == dictionary_path(str(tmp_path), 'test/1') and os.path.basename(path) == 'test_1.zdict'
+    codec = RawCodec('zstd', dictionary=path)
+    directory = os.path.join(str(tmp_path), 'INBOX', '2024', 'new')
+    os.makedirs(directory)
+    codec.write(directory, generate_message(500))
+    with open(raw_path(directory), 'rb') as f:
+        assert zstandard.get_frame_parameters(f.read()).dict_id == rawcodec.load_dictionary(path).dict_id()
+    # The dictionary is found by its id when reading
+    assert read_raw(directory, str(tmp_path)) == generate_message(500)
+    # Trained once
+    assert account_dictionary(str(tmp_path), 'test/1', []) == path
+
+    os.remove(path)
+    with pytest.raises(IOError):
+        read_raw(directory, str(tmp_path))
+
+
+def test_without_zstandard(tmp_path, monkeypatch, capsys):
+    directory, = write_messages(tmp_path, 1, RawCodec('zstd'))
+    monkeypatch.setattr(rawcodec, 'has_zstandard', False)
+    with pytest.raises(IOError, match='zstandard package is required'):
+        read_raw(directory, str(tmp_path))
+    with pytest.raises(IOError, match='zstandard package is required'):
+        RawCodec('zstd', threads=1).compress(b'data')
+    assert account_dictionary(str(tmp_path), 'test', [directory]) is None
+    assert 'zstandard package is not installed' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('compression,level,expected', [('gzip', '6', 6), ('gzip', '12', None), ('zstd', '19', 19),
+                                                        ('zstd', '0', None), ('zstd', '23', None)])
+def test_compression_level(tmp_path, monkeypatch, compression, level, expected):
+    (tmp_path / 'config.cfg').write_text('[imapbox]\ncompression=%s\ncompression_level=%s\n' % (compression, level))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    args = argparse.Namespace(command='search', local_folder=None, days=None, wkhtmltopdf=None, specific_folders=False,
+                              test_only=False, show_version=False)
+    options = load_configuration(args)
+    assert options['compression'] == compression and options['compression_level'] == expected
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import json
+import os
+
+from reprocess import reprocess, archived_messages, parse_artifacts, JOURNAL_FILENAME
+
+from conftest import make_account, make_options, archive
+
+
+def archive_inbox(server, tmp_path):
+    archive('imaplib', make_account(server), make_options(tmp_path / 'INBOX', index=False))
+    return sorted(archived_messages(str(tmp_path)))
+
+
+def write_journal(tmp_path, artifacts, directories, cut=None):
+    with open(tmp_path / JOURNAL_FILENAME, 'w', encoding='utf8') as f:
+        f.write(json.dumps(list(artifacts)) + '\n')
+        for directory in directories:
+            f.write(os.path.relpath(directory, str(tmp_path)).replace(os.sep, '/') + '\n')
+        if cut is not None:
+            # Last line of an interrupted run
+            f.write(os.path.relpath(cut, str(tmp_path))[:5])
+
+
+def remove_metadata(directories):
+    for directory in directories:
+        os.remove(os.path.join(directory, 'metadata.json'))
+
+
+def test_parse_artifacts():
+    assert parse_artifacts('html, metadata') == ('metadata', 'html')
+
+
+def test_resume(server, tmp_path, capsys):
+    directories = archive_inbox(server, tmp_path)
+    artifacts = parse_artifacts('metadata')
+    write_journal(tmp_path, artifacts, directories[:2], cut=directories[2])
+    remove_metadata(directories)
+
+    assert reprocess(str(tmp_path), artifacts, processes=1) == (3, 0)
+    assert 'Resuming, 2 emails already reprocessed' in capsys.readouterr().out
+    assert [os.path.exists(os.path.join(directory, 'metadata.json')) for directory in directories] == [False] * 2 + [True] * 3
+    assert not os.path.exists(tmp_path / JOURNAL_FILENAME)
+
+
+def test_other_artifacts_and_restart(server, tmp_path):
+    directories = archive_inbox(server, tmp_path)
+    # The journal of a run with other artifacts is not resumed
+    write_journal(tmp_path, parse_artifacts('html'), directories[:2])
+    remove_metadata(directories)
+    assert reprocess(str(tmp_path), parse_artifacts('metadata'), processes=1) == (5, 0)
+
+    write_journal(tmp_path, parse_artifacts('metadata'), directories[:2])
+    remove_metadata(directories)
+    assert reprocess(str(tmp_path), parse_artifacts('metadata'), processes=1, restart=True) == (5, 0)
+    assert all(os.path.exists(os.path.join(directory, 'metadata.json')) for directory in directories)
+
+
+def test_failure_kept_in_journal(server, tmp_path):
+    directories = archive_inbox(server, tmp_path)
+    with open(os.path.join(directories[1], 'metadata.json'), encoding='utf8') as json_file:
+        metadata = json.load(json_file)
+    metadata['Flags'] = ['\\Seen']
+    with open(os.path.join(directories[1], 'metadata.json'), 'w', encoding='utf8') as json_file:
+        json.dump(metadata, json_file)
+    raw = os.path.join(directories[3], 'raw.eml.gz')
+    with open(raw, 'rb') as f:
+        data = f.read()
+    with open(raw, 'wb') as f:
+        f.write(b'not gzip')
+
+    assert reprocess(str(tmp_path), processes=1) == (5, 1)
+    with open(tmp_path / JOURNAL_FILENAME, encoding='utf8') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 5 and os.path.relpath(directories[3], str(tmp_path)) not in lines
+
+    # The next run only retries the failed message, the flags are kept from metadata.json
+    with open(raw, 'wb') as f:
+        f.write(data)
+    assert reprocess(str(tmp_path), processes=1) == (1, 0)
+    assert not os.path.exists(tmp_path / JOURNAL_FILENAME)
+    with open(os.path.join(directories[1], 'metadata.json'), encoding='utf8') as json_file:
+        assert json.load(json_file)['Flags'] == ['\\Seen']
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+from imapserver import generate_message
+from pipeline import MessagePipeline
+from scheduler import Scheduler
+
+
+def test_output_grouped(capsys):
+    scheduler = Scheduler(workers=3)
+
+    def job(name, delay):
+        time.sleep(delay)
+        print(name)
+
+    def failing():
+        raise ValueError('job failed')
+
+    # The first group finishes last, it is still printed first
+    scheduler.add('Account A', 'host1', job, 'a1', 0.2)
+    scheduler.add('Account A', 'host1', failing)
+    scheduler.add('Account A', 'host1', job, 'a2', 0)
+    scheduler.add('Account B', 'host2', job, 'b1', 0)
+    scheduler.run()
+    output = capsys.readouterr().out
+    assert output.startswith('Account A\na1\nTraceback')
+    assert 'ValueError: job failed' in output
+    assert output.endswith('a2\nAccount B\nb1\n')
+
+
+def test_host_connections():
+    scheduler = Scheduler(workers=4, host_connections=2)
+    lock = threading.Lock()
+    running = {'host1': 0, 'host2': 0}
+    highest = {'host1': 0, 'host2': 0}
+
+    def job(host):
+        with lock:
+            running[host] += 1
+            highest[host] = max(highest[host], running[host])
+        time.sleep(0.1)
+        with lock:
+            running[host] -= 1
+
+    for n in range(4):
+        scheduler.add('Account %d' % n, 'host1', job, 'host1')
+    scheduler.add('Account 4', 'host2', job, 'host2')
+    scheduler.run()
+    assert highest == {'host1': 2, 'host2': 1}
+
+
+def test_run_async(capsys):
+    scheduler = Scheduler(workers=2, host_connections=1)
+    running = []
+    finished = []
+
+    async def job(name):
+        running.append(name)
+        # A single job per host at a time
+        assert running.count(name[0]) <= 1
+        await asyncio.sleep(0.05)
+        running.remove(name)
+        print(name)
+
+    async def close():
+        finished.append(True)
+
+    for name in ('a1', 'a2', 'b1'):
+        scheduler.add('Account ' + name[0], name[0], job, name)
+    scheduler.run_async(close)
+    assert capsys.readouterr().out == 'Account a\na1\na2\nAccount b\nb1\n'
+    assert finished == [True]
+
+
+def test_pipeline_output(tmp_path, capsys):
+    """What the processes print goes to the output of the job which submitted the message"""
+    pipeline = MessagePipeline(1)
+    scheduler = Scheduler(workers=2)
+
+    def job(name):
+        # The directory is missing, the process prints why the message was not saved
+        pipeline.submit(str(tmp_path / 'missing' / name), generate_message(1)).result()
+        print(name + ' done')
+
+    scheduler.add('Account A', 'host1', job, 'a')
+    scheduler.add('Account B', 'host2', job, 'b')
+    try:
+        scheduler.run()
+    finally:
+        pipeline.close()
+    output = capsys.readouterr().out.split('Account B\n')
+    assert len(output) == 2
+    assert output[0].startswith('Account A\n') and 'missing/a' in output[0] and output[0].endswith('a done\n')
+    assert 'missing/b' in output[1] and output[1].endswith('b done\n')
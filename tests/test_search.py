@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import os
+
+from archiveindex import ArchiveIndex, INDEX_FILENAME
+
+
+def add_message(index, tmp_path, name, date, subject, sender, to, body, attachments=()):
+    directory = str(tmp_path / 'INBOX' / name)
+    index.add(directory, '<%s>' % name, date=date)
+    index.add_text(directory, {'Subject': subject, 'From': sender, 'To': [to], 'Body': body, 'Attachments': list(attachments)})
+
+
+def test_search(tmp_path):
+    index = ArchiveIndex(str(tmp_path))
+    add_message(index, tmp_path, 'a', '20240105T100000Z', 'Invoice January', ['Alice', 'alice@example.com'],
+                ['Bob', 'bob@example.com'], 'Please find the invoice attached', ['invoice-01.pdf'])
+    add_message(index, tmp_path, 'b', '20240210T100000Z', 'Invoice February', ['Carol', 'carol@example.com'],
+                ['Bob', 'bob@example.com'], 'The second invoice')
+    add_message(index, tmp_path, 'c', '20240301T100000Z', 'Lunch', ['Bob', 'bob@example.com'],
+                ['Alice', 'alice@example.com'], 'See you at noon')
+
+    def paths(*args, **kwargs):
+        return [os.path.basename(row[0]) for row in index.search(*args, **kwargs)]
+
+    # Newest first
+    assert paths('invoice') == ['b', 'a']
+    assert paths('invoice', limit=1) == ['b']
+    assert paths(sender='alice@example.com') == ['a']
+    assert paths(recipient='Alice') == ['c']
+    assert paths('invoice', since='2024-02-01') == ['b']
+    assert paths(before='2024-02-01') == ['a']
+    assert paths('attachments : pdf') == ['a']
+    assert index.search('noon')[0][1:] == ('20240301T100000Z', 'Lunch')
+
+    # The text is replaced when a message is indexed again
+    add_message(index, tmp_path, 'c', '20240301T100000Z', 'Dinner', ['Bob', 'bob@example.com'],
+                ['Alice', 'alice@example.com'], 'See you tonight')
+    assert paths('noon') == [] and paths('tonight') == ['c']
+    index.close()
+
+
+def test_without_fulltext(tmp_path):
+    index = ArchiveIndex(str(tmp_path), fulltext=False)
+    add_message(index, tmp_path, 'a', '20240105T100000Z', 'Invoice', ['Alice', 'alice@example.com'],
+                ['Bob', 'bob@example.com'], 'Body')
+    index.close()
+    assert os.path.exists(tmp_path / INDEX_FILENAME)
+    assert ArchiveIndex(str(tmp_path)).search('invoice') == []
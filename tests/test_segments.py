@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import gzip
+import os
+
+import pytest
+import zstandard
+
+import rawcodec
+from archiveindex import ArchiveIndex
+from imapserver import generate_message
+from mailboxresource import extract_segments
+from rawcodec import RawCodec, train_dictionary
+from segmentstore import SegmentStore, SEGMENTS_DIRNAME, stored_messages
+
+from conftest import make_account, make_options, archive, message_folders
+
+
+def test_round_trip(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    messages = dict(('2024/%d' % n, generate_message(n)) for n in range(1, 4))
+    for key, data in messages.items():
+        assert store.add(key, '2024-01', data)
+    assert not store.add('2024/1', '2024-01', b'again')
+    assert store.add('2024/9', '2024-02', generate_message(9), RawCodec('zstd'))
+
+    # The index is read again by a new store
+    store = SegmentStore(str(tmp_path))
+    assert len(store) == 4 and store.keys('2024-01') == sorted(messages)
+    for key, data in messages.items():
+        assert store.read(key) == data
+    assert store.read('2024/9') == generate_message(9)
+    # A gzip segment is a gzip file, a zstd one a zstd stream
+    folder = tmp_path / SEGMENTS_DIRNAME
+    assert gzip.decompress((folder / '2024-01.seg').read_bytes()) == b''.join(messages.values())
+    assert zstandard.ZstdDecompressor().decompressobj().decompress((folder / '2024-02.seg').read_bytes()) == generate_message(9)
+    assert stored_messages(str(tmp_path))[str(tmp_path / '2024' / '9')][1] == '2024/9'
+
+
+def test_interrupted_index(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    store.add('2024/1', '2024-01', generate_message(1))
+    with open(tmp_path / SEGMENTS_DIRNAME / '2024-01.idx', 'ab') as f:
+        f.write(b'2024/2\t12')
+    store = SegmentStore(str(tmp_path))
+    assert store.keys() == ['2024/1']
+    assert store.add('2024/2', '2024-01', generate_message(2))
+    assert SegmentStore(str(tmp_path)).read('2024/2') == generate_message(2)
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_archive_and_extract(server, backend, tmp_path, compression):
+    local_folder = tmp_path / 'INBOX'
+    index = ArchiveIndex(str(tmp_path))
+    options = make_options(local_folder, storage='segments', raw_codec=RawCodec(compression, 1))
+    archive(backend, make_account(server), options, index)
+    assert os.listdir(local_folder) == [SEGMENTS_DIRNAME]
+    assert sorted(os.listdir(local_folder / SEGMENTS_DIRNAME)) == ['2024-01.idx', '2024-01.seg']
+    magic = (local_folder / SEGMENTS_DIRNAME / '2024-01.seg').read_bytes()[:4]
+    assert magic.startswith(rawcodec.GZIP_MAGIC) if compression == 'gzip' else magic == b'\x28\xb5\x2f\xfd'
+    # The messages are found in the index and the segments by the next runs
+    assert len(index.search('lorem')) == 5
+    archive(backend, make_account(server), dict(options, incremental=False), index)
+    index.close()
+    # Without the index, the messages are found in the segments
+    archive(backend, make_account(server), dict(options, incremental=False))
+    assert len(SegmentStore(str(local_folder))) == 5
+
+    assert extract_segments(str(tmp_path), ['INBOX/2024/3imapserver.test']) == 1
+    assert message_folders(local_folder) == ['3imapserver.test']
+    assert extract_segments(str(tmp_path)) == 4
+    assert (local_folder / '2024' / '1imapserver.test' / 'raw.eml.gz').exists()
+
+
+def test_segment_dictionary(tmp_path, monkeypatch):
+    monkeypatch.setattr(rawcodec, 'DICTIONARY_MIN_SAMPLES', 20)
+    store = SegmentStore(str(tmp_path / 'INBOX'))
+    for n in range(1, 41):
+        store.add('2024/%d' % n, '2024-01', generate_message(n))
+    stored = stored_messages(str(tmp_path))
+    path = train_dictionary(str(tmp_path), list(stored), 'test', read=lambda directory: stored[directory][0].read(stored[directory][1]))
+    codec = RawCodec('zstd', dictionary=path)
+    store.add('2024/41', '2024-02', generate_message(41), codec)
+    assert zstandard.get_frame_parameters(codec.compress(b'x')).dict_id
+    # The dictionary is found in the archive root
+    assert next(iter(s for s in stored_messages(str(tmp_path)).values()))[0].read('2024/41') == generate_message(41)
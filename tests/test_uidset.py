@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import imaplib
+
+import pytest
+
+from imapserver import ImapServer, Folder, generate_message
+from mailboxresource import check_esearch, uid_set
+from uidset import UidSet, merge, parse_esearch
+
+from conftest import make_account, make_options, archive, message_folders
+
+
+def test_merge():
+    assert merge([(7, 7), (1, 3), (4, 5), (9, 12), (10, 11)]) == [(1, 5), (7, 7), (9, 12)]
+    assert merge([]) == []
+
+
+def test_parse():
+    uids = UidSet.parse(b'9:12,1:4,7,3,15:13')
+    assert uids.ranges == [(1, 4), (7, 7), (9, 15)]
+    assert str(uids) == '1:4,7,9:15' and len(uids) == 12
+    assert UidSet.parse('') == UidSet()
+    assert str(UidSet([b'3', b'1', b'2', b'8', b'2'])) == uid_set([b'1', b'2', b'3', b'8']) == '1:3,8'
+
+
+def test_positions():
+    uids = UidSet.parse('1:4,7,9:12')
+    assert list(uids) == [str(uid).encode() for uid in (1, 2, 3, 4, 7, 9, 10, 11, 12)]
+    assert uids[0] == b'1' and uids[4] == b'7' and uids[5] == b'9' and uids[-1] == b'12'
+    with pytest.raises(IndexError):
+        uids[9]
+    assert str(uids[3:6]) == '4,7,9' and str(uids[5:]) == '9:12' and str(uids[:0]) == ''
+    assert b'7' in uids and 10 in uids and b'8' not in uids and 13 not in uids
+    # Batches by position cover the set exactly once
+    assert UidSet().union(uids[0:4]).union(uids[4:8]).union(uids[8:]) == uids
+
+
+def test_union_after():
+    uids = UidSet.parse('1:4,9')
+    assert str(uids.union([b'5', b'6', b'8'])) == '1:6,8:9'
+    assert str(uids.after(3)) == '4,9' and str(uids.after(9)) == '' and uids.max() == 9
+    assert UidSet().max() is None
+
+
+def test_parse_esearch():
+    uids, count = parse_esearch(b'(TAG "A5") UID COUNT 6 ALL 4:6,10,12:13')
+    assert str(uids) == '4:6,10,12:13' and count == 6
+    uids, count = parse_esearch('(TAG "A5") UID')
+    assert len(uids) == 0 and count is None
+    assert str(check_esearch(b'(TAG "A5") UID ALL 2:3')) == '2:3'
+    with pytest.raises(imaplib.IMAP4.error):
+        check_esearch(b'(TAG "A5") UID COUNT 3 ALL 2:3')
+
+
+def test_esearch_archive(backend, tmp_path):
+    folder = Folder()
+    for uid in (1, 2, 3, 7, 8, 20):
+        folder.append(generate_message(uid), uid)
+    server = ImapServer({'INBOX': folder}, capabilities='IMAP4rev1 ESEARCH').start()
+    try:
+        archive(backend, make_account(server), make_options(tmp_path / 'INBOX', index=False, fetch_batch_size=2))
+    finally:
+        server.stop()
+    assert len(message_folders(tmp_path / 'INBOX')) == 6
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import bisect
+import re
+
+
+def merge(ranges):
+    """Sorted (first, last) ranges with the overlapping and adjacent ones joined"""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class UidSet:
+    """Sorted set of UIDs stored as ranges, like the IMAP sequence set 1:4,7,9:12
+
+    The UIDs are iterated as bytes, like the ones of imaplib responses, and a
+    slice by position is a UidSet too, so a folder of 500k messages is
+    batched without ever holding a list of its UIDs.
+    """
+
+    def __init__(self, uids=()):
+        if isinstance(uids, UidSet):
+            self.ranges = list(uids.ranges)
+        else:
+            self.ranges = merge((int(uid), int(uid)) for uid in uids)
+        self.index()
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        uids = cls()
+        uids.ranges = merge(ranges)
+        uids.index()
+        return uids
+
+    @classmethod
+    def parse(cls, text):
+        """UidSet of a sequence set like 1:4,7, as found in ESEARCH responses"""
+        if isinstance(text, bytes):
+            text = text.decode('ascii')
+        ranges = []
+        for part in text.split(','):
+            if not part:
+                continue
+            first, _, last = part.partition(':')
+            first, last = int(first), int(last or first)
+            ranges.append((min(first, last), max(first, last)))
+        return cls.from_ranges(ranges)
+
+    def index(self):
+        """Position of the first UID of each range, to slice by position"""
+        self.starts = []
+        self.count = 0
+        for first, last in self.ranges:
+            self.starts.append(self.count)
+            self.count += last - first + 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for first, last in self.ranges:
+            for uid in range(first, last + 1):
+                yield str(uid).encode()
+
+    def __contains__(self, uid):
+        uid = int(uid)
+        i = bisect.bisect_right(self.ranges, (uid, float('inf'))) - 1
+        return i >= 0 and self.ranges[i][0] <= uid <= self.ranges[i][1]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            if key < 0:
+                key += self.count
+            if not 0 <= key < self.count:
+                raise IndexError('UidSet index out of range')
+            i = bisect.bisect_right(self.starts, key) - 1
+            return str(self.ranges[i][0] + key - self.starts[i]).encode()
+
+        start, stop, step = key.indices(self.count)
+        if step != 1:
+            raise ValueError('UidSet slices have no step')
+        ranges = []
+        i = max(0, bisect.bisect_right(self.starts, start) - 1)
+        while i < len(self.ranges) and self.starts[i] < stop:
+            first, last = self.ranges[i]
+            first = first + max(0, start - self.starts[i])
+            last = min(last, self.ranges[i][0] + stop - 1 - self.starts[i])
+            if first <= last:
+                ranges.append((first, last))
+            i += 1
+        return UidSet.from_ranges(ranges)
+
+    def __eq__(self, other):
+        return isinstance(other, UidSet) and self.ranges == other.ranges
+
+    def __str__(self):
+        return ','.join(str(first) if first == last else '%d:%d' % (first, last) for first, last in self.ranges)
+
+    def __repr__(self):
+        return 'UidSet(%r)' % str(self)
+
+    def max(self):
+        return self.ranges[-1][1] if self.ranges else None
+
+    def union(self, other):
+        return UidSet.from_ranges(self.ranges + UidSet(other).ranges)
+
+    def after(self, uid):
+        """UIDs greater than uid"""
+        return UidSet.from_ranges((max(first, uid + 1), last) for first, last in self.ranges if last > uid)
+
+
+def parse_esearch(data):
+    """UidSet and COUNT of an ESEARCH response like (TAG "A5") UID COUNT 3 ALL 4:6, COUNT is None if not returned"""
+    if isinstance(data, str):
+        data = data.encode()
+    found = re.search(rb'\bALL ([\d:,]+)', data)
+    count = re.search(rb'\bCOUNT (\d+)', data)
+    uids = UidSet.parse(found.group(1)) if found else UidSet()
+    return uids, int(count.group(1)) if count else None